@@ -0,0 +1,99 @@
+# Local training of K emulated clients in one process: one model.fit (or compiled
+# engine step) per client against utils.batched.BatchedTrainer, which trains all K as
+# one vectorised graph, on MNIST-shaped random shards. Reports client-rounds/s of the
+# rounds after the first, and how far (relative L2) the batched weights end up from
+# training every client on its own with train_on_batch on the same batches.
+# Run from emulator/: python -m benchmarks.batched [--clients 16 --shard 600 --batch_size 32 --rounds 3]
+import argparse
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from models import create_custom_cnn
+from utils.batched import BatchedTrainer
+from utils.ml import make_indexed_dataset, make_stacked_dataset, TrainingEngine
+
+def build(n, weights=None):
+    models = []
+    for _ in range(n):
+        model = create_custom_cnn()
+        model.compile(optimizer='adam', loss='sparse_categorical_crossentropy')
+        if weights is not None:
+            model.set_weights(weights)
+        models.append(model)
+    return models
+
+def deviation(models, references):
+    # Largest relative L2 distance between the weights of corresponding models
+    result = 0.0
+    for model, reference in zip(models, references):
+        a = np.concatenate([w.ravel() for w in model.get_weights()])
+        b = np.concatenate([w.ravel() for w in reference.get_weights()])
+        result = max(result, float(np.linalg.norm(a - b) / np.linalg.norm(b)))
+    return result
+
+def timed(rounds, train):
+    # Seconds per round of the rounds after the first (which traces and builds)
+    train(0)
+    start_time = time.perf_counter()
+    for i in range(1, rounds):
+        train(i)
+    return (time.perf_counter() - start_time) / max(rounds - 1, 1)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--shard', type=int, default=600, help='Samples per client')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    n = args.clients * args.shard
+    x = rng.integers(0, 256, (n, 28, 28, 1), dtype=np.uint8)
+    y = rng.integers(0, 10, n)
+    shards = [np.arange(i * args.shard, (i + 1) * args.shard) for i in range(args.clients)]
+    weights = create_custom_cnn().get_weights()
+    print(f'{args.clients} clients x {args.shard} samples, batch size {args.batch_size}, {os.cpu_count()} CPUs')
+
+    results = {}
+    models = build(args.clients, weights)
+    datasets = [make_indexed_dataset(x, y, shard, args.batch_size, shuffle=True, seed=i) for i, shard in enumerate(shards)]
+    results['fit'] = timed(args.rounds, lambda _: [m.fit(ds, epochs=1, verbose=0) for m, ds in zip(models, datasets)])
+
+    engines = [TrainingEngine(m, jit_compile=False) for m in build(args.clients, weights)]
+    results['compiled'] = timed(args.rounds, lambda _: [e.train(ds) for e, ds in zip(engines, datasets)])
+
+    models = build(args.clients, weights)
+    trainer = BatchedTrainer(models[0], args.clients)
+    for slot, model in enumerate(models):
+        trainer.load(slot, model)
+    batched_datasets = []
+    def train_batched(i):
+        batched_datasets.append(make_stacked_dataset(x, y, shards, args.batch_size, seed=i))
+        trainer.train(batched_datasets[-1])
+    results['batched'] = timed(args.rounds, train_batched)
+
+    print()
+    for label, seconds in results.items():
+        print(f'  {label:<10} {seconds:7.2f} s/round  {args.clients / seconds:7.2f} client-rounds/s '
+              f'({results["fit"] / seconds:5.2f}x)')
+
+    # The same batches, client by client, and again from weights perturbed by float32
+    # rounding: small differences grow quickly when training on random data, so the
+    # second gives the scale at which the batched result is indistinguishable
+    references = build(args.clients, weights)
+    perturbed = build(args.clients, [w * (1 + 1e-7 * rng.standard_normal(w.shape)).astype(np.float32) for w in weights])
+    for ds in batched_datasets:
+        for xb, yb, mask in ds:
+            for slot, (xc, yc, mc) in enumerate(zip(xb.numpy(), yb.numpy(), mask.numpy())):
+                if mc.any():
+                    references[slot].train_on_batch(xc[mc], yc[mc])
+                    perturbed[slot].train_on_batch(xc[mc], yc[mc])
+    for slot, model in enumerate(models):
+        trainer.store(slot, model)
+    print(f'  largest relative weight difference to per-client training: {deviation(models, references):.2e} '
+          f'(per-client training from perturbed weights: {deviation(perturbed, references):.2e})')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# Bytes uploaded vs accuracy of update compression options: N FedAvg rounds of the
+# MNIST CNN of utils/ml.py, K clients each training on its own shard. Updates go
+# through the same encoder/decoder as script.py and manager.py (no chain or IPFS).
+# Run from emulator/: python -m benchmarks.compression [--clients 4 --rounds 5]
+import argparse
+import tensorflow as tf
+from utils.aggregate import FedAvg
+from utils.compression import UpdateEncoder, decode_update, parse_compression
+from utils.ml import create_model, load_mnist_dataset, make_dataset, partition_indices
+from utils.weights import model_weight_names
+
+DEFAULT_SPECS = 'none;delta,fp16;delta,int8;delta,topk=0.1;delta,topk=0.01,int8'
+
+def run(spec, dataset, n_clients, num_shards, rounds, epochs, batch_size, seed):
+    (x_train, y_train), test_ds = dataset
+    tf.keras.utils.set_random_seed(seed)
+    global_model = create_model()
+    clients = [create_model() for _ in range(n_clients)]
+    encoders = [UpdateEncoder(parse_compression(spec)) for _ in range(n_clients)]
+    shards = [partition_indices(y_train, num_shards, i, seed=seed) for i in range(n_clients)]
+    train_sets = [make_dataset(x_train[shard], y_train[shard], batch_size, shuffle=True, seed=seed) for shard in shards]
+    names = model_weight_names(global_model)
+
+    uploaded = 0
+    for niter in range(rounds):
+        base, base_cid = global_model.get_weights(), f'round-{niter}'
+        fedavg = FedAvg()
+        for model, encoder, shard, train_ds in zip(clients, encoders, shards, train_sets):
+            model.set_weights(base)
+            encoder.set_base(base, base_cid)
+            model.fit(train_ds, epochs=epochs, verbose=0)
+            payload = encoder.encode(model.get_weights(), names)
+            uploaded += len(payload)
+            fedavg.add(decode_update(payload, base, base_cid), len(shard))
+        global_model.set_weights(fedavg.result())
+    accuracy = global_model.evaluate(test_ds, verbose=0)[1]
+    return uploaded / (rounds * n_clients), accuracy
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--specs', type=str, default=DEFAULT_SPECS, help='Semicolon-separated compression specs')
+    parser.add_argument('--clients', type=int, default=4, help='Clients per round')
+    parser.add_argument('--num_shards', type=int, default=10, help='Training set shards, client i trains on shard i (as in script.py)')
+    parser.add_argument('--rounds', type=int, default=5, help='Global rounds')
+    parser.add_argument('--epochs', type=int, default=1, help='Local epochs per round')
+    parser.add_argument('--batch_size', type=int, default=64, help='Local batch size')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of model initialisation and sharding')
+    args = parser.parse_args()
+
+    (x_train, y_train), (x_test, y_test) = load_mnist_dataset()
+    dataset = (x_train, y_train), make_dataset(x_test, y_test, args.batch_size)
+    results = {spec: run(spec, dataset, args.clients, args.num_shards, args.rounds, args.epochs, args.batch_size, args.seed)
+               for spec in args.specs.split(';')}
+    full = results.get('none', next(iter(results.values())))[0]
+    for spec, (nbytes, accuracy) in results.items():
+        print(f'{spec:>22}: {nbytes / 1024:9.1f} KiB/upload ({full / nbytes:6.1f}x smaller), '
+              f'accuracy after {args.rounds} rounds {accuracy:.4f}')
+
+if __name__ == '__main__':
+    main()
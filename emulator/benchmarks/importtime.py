@@ -0,0 +1,42 @@
+# Import-time profile of an emulator module, from `python -X importtime`: self time
+# summed per top-level package (wherever in the tree it was imported from), and the
+# slowest single modules. Run from emulator/: python -m benchmarks.importtime [--module script]
+import argparse
+import subprocess
+import sys
+from collections import defaultdict
+
+def profile(module):
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          capture_output=True, text=True, check=True)
+    # "import time: self [us] | cumulative | imported package"
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        rows.append((name.strip(), int(self_us)))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', type=str, default='script', help='Module to import')
+    parser.add_argument('--top', type=int, default=15, help='Rows per table')
+    args = parser.parse_args()
+
+    rows = profile(args.module)
+    packages = defaultdict(int)
+    for name, self_us in rows:
+        packages[name.split('.')[0]] += self_us
+    total = sum(packages.values())
+
+    print(f'import {args.module}: {total / 1e6:.3f} s in {len(rows)} modules')
+    print(f'\n{"self":>12}  package')
+    for name, us in sorted(packages.items(), key=lambda kv: -kv[1])[:args.top]:
+        print(f'{us / 1e3:9.1f} ms  {name}')
+    print(f'\n{"self":>12}  module')
+    for name, self_us in sorted(rows, key=lambda r: -r[1])[:args.top]:
+        print(f'{self_us / 1e3:9.1f} ms  {name}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# Micro-benchmark of IPFS client handling against the in-process stub daemon:
+# connect() per call (previous behaviour) vs the pooled keep-alive clients.
+# Run from emulator/: python -m benchmarks.ipfs_pool [--workers 8 --ops 50 --size 65536]
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ipfshttpclient import connect
+from utils.ipfs import ClientPool
+from benchmarks.stub_ipfs import start_stub_ipfs
+
+def run_threads(workers, ops, fn):
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(lambda _: fn(), range(workers * ops)))
+    return time.perf_counter() - start_time
+
+def bench_connect(addr, data, workers, ops):
+    def roundtrip():
+        client = connect(addr)
+        cid = client.add_bytes(data)
+        client = connect(addr)
+        assert client.cat(cid) == data
+    return run_threads(workers, ops, roundtrip)
+
+def bench_pool(addr, data, workers, ops):
+    pool = ClientPool(workers, addr)
+    def roundtrip():
+        with pool.client() as client:
+            cid = client.add_bytes(data)
+        with pool.client() as client:
+            assert client.cat(cid) == data
+    elapsed = run_threads(workers, ops, roundtrip)
+    pool.close()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=8, help='Concurrent emulated clients')
+    parser.add_argument('--ops', type=int, default=50, help='add+cat round trips per client')
+    parser.add_argument('--size', type=int, default=1 << 16, help='Payload size in bytes')
+    args = parser.parse_args()
+
+    server = start_stub_ipfs()
+    port = server.server_address[1]
+    addr = f'/ip4/127.0.0.1/tcp/{port}/http'
+    data = os.urandom(args.size)
+    total = args.workers * args.ops
+
+    results = {
+        'connect per call': bench_connect(addr, data, args.workers, args.ops),
+        'pooled sessions': bench_pool(addr, data, args.workers, args.ops),
+    }
+    for name, elapsed in results.items():
+        print(f'{name:>17}: {elapsed:7.3f} s, {total / elapsed:8.1f} round trips/s, {elapsed / total * 1e3:7.2f} ms/round trip')
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
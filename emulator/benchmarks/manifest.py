@@ -0,0 +1,102 @@
+# Global weights as one encrypted blob vs a manifest of per-layer chunks, against the
+# in-process IPFS stub with per-request latency and per-connection bandwidth. Reports
+# upload and load time, time to the first assigned layer and the bytes moved, for a
+# cold load, a second round (the first half of the layers is frozen, as in fine-tuning)
+# and a second client on the same host sharing the payload cache.
+# Run from emulator/: python -m benchmarks.manifest [--model resnet18 --latency_ms 20 --mbps 200]
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from models import build_resnet18, create_custom_cnn
+from utils.cache import CIDCache
+from utils.ipfs import configure_pool, enc_upload_weight_to_ipfs, enc_upload_manifest_to_ipfs, fetch_decrypted_payload, assign_payload
+from utils.trace import Tracer
+from benchmarks.stub_ipfs import start_stub_ipfs
+
+def build(name):
+    if name == 'cnn':
+        return create_custom_cnn()
+    return build_resnet18(input_shape=(28, 28, 1), num_classes=10)
+
+def freeze_first_half(model):
+    layers = [layer for layer in model.layers if layer.weights]
+    for layer in layers[:len(layers) // 2]:
+        layer.trainable = False
+
+def train_step(model, rng):
+    # Stand-in for a round of training: every variable of a layer that is not frozen
+    # changes, BatchNormalization statistics included
+    for layer in model.layers:
+        if layer.trainable:
+            for v in layer.weights:
+                v.assign(v.numpy() + rng.standard_normal(v.shape).astype('float32') * 1e-3)
+
+def load(server, tracer, model, cid, aesKey, cache=None):
+    served = server.stats['served']
+    start_time = time.perf_counter()
+    with tracer.span('load') as span:
+        assign_payload(model, fetch_decrypted_payload(cid, aesKey, cache), cache)
+    elapsed = time.perf_counter() - start_time
+    # A blob is only assigned once all of it arrived
+    first = span.phases['first_chunk'][0] + (elapsed - span.phases['first_chunk'][0] - span.phases['fetch'][0]
+                                              - span.phases['assign'][0]) if 'first_chunk' in span.phases else elapsed
+    return elapsed, first, server.stats['served'] - served
+
+def upload(server, storage, model, aesKey, previous=None):
+    added = server.stats['added']
+    start_time = time.perf_counter()
+    if storage == 'manifest':
+        cid, chunks = enc_upload_manifest_to_ipfs(model, aesKey, previous=previous)
+    else:
+        cid, chunks = enc_upload_weight_to_ipfs(model, aesKey), None
+    return cid, chunks, time.perf_counter() - start_time, server.stats['added'] - added
+
+def report(label, up, up_bytes, loaded):
+    elapsed, first, served = loaded
+    print(f'  {label:<22} upload {up * 1e3:8.1f} ms {up_bytes / 2**20:7.2f} MiB | '
+          f'load {elapsed * 1e3:8.1f} ms, first layer {first * 1e3:8.1f} ms, {served / 2**20:7.2f} MiB fetched')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='resnet18', choices=['cnn', 'resnet18'])
+    parser.add_argument('--latency_ms', type=float, default=20, help='Stub IPFS latency per request')
+    parser.add_argument('--mbps', type=float, default=200, help='Stub IPFS bandwidth per connection in MB/s (0: unlimited)')
+    parser.add_argument('--pool_size', type=int, default=8, help='IPFS connections, i.e. chunks fetched in parallel')
+    args = parser.parse_args()
+
+    server = start_stub_ipfs(latency=args.latency_ms / 1e3, bandwidth=int(args.mbps * 1e6))
+    configure_pool(args.pool_size, f'/ip4/127.0.0.1/tcp/{server.server_address[1]}/http')
+    tracer = Tracer('benchmark')
+    rng = np.random.default_rng(0)
+    global_model = build(args.model)
+    print(f'{args.model}: {global_model.count_params()} parameters, {args.latency_ms:g} ms latency, '
+          f'{args.mbps:g} MB/s per connection, {args.pool_size} connections')
+
+    for storage in ('blob', 'manifest'):
+        print(f'{storage}:')
+        manager, client, other = build(args.model), build(args.model), build(args.model)
+        manager.set_weights(global_model.get_weights())
+        for model in (manager, client, other):
+            freeze_first_half(model)
+        aesKey = os.urandom(32)
+        cid, chunks, up, up_bytes = upload(server, storage, manager, aesKey)
+        report('cold', up, up_bytes, load(server, tracer, client, cid, aesKey))
+        load(server, tracer, other, cid, aesKey)
+
+        # Next round: everything but the frozen layers was trained
+        train_step(manager, rng)
+        train_step(client, rng)
+        aesKey = os.urandom(32)
+        cid, chunks, up, up_bytes = upload(server, storage, manager, aesKey, chunks)
+        report('next round', up, up_bytes, load(server, tracer, client, cid, aesKey))
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = CIDCache(cache_dir, 1 << 30)
+            load(server, tracer, client, cid, aesKey, cache)
+            report('second client, cache', 0, 0, load(server, tracer, other, cid, aesKey, cache))
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# Local training of the clients of one process in their own threads (script.py's
+# default, --train_workers concurrent fits) against utils.workers.TrainingPool (--engine
+# pool), on an MNIST-shaped random dataset prepared in a temporary --data_dir. Every
+# round all clients train at once; reports the round time, client-rounds/s and the
+# pool's queue depth and utilisation report.
+# Run from emulator/: python -m benchmarks.pool [--clients 8 --num_shards 60 --workers 2 --train_workers 2]
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from models import create_custom_cnn
+from utils.ml import load_mnist_memmap, load_client_datasets
+from utils.workers import TrainingPool
+
+def prepare_data(root, n=60000):
+    # The files prepare_mnist_memmap writes, with random images
+    path = os.path.join(root, 'mnist')
+    os.makedirs(path)
+    rng = np.random.default_rng(0)
+    np.save(os.path.join(path, 'x_train.npy'), rng.random((n, 28, 28, 1), dtype=np.float32))
+    np.save(os.path.join(path, 'y_train.npy'), rng.integers(0, 10, n).astype(np.uint8))
+    np.save(os.path.join(path, 'x_test.npy'), rng.random((100, 28, 28, 1), dtype=np.float32))
+    np.save(os.path.join(path, 'y_test.npy'), rng.integers(0, 10, 100).astype(np.uint8))
+    open(os.path.join(path, 'ready'), 'w').close()
+
+def build(n):
+    models = []
+    for _ in range(n):
+        model = create_custom_cnn()
+        model.compile(optimizer='adam', loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+        models.append(model)
+    return models
+
+async def rounds(n, train_all):
+    times = []
+    for _ in range(n):
+        start_time = time.perf_counter()
+        await train_all()
+        times.append(time.perf_counter() - start_time)
+    return times
+
+def report(label, clients, times):
+    steady = np.median(times[1:] or times)
+    print(f'  {label:<26} first round {times[0]:6.2f} s, then {steady:6.2f} s/round, {clients / steady:6.2f} client-rounds/s')
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--num_shards', type=int, default=60, help='Shards of the 60000 samples (60: 1000 per client)')
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--workers', type=int, default=2, help='Pool worker processes')
+    parser.add_argument('--train_workers', type=int, default=2, help='Concurrent fits of the in-process baseline')
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+    print(f'{args.clients} clients, {60000 // args.num_shards} samples each, {len(os.sched_getaffinity(0))} CPUs')
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        prepare_data(data_dir)
+        data = load_mnist_memmap(data_dir)[0]
+        loop = asyncio.get_running_loop()
+
+        models = build(args.clients)
+        datasets = [load_client_datasets(data, i % args.num_shards, args.num_shards, batch_size=args.batch_size)[0]
+                    for i in range(args.clients)]
+        executor = ThreadPoolExecutor(args.train_workers)
+        times = await rounds(args.rounds, lambda: asyncio.gather(*(loop.run_in_executor(executor, lambda m=m, ds=ds: m.fit(ds, epochs=1, verbose=0))
+                                                                   for m, ds in zip(models, datasets))))
+        report(f'threads ({args.train_workers} concurrent)', args.clients, times)
+
+        pool = TrainingPool(args.workers, data_dir)
+        # Worker start-up (TensorFlow import) happens while the clients join in script.py
+        await asyncio.gather(*map(asyncio.wrap_future, pool.start()))
+        models = build(args.clients)
+        shards = [(i % args.num_shards, args.num_shards, 'iid', 0.5, 0.0) for i in range(args.clients)]
+        times = await rounds(args.rounds, lambda: asyncio.gather(*(pool.train(i, m, shard, args.batch_size)
+                                                                   for i, (m, shard) in enumerate(zip(models, shards)))))
+        report(f'pool ({args.workers} workers)', args.clients, times)
+        print(pool.report())
+        pool.close()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,211 @@
+# End-to-end federated rounds without Ganache or an IPFS daemon: manager.py and
+# script.py run unchanged as subprocesses against an in-process EVM (eth-tester,
+# running the compiled federated.sol) and the in-memory IPFS stub. Sweeps model,
+# client count and weight format, and writes round latency, throughput and memory
+# per configuration to a JSON file that can be compared with a run on another commit.
+# Run from emulator/: python -m benchmarks.round [--models cnn,resnet18 --clients 2,8
+#                     --formats binary,json --rounds 3] [--baseline round-<commit>.json]
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from web3 import Web3
+from benchmarks.stub_evm import StubEVM, load_contract
+from benchmarks.stub_ipfs import start_stub_ipfs
+from trace_report import load_spans
+from utils.ml import ENGINES
+
+EMULATOR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def model_json(name):
+    if name == 'cnn':
+        with open(os.path.join(EMULATOR_DIR, 'cnn_model.json')) as f:
+            return f.read()
+    if name == 'resnet18':
+        from models import build_resnet18
+        return build_resnet18(input_shape=(28, 28, 1), num_classes=10).to_json()
+    raise ValueError(f'Unknown model: {name}')
+
+def make_workdir(root, chain, contract, n_clients, arch):
+    os.makedirs(os.path.join(root, 'cfg'))
+    os.makedirs(os.path.join(root, 'res'))
+    accounts = chain.accounts
+    lines = ['[global]', f'HTTP_PROVIDER={chain.url}', f'CONTRACT_ADDRESS={contract.address}',
+             '[manager]', f'ACCOUNT_ADDRESS={accounts[0][0]}', f'PRIVATE_KEY={accounts[0][1]}']
+    for i in range(n_clients):
+        lines += [f'[{i}]', f'ACCOUNT_ADDRESS={accounts[i + 1][0]}', f'PRIVATE_KEY={accounts[i + 1][1]}']
+    with open(os.path.join(root, 'cfg', 'all.cfg'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    with open(os.path.join(root, 'EncFederatedLearningContract.json'), 'w') as f:
+        json.dump({'abi': contract.abi}, f)
+    with open(os.path.join(root, 'arch.json'), 'w') as f:
+        f.write(arch)
+
+def launch(cmd, workdir, env, name):
+    out = open(os.path.join(workdir, f'{name}.out'), 'w')
+    return subprocess.Popen([sys.executable, '-u', *cmd], cwd=workdir, env=env, stdout=out, stderr=subprocess.STDOUT)
+
+def wait(proc, deadline):
+    # Exit code and peak RSS (bytes) of a child; os.wait4 reports the child's own rusage
+    while True:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            return proc.returncode, rusage.ru_maxrss * 1024
+        if time.time() > deadline:
+            proc.kill()
+        time.sleep(0.1)
+
+def tail(path, n=20):
+    with open(path) as f:
+        return ''.join(f.readlines()[-n:])
+
+def round_times(chain, contract):
+    # Wall time of every on-chain step, by contract function: a round starts with the
+    # transaction emitting GlobalModelUpdated (create, whetherContinue(true)) and
+    # ends with updateGlobalModel
+    steps = []
+    for accepted, tx_hash in chain.transactions:
+        tx = chain.w3.eth.get_transaction(tx_hash)
+        if tx['to'] != contract.address:
+            continue
+        fn, args = contract.decode_function_input(tx['input'])
+        steps.append((accepted, fn.fn_name, args))
+    starts = [t for t, name, args in steps if name == 'create' or (name == 'whetherContinue' and args['flag'])]
+    ends = [t for t, name, _ in steps if name == 'updateGlobalModel']
+    uploads = sum(name == 'local_upload' for _, name, _ in steps)
+    return [end - start for start, end in zip(starts, ends)], starts, ends, uploads
+
+def phase_medians(spans):
+    by_phase = {}
+    for span in spans:
+        name = f"{span['parent']}/{span['phase']}" if span.get('parent') else span['phase']
+        by_phase.setdefault(name, []).append(span['wall'])
+    return {name: statistics.median(walls) for name, walls in sorted(by_phase.items())}
+
+def run_config(model, n_clients, fmt, args, abi, bytecode):
+    chain = StubEVM(num_accounts=n_clients + 1)
+    ipfs = start_stub_ipfs()
+    contract = chain.deploy(abi, bytecode)
+    env = {**os.environ, 'PY_IPFS_HTTP_CLIENT_DEFAULT_ADDR': f'/ip4/127.0.0.1/tcp/{ipfs.server_address[1]}/http',
+           'TF_CPP_MIN_LOG_LEVEL': '2'}
+    result = {'model': model, 'clients': n_clients, 'weight_format': fmt, 'rounds': args.rounds, 'engine': args.engine}
+    with tempfile.TemporaryDirectory() as workdir:
+        make_workdir(workdir, chain, contract, n_clients, model_json(model))
+        deadline = time.time() + args.timeout
+        manager = launch([os.path.join(EMULATOR_DIR, 'manager.py'), '--arch', 'arch.json', '--rounds', str(args.rounds)],
+                         workdir, env, 'manager')
+        # The project exists (ID 0 on the fresh chain) once the manager's create is mined
+        counter = Web3(Web3.HTTPProvider(chain.url)).eth.contract(address=contract.address, abi=abi).functions.projectIdCounter()
+        while counter.call() == 0:
+            if manager.poll() is not None or time.time() > deadline:
+                manager.kill()
+                raise RuntimeError(f'manager.py did not create the project:\n{tail(os.path.join(workdir, "manager.out"))}')
+            time.sleep(0.1)
+        clients = launch([os.path.join(EMULATOR_DIR, 'script.py'), '--clients', f'0-{n_clients - 1}', '--projectID', '0',
+                          '--rounds', str(args.rounds), '--weight_format', fmt, '--num_shards', str(args.num_shards),
+                          '--train_workers', str(args.train_workers), '--engine', args.engine, '--eval_every', '0',
+                          '--data_dir', os.path.abspath(args.data_dir)], workdir, env, 'clients')
+        client_status, client_rss = wait(clients, deadline)
+        manager_status, manager_rss = wait(manager, deadline)
+        if client_status or manager_status:
+            raise RuntimeError(f'clients exited with {client_status}, manager with {manager_status}:\n'
+                               f'{tail(os.path.join(workdir, "clients.out"))}{tail(os.path.join(workdir, "manager.out"))}')
+        spans = load_spans([os.path.join(workdir, 'res', f'{i}.trace.jsonl') for i in range(n_clients)])
+
+    latencies, starts, ends, uploads = round_times(chain, contract)
+    chain.close()
+    ipfs.shutdown()
+    elapsed = ends[-1] - starts[0]
+    uploaded = sum(s['bytes'] for s in spans if s['phase'] == 'upload' and not s.get('parent'))
+    result.update({
+        'round_latency_s': latencies,
+        # The first round includes the clients' cold start (imports, dataset, model)
+        'first_round_s': latencies[0],
+        'round_p50_s': float(np.median(latencies[1:] or latencies)),
+        'round_max_s': max(latencies[1:] or latencies),
+        'rounds_per_s': len(ends) / elapsed,
+        'updates_per_s': uploads / elapsed,
+        'upload_bytes_per_update': uploaded / max(uploads, 1),
+        'client_peak_rss': client_rss,
+        'manager_peak_rss': manager_rss,
+        # Client time from joining to local_upload, without the first round
+        'critical_path_p50_s': statistics.median([s['wall'] for s in spans if s['phase'] == 'round' and s['round']] or [0]),
+        'phase_p50_s': phase_medians(spans),
+    })
+    return result
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=EMULATOR_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=EMULATOR_DIR,
+                                    capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    key = lambda r: (r['model'], r['clients'], r['weight_format'])
+    old = {key(r): r for r in baseline['results'] if 'error' not in r}
+    print(f"\nagainst {baseline_path} ({(baseline.get('commit') or '?')[:10]}):")
+    for r in results:
+        before = old.get(key(r))
+        if before is None or 'error' in r:
+            continue
+        changes = [f"{metric} {before[metric]:.4g} -> {r[metric]:.4g} ({(r[metric] / before[metric] - 1) * 100:+.1f}%)"
+                   for metric in ('round_p50_s', 'critical_path_p50_s', 'updates_per_s', 'client_peak_rss') if before.get(metric)]
+        print(f'{"/".join(map(str, key(r))):<24} ' + ', '.join(changes))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', type=str, default='cnn,resnet18', help='Comma-separated models: cnn, resnet18')
+    parser.add_argument('--clients', type=str, default='2,8', help='Comma-separated client counts')
+    parser.add_argument('--formats', type=str, default='binary,json', help='Comma-separated weight formats')
+    parser.add_argument('--rounds', type=int, default=3, help='Rounds per configuration')
+    parser.add_argument('--num_shards', type=int, default=60, help='Training set shards, each client trains on one (60: 1000 samples)')
+    parser.add_argument('--train_workers', type=int, default=1, help='Clients training concurrently')
+    parser.add_argument('--engine', type=str, default='fit', choices=ENGINES, help='Local training engine of the clients (script.py --engine)')
+    parser.add_argument('--data_dir', type=str, default='./data', help='Dataset directory shared by every run')
+    parser.add_argument('--artifact', type=str, default=None, help='Hardhat artifact of the contract (default: hardhat/artifacts, else compile with solc)')
+    parser.add_argument('--timeout', type=float, default=1800, help='Seconds before a configuration is aborted')
+    parser.add_argument('--out', type=str, default=None, help='Result file (default: round-<commit>.json)')
+    parser.add_argument('--baseline', type=str, default=None, help='Result file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    abi, bytecode = load_contract(args.artifact)
+    commit, dirty = git_commit()
+    results = []
+    for model in args.models.split(','):
+        for n_clients in map(int, args.clients.split(',')):
+            for fmt in args.formats.split(','):
+                print(f'{model}, {n_clients} clients, {fmt} weights...', flush=True)
+                try:
+                    result = run_config(model, n_clients, fmt, args, abi, bytecode)
+                    print(f"  round p50 {result['round_p50_s']:.2f} s (first {result['first_round_s']:.2f} s), "
+                          f"{result['updates_per_s']:.2f} updates/s, {result['upload_bytes_per_update'] / 2**20:.2f} MiB/update, "
+                          f"client peak RSS {result['client_peak_rss'] / 2**20:.0f} MiB")
+                except Exception as e:
+                    result = {'model': model, 'clients': n_clients, 'weight_format': fmt, 'rounds': args.rounds, 'error': str(e)}
+                    print(f'  failed: {e}')
+                results.append(result)
+
+    report = {'commit': commit, 'dirty': dirty, 'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+              'args': vars(args), 'results': results}
+    out = args.out or f'round-{(commit or "unknown")[:10]}.json'
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {out}')
+    if args.baseline:
+        compare(results, args.baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# Cold start of one client: wall time from launching `python script.py` until it
+# prints "Connected to Ethereum node", against a stub JSON-RPC endpoint and a
+# scratch working directory (cfg, ABI placeholder, res/).
+# Run from emulator/: python -m benchmarks.startup [--runs 5]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RPC_RESULTS = {'web3_clientVersion': 'stub', 'eth_chainId': '0x539', 'net_version': '1337', 'eth_blockNumber': '0x0'}
+
+class StubRPCHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        body = json.dumps({'jsonrpc': '2.0', 'id': request.get('id'),
+                           'result': RPC_RESULTS.get(request.get('method'))}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def make_workdir(root, rpc_url):
+    os.makedirs(os.path.join(root, 'cfg'))
+    os.makedirs(os.path.join(root, 'res'))
+    with open(os.path.join(root, 'cfg', 'all.cfg'), 'w') as f:
+        f.write(f'[global]\nHTTP_PROVIDER={rpc_url}\nCONTRACT_ADDRESS=0x269b67838C6c63bE752c4Aa71682D481817Bec45\n'
+                '[0]\nACCOUNT_ADDRESS=0x0000000000000000000000000000000000000000\nPRIVATE_KEY=0x00\n')
+    with open(os.path.join(root, 'EncFederatedLearningContract.json'), 'w') as f:
+        json.dump({'abi': []}, f)
+
+def time_to_connect(script, workdir, marker='Connected to Ethereum node'):
+    start_time = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, '-u', script, '--id', '0'], cwd=workdir,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        for line in proc.stdout:
+            if marker in line:
+                return time.perf_counter() - start_time
+        raise RuntimeError(f'{script} exited with {proc.wait()} before printing "{marker}"')
+    finally:
+        proc.kill()
+        proc.wait()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help='Client launches to time')
+    parser.add_argument('--script', type=str, default=os.path.abspath('script.py'), help='Client script to launch')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubRPCHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with tempfile.TemporaryDirectory() as workdir:
+        make_workdir(workdir, f'http://127.0.0.1:{server.server_address[1]}')
+        times = [time_to_connect(args.script, workdir) for _ in range(args.runs)]
+    server.shutdown()
+    print(f'time to "Connected to Ethereum node" over {args.runs} runs: '
+          f'first {times[0]:.3f} s, median {statistics.median(times):.3f} s, min {min(times):.3f} s')
+
+if __name__ == '__main__':
+    main()
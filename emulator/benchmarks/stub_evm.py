@@ -0,0 +1,103 @@
+# In-process stand-in for the Ethereum node: the py-evm backend of eth-tester served
+# over HTTP JSON-RPC, so script.py and manager.py talk to it through their usual
+# Web3.HTTPProvider. Every transaction is mined on arrival; the wall time at which it
+# was accepted is kept so benchmarks can time on-chain steps. Requests are served one
+# at a time because the EVM backend is not thread-safe.
+import glob
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from web3 import Web3, EthereumTesterProvider
+from web3.providers.eth_tester.middleware import request_formatters, result_formatters
+
+CONTRACT_NAME = 'EncFederatedLearningContract'
+CONTRACT_SOURCE = os.path.join(os.path.dirname(__file__), '..', '..', 'hardhat', 'contracts', 'federated.sol')
+HARDHAT_ARTIFACTS = os.path.join(os.path.dirname(__file__), '..', '..', 'hardhat', 'artifacts')
+SOLC_VERSION = '0.8.28'
+
+def load_contract(artifact=None):
+    # ABI and deployment bytecode of the FL contract: a hardhat artifact
+    # (`npx hardhat compile`) when there is one, otherwise compiled with solc
+    if artifact is None:
+        found = glob.glob(os.path.join(HARDHAT_ARTIFACTS, 'contracts', '*', f'{CONTRACT_NAME}.json'))
+        artifact = found[0] if found else None
+    if artifact is not None:
+        with open(artifact) as f:
+            data = json.load(f)
+        return data['abi'], data['bytecode']
+    import solcx
+    if SOLC_VERSION not in map(str, solcx.get_installed_solc_versions()):
+        solcx.install_solc(SOLC_VERSION)
+    compiled = solcx.compile_files([CONTRACT_SOURCE], output_values=['abi', 'bin'], solc_version=SOLC_VERSION)
+    contract = next(c for name, c in compiled.items() if name.endswith(f':{CONTRACT_NAME}'))
+    return contract['abi'], '0x' + contract['bin']
+
+class StubEVM:
+    def __init__(self, num_accounts=10, port=0):
+        from eth_tester import EthereumTester, PyEVMBackend
+        self.backend = PyEVMBackend(genesis_state=PyEVMBackend.generate_genesis_state(num_accounts=num_accounts))
+        self.provider = EthereumTesterProvider(EthereumTester(self.backend))
+        self.w3 = Web3(self.provider)
+        # (accept time, transaction hash) of every transaction, in mining order
+        self.transactions = []
+        self._lock = threading.Lock()
+        handler = type('Handler', (_RPCHandler,), {'chain': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    @property
+    def accounts(self):
+        # (address, private key hex) of the pre-funded accounts
+        return [(key.public_key.to_checksum_address(), key.to_hex()) for key in self.backend.account_keys]
+
+    def request(self, request):
+        # The same parameter and result conversions web3 applies in front of eth-tester
+        method, params = request['method'], request.get('params', [])
+        try:
+            params = request_formatters.get(method, lambda p: p)(params)
+            with self._lock:
+                response = self.provider.make_request(method, params)
+                if method == 'eth_sendRawTransaction' and 'result' in response:
+                    self.transactions.append((time.time(), response['result']))
+        except Exception as e:
+            response = {'error': {'code': -32000, 'message': f'{type(e).__name__}: {e}'}}
+        if 'result' in response and method in result_formatters:
+            response['result'] = result_formatters[method](response['result'])
+        return {'jsonrpc': '2.0', 'id': request.get('id'), **{k: v for k, v in response.items() if k in ('result', 'error')}}
+
+    def deploy(self, abi, bytecode):
+        with self._lock:
+            contract = self.w3.eth.contract(abi=abi, bytecode=bytecode)
+            tx_hash = contract.constructor().transact({'from': self.w3.eth.accounts[0]})
+            address = self.w3.eth.get_transaction_receipt(tx_hash)['contractAddress']
+        return self.w3.eth.contract(address=address, abi=abi)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class _RPCHandler(BaseHTTPRequestHandler):
+    chain = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        if isinstance(request, list):
+            response = [self.chain.request(r) for r in request]
+        else:
+            response = self.chain.request(request)
+        body = Web3.to_json(response).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
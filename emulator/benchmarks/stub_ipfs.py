@@ -0,0 +1,89 @@
+# In-process stand-in for the IPFS daemon HTTP API: /api/v0/version, /add and /cat
+# backed by an in-memory block store. Speaks HTTP/1.1 keep-alive and accepts the
+# chunked multipart uploads produced by ipfshttpclient. Optionally adds a
+# per-request latency and caps the bandwidth of each response, and counts the bytes
+# added and served (server.stats).
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+class StubIPFSHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    store = None
+    stats = None
+    latency = 0.0
+    bandwidth = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _count(self, name, n):
+        with self.stats['lock']:
+            self.stats[name] += n
+
+    def _send(self, body, content_type='application/json'):
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not self.bandwidth:
+            self.wfile.write(body)
+            return
+        step = 1 << 16
+        for pos in range(0, len(body), step):
+            self.wfile.write(body[pos:pos + step])
+            time.sleep(len(body[pos:pos + step]) / self.bandwidth)
+
+    def _add(self, body):
+        boundary = self.headers['Content-Type'].split('boundary=')[1].strip('"').encode()
+        part = body.split(b'--' + boundary)[1]
+        data = part.split(b'\r\n\r\n', 1)[1][:-2]
+        cid = 'Qm' + hashlib.sha256(data).hexdigest()[:44]
+        self.store[cid] = data
+        self._count('added', len(data))
+        return {'Name': cid, 'Hash': cid, 'Size': str(len(data))}
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self._read_body()
+        endpoint = url.path.rsplit('/', 1)[-1]
+        if endpoint == 'version':
+            self._send(json.dumps({'Version': '0.7.0'}).encode())
+        elif endpoint == 'add':
+            self._send(json.dumps(self._add(body)).encode())
+        elif endpoint == 'cat':
+            cid = parse_qs(url.query)['arg'][0]
+            if cid not in self.store:
+                self.send_error(500, 'block not found')
+            else:
+                self._count('served', len(self.store[cid]))
+                self._send(self.store[cid], 'text/plain')
+        else:
+            self.send_error(404)
+
+def start_stub_ipfs(port=0, latency=0.0, bandwidth=0):
+    # latency in seconds per request, bandwidth in bytes/s per response (0: unlimited)
+    stats = {'added': 0, 'served': 0, 'lock': threading.Lock()}
+    handler = type('Handler', (StubIPFSHandler,), {'store': {}, 'stats': stats, 'latency': latency, 'bandwidth': bandwidth})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.stats = stats
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,82 @@
+# Local training throughput of one client round: Keras fit against the compiled
+# engine (utils.ml.TrainingEngine) with and without XLA, under mixed precision and
+# with the autotuned batch size, on a random MNIST-shaped shard. Models are loaded from
+# their JSON architecture, as clients load them from IPFS. Reports samples/s of the
+# first round, which includes tracing and compilation, and the median of the rest.
+# Run from emulator/: python -m benchmarks.training [--models cnn,resnet18 --samples 6000 --rounds 4]
+import argparse
+import os
+import statistics
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+from models import build_resnet18, create_custom_cnn
+from utils.ml import make_indexed_dataset, model_from_json, set_precision, autotune_batch_size, TrainingEngine
+
+# label: engine, XLA, precision, batch size (None: autotuned)
+CONFIGS = {
+    'fit': ('fit', False, 'float32', 512),
+    'compiled': ('compiled', False, 'float32', 512),
+    'compiled+xla': ('compiled', True, 'float32', 512),
+    'compiled bf16': ('compiled', False, 'mixed_bfloat16', 512),
+    'compiled fp16': ('compiled', False, 'mixed_float16', 512),
+    'compiled autotune': ('compiled', False, 'float32', None),
+}
+
+def architecture(name):
+    # JSON of the float32 model, as the manager uploads it
+    if name == 'cnn':
+        return create_custom_cnn().to_json()
+    return build_resnet18(input_shape=(28, 28, 1), num_classes=10).to_json()
+
+def run(arch, config, x, y, rounds, cache_path):
+    engine_name, jit_compile, precision, batch_size = config
+    set_precision(precision)
+    try:
+        model = model_from_json(arch)
+        model.compile(optimizer='adam', loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+        if batch_size is None:
+            batch_size = autotune_batch_size(model, jit_compile, cache_path)
+        ds = make_indexed_dataset(x, y, None, batch_size, shuffle=True, seed=0)
+        engine = TrainingEngine(model, jit_compile) if engine_name == 'compiled' else None
+        rates = []
+        for _ in range(rounds):
+            start_time = time.perf_counter()
+            if engine is not None:
+                engine.train(ds)
+            else:
+                model.fit(ds, epochs=1, verbose=0)
+            rates.append(len(x) / (time.perf_counter() - start_time))
+        return batch_size, rates
+    finally:
+        set_precision('float32')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', type=str, default='cnn,resnet18')
+    parser.add_argument('--configs', type=str, default=','.join(c for c in CONFIGS if c != 'compiled fp16'),
+                        help=f'Comma-separated subset of: {", ".join(CONFIGS)} (float16 is emulated, and slow, on most CPUs)')
+    parser.add_argument('--samples', type=int, default=6000, help='Shard size, i.e. samples per round')
+    parser.add_argument('--rounds', type=int, default=4)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    x = rng.random((args.samples, 28, 28, 1), dtype=np.float32)
+    y = rng.integers(0, 10, args.samples)
+    print(f'{args.samples} samples per round, {args.rounds} rounds, {os.cpu_count()} CPUs, TensorFlow {tf.__version__}')
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache_path = os.path.join(cache_dir, 'batch_size.json')
+        for name in args.models.split(','):
+            print(f'{name}:')
+            arch = architecture(name)
+            baseline = None
+            for label in args.configs.split(','):
+                batch_size, rates = run(arch, CONFIGS[label], x, y, args.rounds, cache_path)
+                steady = statistics.median(rates[1:] or rates)
+                baseline = baseline or steady
+                print(f'  {label:<18} batch {batch_size:>4} | first round {rates[0]:7.0f} samples/s | '
+                      f'then {steady:7.0f} samples/s ({steady / baseline:5.2f}x)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+# Compare the legacy JSON weight payload against the binary container.
+# Run from emulator/: python -m benchmarks.weight_format [--repeat 5]
+import argparse
+import os
+import time
+from utils.crypto import encrypt, decrypt_bytes
+from utils.weights import serialize_weights, decode_weights
+from models import build_resnet18, create_custom_cnn
+
+def best_of(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start_time)
+    return best, result
+
+def bench_model(name, model, aesKey, repeat):
+    print(f'{name}: {model.count_params()} parameters')
+    for fmt in ('json', 'binary'):
+        encode_time, payload = best_of(lambda: serialize_weights(model, fmt), repeat)
+        decode_time, _ = best_of(lambda: decode_weights(payload), repeat)
+        enc_time, ciphertext = best_of(lambda: encrypt(payload, aesKey), repeat)
+        dec_time, _ = best_of(lambda: decode_weights(decrypt_bytes(ciphertext, aesKey)), repeat)
+        print(f'  {fmt:>6}: payload {len(payload) / 2**20:8.2f} MiB, ciphertext {len(ciphertext) / 2**20:8.2f} MiB | '
+              f'encode {encode_time * 1e3:9.1f} ms, decode {decode_time * 1e3:9.1f} ms | '
+              f'encode+encrypt {(encode_time + enc_time) * 1e3:9.1f} ms, decrypt+decode {dec_time * 1e3:9.1f} ms')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3, help='Repetitions per measurement (best is reported)')
+    args = parser.parse_args()
+    aesKey = os.urandom(32)
+    bench_model('CNN', create_custom_cnn(), aesKey, args.repeat)
+    bench_model('ResNet-18', build_resnet18(input_shape=(32, 32, 3), num_classes=10), aesKey, args.repeat)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+from utils.ml import load_mnist_memmap, make_indexed_dataset, evaluate_model
+from utils.crypto import generate_key
+from utils.keydist import KeyDistributor
+from utils.session import KEY_SCHEMES
+from utils.aggregate import StreamingRound, ACCUMULATORS
+from utils.events import EventDispatcher
+from utils.tx import TransactionManager
+from utils.compression import decode_update, update_samples
+from utils.ipfs import (enc_upload_weight_to_ipfs, enc_upload_manifest_to_ipfs, enc_upload_model_to_ipfs, fetch_decrypted_payload, assign_weights,
+                        configure_pool, CIPHER_SCHEMES, WEIGHT_STORAGE)
+from utils.lazy import lazy_import
+from script import create_logger
+import numpy as np
+from web3 import Web3
+import argparse
+import asyncio
+import configparser
+import json
+import os
+import time
+
+# Imported on first use, so the key derivation workers (which re-import this module) stay light
+tf = lazy_import('tensorflow')
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--arch', type=str, default='./cnn_model.json', help='Keras model architecture JSON')
+    parser.add_argument('--fee', type=int, default=10, help='One time fee of the project')
+    parser.add_argument('--rounds', type=int, default=10, help='Global rounds before the project is closed')
+    parser.add_argument('--fetch_workers', type=int, default=8, help='Client uploads downloaded and decrypted concurrently')
+    parser.add_argument('--quorum', type=int, default=0, help='Close a round once this many updates are aggregated (0: wait for every trainer)')
+    parser.add_argument('--deadline', type=float, default=0, help='Close a round this many seconds after it opened if at least one update is aggregated (0: no deadline)')
+    parser.add_argument('--accumulator', type=str, default='float64', choices=ACCUMULATORS, help='Precision of the running weighted sum')
+    parser.add_argument('--key_workers', type=int, default=min(4, os.cpu_count() or 1), help='Processes deriving ECDH secrets for large batches of joining clients (1: derive in a thread)')
+    parser.add_argument('--key_scheme', type=str, default='hkdf-v1', choices=KEY_SCHEMES, help='Derivation of the round key wrapping and upload keys from the ECDH secrets (raw for frontend clients that predate hkdf-v1)')
+    parser.add_argument('--cipher', type=str, default='aead', choices=CIPHER_SCHEMES, help='Encryption of the uploaded architecture and global weights')
+    parser.add_argument('--weight_storage', type=str, default='blob', choices=WEIGHT_STORAGE, help='Store global weights as one payload, or as a manifest of per-layer chunks fetched in parallel (Python clients only)')
+    parser.add_argument('--ipfs_pool_size', type=int, default=8, help='Persistent IPFS API connections kept by this process')
+    parser.add_argument('--evaluate', action='store_true', help='Evaluate every new global model on the MNIST test set')
+    return parser.parse_args()
+
+class Manager:
+    def __init__(self, args, config, logger):
+        self.args = args
+        self.logger = logger
+        with open('./EncFederatedLearningContract.json', 'r') as json_file:
+            contract_abi = json.load(json_file)['abi']
+        self.config = config
+        self.w3 = Web3(Web3.HTTPProvider(config['global']['HTTP_PROVIDER']))
+        self.contract = self.w3.eth.contract(address=config['global']['CONTRACT_ADDRESS'], abi=contract_abi)
+        self.address = config['manager']['ACCOUNT_ADDRESS']
+        self.tx_manager = TransactionManager(self.w3, self.address, config['manager']['PRIVATE_KEY'], logger=logger)
+
+        ecdh_private_key_hex_str, self.ecdh_public_key_hex_str = generate_key()
+        self.keys = KeyDistributor(ecdh_private_key_hex_str, self.ecdh_public_key_hex_str, args.key_workers,
+                                   scheme=args.key_scheme)
+        self.client_pks = {}
+        self.pending_keys = []
+        self.aesKey = os.urandom(32)
+        self.projectID = None
+        self.iteration = None
+        self.weights_ipfs_hash = None
+        # Chunks of the last stored manifest by digest, reused when unchanged
+        self.chunks = None
+        self.round = None
+
+        with open(args.arch, 'r') as json_file:
+            self.model = tf.keras.models.model_from_json(json_file.read())
+        self.model.compile(optimizer='adam', loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+        self.test_set = make_indexed_dataset(*load_mnist_memmap()[1]) if args.evaluate else None
+
+    def call(self, fn):
+        return asyncio.to_thread(fn.call, {'from': self.address})
+
+    async def upload_weights(self):
+        if self.args.weight_storage == 'manifest':
+            weights_ipfs_hash, self.chunks = await asyncio.to_thread(enc_upload_manifest_to_ipfs, self.model, self.aesKey,
+                                                                     self.args.cipher, self.chunks)
+            return weights_ipfs_hash
+        return await asyncio.to_thread(enc_upload_weight_to_ipfs, self.model, self.aesKey, 'binary', self.args.cipher)
+
+    async def create_project(self):
+        arch_ipfs_hash = await asyncio.to_thread(enc_upload_model_to_ipfs, self.model, self.aesKey, self.args.cipher)
+        self.weights_ipfs_hash = await self.upload_weights()
+        receipt = await (await self.tx_manager.send(self.contract.functions.create(
+            arch_ipfs_hash, self.weights_ipfs_hash, self.args.fee, self.ecdh_public_key_hex_str)))
+        if receipt['status'] != 1:
+            raise RuntimeError('Creating the project failed.')
+        self.projectID = await self.call(self.contract.functions.createReturn())
+        self.iteration = 1
+        print(f'Project created, project ID is: {self.projectID}')
+        return self.projectID
+
+    def handle_achieve_key(self, event):
+        # AchieveKey logs delivered by one poll are answered as one batch, once they
+        # have all been routed
+        self.pending_keys.append(event)
+        if len(self.pending_keys) == 1:
+            asyncio.create_task(self.distribute_keys())
+
+    async def distribute_keys(self):
+        events, self.pending_keys = self.pending_keys, []
+        start_time = time.time()
+        clients = [(event['args']['clientAddress'], event['args']['clientPK']) for event in events]
+        encryptedKeys = await self.keys.wrap(self.aesKey, [clientPK for _, clientPK in clients], self.projectID,
+                                             [(event['args']['clientAddress'], event['args']['iteration']) for event in events])
+        # Nonces are reserved and signed for the whole batch, then sent back to back
+        prepared = []
+        for (clientAddress, clientPK), encryptedKey in zip(clients, encryptedKeys):
+            if encryptedKey is None:
+                self.logger.warning(f"Ignoring join of {clientAddress} with invalid public key {clientPK}")
+                continue
+            self.client_pks[clientAddress] = clientPK
+            prepared.append(await self.tx_manager.prepare(
+                self.contract.functions.updateEncryptedKey(self.projectID, clientAddress, encryptedKey)))
+        for tx in prepared:
+            await self.tx_manager.submit(tx)
+        self.logger.info(f"Encrypt key time for {len(prepared)} clients: {time.time() - start_time}")
+
+    def open_round(self):
+        # Compressed (delta) updates are rebuilt against the global model of this round
+        base, base_cid, iteration = self.model.get_weights(), self.weights_ipfs_hash, self.iteration
+        def fetch(ipfs_hash, clientAddress):
+            upload_key = self.keys.session_keys(self.client_pks[clientAddress], self.projectID, clientAddress, iteration).upload
+            payload = fetch_decrypted_payload(ipfs_hash, upload_key)
+            weights = decode_update(payload, base, base_cid)
+            # Updates are weighted by the client's training samples. Legacy JSON updates
+            # carry flat tensors and no sample count, and all weigh the same
+            n_samples = update_samples(payload)
+            if n_samples is None:
+                self.logger.warning(f'Update of {clientAddress} has no sample count, weighting it as one sample.')
+                n_samples = 1
+            return [np.reshape(w, b.shape) for w, b in zip(weights, base)], n_samples
+        self.round = StreamingRound(fetch, self.args.quorum, self.args.deadline, self.args.fetch_workers,
+                                    self.args.accumulator, self.logger)
+
+    def handle_upload(self, event):
+        # Each update is fetched and folded into the running sum as soon as its CID is
+        # on chain, while other clients are still training
+        if event['args']['iteration'] == self.iteration:
+            self.round.submit(event['args']['clientAddress'], event['args']['modelAddress'], event['args']['clientAddress'])
+
+    def handle_training_finished(self, event):
+        if event['args']['iteration'] == self.iteration:
+            self.round.mark_complete()
+
+    async def aggregate(self):
+        current = self.round
+        reason = await current.wait()
+        start_time_1 = time.time()
+        if reason != 'all':
+            # Stragglers' uploads revert from here on
+            await (await self.tx_manager.send(self.contract.functions.closeRound(self.projectID)))
+        client_addresses = await self.call(self.contract.functions.getTrainers(self.projectID))
+        self.logger.info(f"Close round and get trainers from blockchain time: {time.time() - start_time_1}")
+
+        self.logger.info(f"Round {self.iteration} closed on {reason} with {current.fedavg.count} of {len(client_addresses)} "
+                         f"updates ({len(current.failed)} failed, {len(current.dropped)} dropped) after {current.closed - current.opened}")
+        if current.fedavg.count:
+            # The average is already accumulated, so only the division is left after the last update
+            start_time_2 = time.time()
+            assign_weights(self.model, current.result())
+            self.logger.info(f"Aggregation latency after last update: {time.time() - start_time_2 + (current.closed - current.last_fold)}")
+        else:
+            self.logger.warning(f"No update of round {self.iteration} could be fetched, keeping the global model.")
+
+        if self.test_set is not None:
+            evaluate_model(self.model, self.test_set)
+
+        # Dynamic key: every round's global weights get a fresh AES key
+        start_time_3 = time.time()
+        self.aesKey = os.urandom(32)
+        weights_ipfs_hash = await self.upload_weights()
+        self.weights_ipfs_hash = weights_ipfs_hash
+        self.logger.info(f"Encrypt and store new global model weights on IPFS time: {time.time() - start_time_3}")
+
+        start_time_4 = time.time()
+        # Only clients whose update made it into the average are paid
+        folded = set(current.folded)
+        incentiveFees = [1 if address in folded else 0 for address in client_addresses]
+        await (await self.tx_manager.send(self.contract.functions.updateGlobalModel(self.projectID, weights_ipfs_hash, incentiveFees)))
+        self.iteration += 1
+        self.logger.info(f"Update global model on blockchain time: {time.time() - start_time_4}")
+        print('New global model weights IPFS hash:', weights_ipfs_hash)
+
+    async def settle(self):
+        await (await self.tx_manager.send(self.contract.functions.whetherContinue(self.projectID, False)))
+        totalBilling = await self.call(self.contract.functions.billingsReturn(self.projectID))
+        print('Billing is ', totalBilling)
+        await (await self.tx_manager.send(self.contract.functions.settleBillings(self.projectID), self.w3.to_wei(0.1 * totalBilling, 'ether')))
+
+    async def run(self):
+        self.keys.start()
+        await self.create_project()
+        self.open_round()
+        dispatcher = EventDispatcher(self.w3, self.contract, [self.projectID],
+                                     event_names=('AchieveKey', 'LocalModelUploaded', 'LocalTrainingFinished'),
+                                     ws_url=self.config['global'].get('WS_PROVIDER'), logger=self.logger)
+        dispatcher.listen('AchieveKey', self.handle_achieve_key)
+        dispatcher.listen('LocalModelUploaded', self.handle_upload)
+        dispatcher.listen('LocalTrainingFinished', self.handle_training_finished)
+        dispatcher.start()
+        print('Listening started. PID: ', self.projectID)
+
+        for niter in range(self.args.rounds):
+            await self.aggregate()
+            if niter + 1 < self.args.rounds:
+                self.open_round()
+                await (await self.tx_manager.send(self.contract.functions.whetherContinue(self.projectID, True)))
+        await self.settle()
+        await dispatcher.stop()
+        self.keys.close()
+        print('Training completed.')
+
+async def main():
+    args = parse_args()
+    logger = create_logger('manager')
+    configure_pool(args.ipfs_pool_size)
+    config = configparser.ConfigParser()
+    config.read('./cfg/all.cfg')
+    await Manager(args, config, logger).run()
+
+if __name__ == '__main__':
+    asyncio.run(main())
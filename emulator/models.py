@@ -66,16 +66,17 @@ def create_custom_cnn():
 
     return model
 
-# Create and save the models
-resnet18_model = build_resnet18(input_shape=(32, 32, 3), num_classes=10)
-custom_cnn_model = create_custom_cnn()
+if __name__ == '__main__':
+    # Create and save the models
+    resnet18_model = build_resnet18(input_shape=(32, 32, 3), num_classes=10)
+    custom_cnn_model = create_custom_cnn()
 
-resnet18_json = resnet18_model.to_json()
-# Write the JSON data to the file
-with open('resnet18_model.json', 'w') as json_file:
-    json_file.write(resnet18_json)
+    resnet18_json = resnet18_model.to_json()
+    # Write the JSON data to the file
+    with open('resnet18_model.json', 'w') as json_file:
+        json_file.write(resnet18_json)
 
-custom_cnn_json = custom_cnn_model.to_json()
-# Write the JSON data to the file
-with open('cnn_model.json', 'w') as json_file:
-    json_file.write(custom_cnn_json)
+    custom_cnn_json = custom_cnn_model.to_json()
+    # Write the JSON data to the file
+    with open('cnn_model.json', 'w') as json_file:
+        json_file.write(custom_cnn_json)
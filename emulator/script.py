@@ -1,18 +1,33 @@
 
-from utils.ml import load_mnist_dataset, train_model, evaluate_model
+from utils.ml import (load_mnist_memmap, load_client_datasets, split_client_shard, make_indexed_dataset, train_model, validate_model, evaluate_model,
+                      set_precision, autotune_batch_size, architecture_key, TrainingEngine, PARTITIONS, ENGINES, PRECISIONS)
 from utils.crypto import generate_key, load_private_key_from_hex, load_public_key_from_hex, encrypt, decrypt, load_private_key_from_pem, load_public_key_from_pem, achieve_shared_secret
-from utils.ipfs import enc_upload_weight_to_ipfs, dec_load_weight_from_ipfs, dec_load_model_from_ipfs, load_model_from_ipfs
+from utils.session import session_keys, key_scheme, unwrap_key
+from utils.cache import CIDCache
+from utils.events import EventDispatcher
+from utils.tx import TransactionManager
+from utils.reader import ContractReader
+from utils.batched import BatchedTraining, supports_batched
+from utils.workers import TrainingPool
+from utils.lazy import preload
+from utils.compression import UpdateEncoder, parse_compression
+from utils.weights import model_weight_names, serialize_weights
+from utils.trace import Tracer, add_phase, start_metrics_server
+from utils.ipfs import enc_upload_bytes_to_ipfs, fetch_decrypted_payload, assign_payload, dec_load_model_from_ipfs, load_model_from_ipfs, configure_pool, WEIGHT_FORMATS, CIPHER_SCHEMES
 import json
+import os
+import numpy as np
 from web3 import Web3
 import argparse
-import binascii
 import asyncio
+import contextlib
 import logging
-import time
 import configparser
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 def create_logger(ID):
-    logger = logging.getLogger("my_logger")
+    logger = logging.getLogger(f"client_{ID}")
     logger.setLevel(logging.DEBUG)
     log_filename = f"./res/{ID}.log"
     file_handler = logging.FileHandler(log_filename)
@@ -21,212 +36,412 @@ def create_logger(ID):
     logger.addHandler(file_handler)
     return logger
 
+def parse_id_range(text):
+    ids = []
+    for part in text.split(','):
+        start, _, end = part.partition('-')
+        ids.extend(range(int(start), int(end or start) + 1))
+    return ids
+
+def parse_batch_size(text):
+    return text if text == 'auto' else int(text)
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--id', type=int, default=0, help='Wallet ID')
+    parser.add_argument('--clients', type=parse_id_range, default=None, help='Run several wallet IDs in this process, e.g. 0-63 or 0,2,5-7 (overrides --id)')
+    parser.add_argument('--train_workers', type=int, default=1, help='Clients allowed to train concurrently in this process')
+    parser.add_argument('--num_shards', type=int, default=10, help='MNIST training set is split into this many shards, client ID i trains on shard i % num_shards')
+    parser.add_argument('--partition', type=str, default='iid', choices=PARTITIONS, help='How samples are assigned to shards')
+    parser.add_argument('--alpha', type=float, default=0.5, help='Dirichlet concentration of the non-IID partition (smaller is more skewed)')
+    parser.add_argument('--data_dir', type=str, default='./data', help='Directory of the normalised dataset memory-mapped by every client on this host')
+    parser.add_argument('--eval_every', type=int, default=1, help='Evaluate the local model every K rounds (0 disables evaluation)')
+    parser.add_argument('--eval_samples', type=int, default=0, help='Evaluate on a fixed random subset of this many test samples (0: full test set)')
+    parser.add_argument('--batch_size', type=parse_batch_size, default=512, help='Local training batch size, or auto for the fastest one of the architecture on this host (measured once, cached in --cache_dir)')
+    parser.add_argument('--validation_split', type=float, default=0.0, help='Fraction of the shard held out and validated on after every round (0: train on all of it)')
+    parser.add_argument('--engine', type=str, default='fit', choices=ENGINES, help='fit: Keras model.fit; compiled: a tf.function train step, XLA-compiled unless --no_jit; batched: all --clients of the process as one vectorised step (Sequential CNNs, others use fit); pool: fit in --pool_workers worker processes')
+    parser.add_argument('--pool_workers', type=int, default=0, help='Training processes of --engine pool, each pinned to its share of --pool_cpus (0: one per 4 CPUs)')
+    parser.add_argument('--pool_cpus', type=parse_id_range, default=None, help='CPUs the --engine pool workers run on, e.g. 0-15 (default: all this process may use)')
+    parser.add_argument('--batch_window', type=float, default=1.0, help='Seconds --engine batched waits for the other clients of the process before training those that are ready')
+    parser.add_argument('--no_jit', action='store_true', help='Compile the train step of --engine compiled without XLA')
+    parser.add_argument('--precision', type=str, default='float32', choices=PRECISIONS, help='Keras dtype policy; mixed_* computes in 16 bits, weights stay float32 (float16 is slow on most CPUs)')
+    parser.add_argument('--rounds', type=int, default=10, help='Rounds to train before leaving the project')
+    parser.add_argument('--key_timeout', type=float, default=300, help='Seconds to wait for the round key after joining before waiting for the next round instead')
     parser.add_argument('--projectID', type=int, default=0, help='Project ID')
     parser.add_argument('--contrac_address', type=str, default='0x269b67838C6c63bE752c4Aa71682D481817Bec45', help='Contract address')
+    parser.add_argument('--weight_format', type=str, default='binary', choices=WEIGHT_FORMATS, help='Wire format of uploaded weights (use json for the frontend manager)')
+    parser.add_argument('--cipher', type=str, default='aead', choices=CIPHER_SCHEMES, help='Encryption of uploaded weights (use ecb for the frontend manager)')
+    parser.add_argument('--compression', type=str, default=None, help='Update compression, e.g. delta,topk=0.01,int8 (default: COMPRESSION of the [project_<ID>] cfg section, else none)')
+    parser.add_argument('--cache_dir', type=str, default='./cache', help='Directory of the decrypted IPFS payload cache (shared by clients on this host)')
+    parser.add_argument('--cache_mb', type=int, default=1024, help='Size cap of the payload cache in MiB, 0 disables it')
+    parser.add_argument('--trace_dir', type=str, default='./res', help='Per-phase spans are appended to {trace_dir}/{ID}.trace.jsonl (empty disables)')
+    parser.add_argument('--metrics_port', type=int, default=0, help='Serve per-phase totals in Prometheus text format on this port (0 disables)')
+    parser.add_argument('--ipfs_pool_size', type=int, default=4, help='Persistent IPFS API connections kept by this process')
 
     return parser.parse_args()
 
-async def filter_GlobalModelUpdated(event_filter, poll_interval, projectID):
-    flag = False  # Initialize the flag
-    while not flag:  # Continue looping until flag becomes True
-        for event in event_filter.get_new_entries():
-            manager_address = event['args']['managerAddress']
-            project_id = event['args']['projectId']
-            iteration = event['args']['iteration']
-
-            if project_id == projectID:
-                print(f"Condition met: projectId={project_id}, iteration={iteration}")
-                flag = True  # Set flag to True to exit the loop
-                break  # Exit the for loop
-        await asyncio.sleep(poll_interval)
-    return
-
-async def filter_EncryptedKey(event_filter, poll_interval, projectID, wallet_address, sharedKey):
-    flag = False  # Initialize the flag
-    while not flag:  # Continue looping until flag becomes True
-        for event in event_filter.get_new_entries():
-            clientAddress = event['args']['clientAddress']
-            project_id = event['args']['projectId']
-            iteration = event['args']['iteration']
-            encryptedKey = event['args']['encryptedKey']
-
-            if project_id == projectID and clientAddress == wallet_address:
-                print(f"Condition met: projectId={project_id}, iteration={iteration}")
-                aesKeyStr = decrypt(encryptedKey, sharedKey)
-                print('Dynamic AES key is: ', aesKeyStr)
-                aesKey = binascii.unhexlify(aesKeyStr)
-                flag = True  # Set flag to True to exit the loop
-                break  # Exit the for loop
-        await asyncio.sleep(poll_interval)
-    return aesKey
+async def filter_GlobalModelUpdated(event_future):
+    # The iteration the published global model opens
+    event = await event_future
+    print(f"Condition met: projectId={event['args']['projectId']}, iteration={event['args']['iteration']}")
+    return event['args']['iteration']
 
-async def main():
+async def filter_EncryptedKey(key_future, sharedKey, projectID, wallet_address):
+    # The round key and this round's session keys, in the scheme the manager wrapped it with
+    event = await key_future
+    print(f"Condition met: projectId={event['args']['projectId']}, iteration={event['args']['iteration']}")
+    encryptedKey = event['args']['encryptedKey']
+    keys = session_keys.get(key_scheme(encryptedKey), sharedKey, projectID, wallet_address, event['args']['iteration'])
+    aesKey = unwrap_key(encryptedKey, keys)
+    print('Dynamic AES key is: ', aesKey.hex())
+    return aesKey, keys
+
+async def wait_for_key(key_future, join_receipt):
+    # The manager's EncryptedKey reply, or None when join reverted (the round closed on
+    # its quorum or deadline before the join was mined), which is never answered
+    done, _ = await asyncio.wait([key_future, join_receipt], return_when=asyncio.FIRST_COMPLETED)
+    if key_future not in done and join_receipt.result()['status'] != 1:
+        return None
+    return await key_future
+
+class SharedContext:
+    # State loaded once per process and shared by every emulated client: the
+    # configuration, the node connection and contract object, and the dataset.
+    def __init__(self, args):
+        # Load the contract ABI and address from the JSON file
+        with open('./EncFederatedLearningContract.json', 'r') as json_file:
+            contract_data = json.load(json_file)
+        contract_abi = contract_data['abi']
+
+        # cfg_file = './cfg/'+str(args.id)+'.cfg'
+        cfg_file = './cfg/all.cfg'
+        # read configuration from .cfg file
+        self.config = configparser.ConfigParser()
+        self.config.read(cfg_file)
+        contract_address = self.config['global']['CONTRACT_ADDRESS']
+
+        # Update compression is a project setting; the command line overrides the cfg
+        project_section = f'project_{args.projectID}'
+        compression = args.compression
+        if compression is None and self.config.has_section(project_section):
+            compression = self.config[project_section].get('COMPRESSION')
+        self.compression = parse_compression(compression)
+        if self.compression.enabled and args.weight_format != 'binary':
+            raise ValueError('Update compression needs the binary weight format.')
+
+        http_provider = self.config['global']['HTTP_PROVIDER']
+        self.w3 = Web3(Web3.HTTPProvider(http_provider))
+        if not self.w3.is_connected():
+            print("Could not connect to Ethereum node.")
+        else:
+            print("Connected to Ethereum node.")
+
+        # Create a contract instance
+        self.contract = self.w3.eth.contract(address=contract_address, abi=contract_abi)
+        # The dataset is prepared once per host and mapped read-only; each client only
+        # holds the indices of its shard and gathers batches from the mapping
+        self.args = args
+        self.data = load_mnist_memmap(args.data_dir)
+        self._datasets = {}
+        self._datasets_lock = threading.Lock()
+        self.train_executor = ThreadPoolExecutor(args.train_workers)
+        # Evaluation is off the critical path of a round and must not queue ahead of training
+        self.eval_executor = ThreadPoolExecutor(1)
+        # One log subscription serves every client; WS_PROVIDER is optional
+        self.dispatcher = EventDispatcher(self.w3, self.contract, [args.projectID],
+                                          ws_url=self.config['global'].get('WS_PROVIDER'))
+        # Reads of every client share batch requests; per-round values are dropped when
+        # the next GlobalModelUpdated arrives
+        self.reader = ContractReader(self.w3)
+        self.reader.watch(self.dispatcher, args.projectID)
+        self._batch_sizes = {}
+        self._batch_sizes_lock = threading.Lock()
+        self._shards = {}
+        # With --engine batched the clients of the process train together
+        client_ids = args.clients if args.clients is not None else [args.id]
+        self.batched = BatchedTraining(self.data[0], client_ids, args.batch_window, self.train_executor)
+        # With --engine pool they submit training jobs to worker processes
+        self.pool = None
+        if args.engine == 'pool':
+            workers = args.pool_workers or max(1, len(args.pool_cpus or os.sched_getaffinity(0)) // 4)
+            self.pool = TrainingPool(workers, args.data_dir, args.pool_cpus, precision=args.precision)
+        if args.precision != 'float32':
+            set_precision(args.precision)
+
+    def batch_size(self, model):
+        # --batch_size, or the one autotuned for the model's architecture (the fit engine
+        # is measured with the compiled step without XLA, which is closest to it)
+        args = self.args
+        if args.batch_size != 'auto':
+            return args.batch_size
+        with self._batch_sizes_lock:
+            arch = architecture_key(model)
+            if arch not in self._batch_sizes:
+                os.makedirs(args.cache_dir, exist_ok=True)
+                self._batch_sizes[arch] = autotune_batch_size(model, args.engine == 'compiled' and not args.no_jit,
+                                                              os.path.join(args.cache_dir, 'batch_size.json'))
+            return self._batch_sizes[arch]
+
+    def client_shard(self, ID):
+        # Training indices of the client's shard, for --engine batched and the sample
+        # count of its updates
+        args = self.args
+        with self._datasets_lock:
+            if ID not in self._shards:
+                self._shards[ID] = split_client_shard(self.data[0][1], ID % args.num_shards, args.num_shards, args.partition,
+                                                      args.alpha, args.validation_split)[0]
+            return self._shards[ID]
+
+    def shard_spec(self, ID):
+        # The client's shard as --engine pool workers rebuild it (split_client_shard)
+        args = self.args
+        return (ID % args.num_shards, args.num_shards, args.partition, args.alpha, args.validation_split)
+
+    def client_datasets(self, ID, batch_size=None):
+        # tf.data pipelines are built on first use, so TensorFlow is not needed to start
+        args = self.args
+        batch_size = batch_size or args.batch_size
+        with self._datasets_lock:
+            if (ID, batch_size) not in self._datasets:
+                self._datasets[(ID, batch_size)] = load_client_datasets(self.data[0], ID % args.num_shards, args.num_shards,
+                                                                        args.partition, args.alpha, batch_size,
+                                                                        args.validation_split)
+            return self._datasets[(ID, batch_size)]
+
+    def test_dataset(self):
+        args = self.args
+        with self._datasets_lock:
+            if 'test' not in self._datasets:
+                x_test, y_test = self.data[1]
+                test_idx = None
+                if 0 < args.eval_samples < len(x_test):
+                    test_idx = np.sort(np.random.default_rng(0).choice(len(x_test), args.eval_samples, replace=False))
+                self._datasets['test'] = make_indexed_dataset(x_test, y_test, test_idx, args.batch_size if args.batch_size != 'auto' else 512)
+            return self._datasets['test']
+
+async def evaluate_round(shared, tracer, model, niter, val_ds=None, engine=None, test=True):
+    if val_ds is not None:
+        validate = engine.validate if engine is not None else lambda ds: validate_model(model, ds)
+        await tracer.run('validate', validate, val_ds, round=niter, executor=shared.eval_executor)
+    if test:
+        test_ds = await asyncio.to_thread(shared.test_dataset)
+        await tracer.run('evaluate', evaluate_model, model, test_ds, round=niter, executor=shared.eval_executor)
+
+async def run_client(ID, args, shared):
     aesKey = None
     serverPK = None
-    args = parse_args()
-    logger = create_logger(args.id)
-    # Load the contract ABI and address from the JSON file
-    with open('./EncFederatedLearningContract.json', 'r') as json_file:
-        contract_data = json.load(json_file)
-    contract_abi = contract_data['abi']
-
-    # cfg_file = './cfg/'+str(args.id)+'.cfg'
-    cfg_file = './cfg/all.cfg'
-    # read configuration from .cfg file
-    config = configparser.ConfigParser()
-    config.read(cfg_file)
-    contract_address = config['global']['CONTRACT_ADDRESS']    
-
-    # Load the wallet address and private key from the JSON file
-    with open('./wallet.json', 'r') as wallet_file:
-        wallet_data = json.load(wallet_file)
-    wallet_address = config[str(args.id)]['ACCOUNT_ADDRESS']
-    wallet_private_key = config[str(args.id)]['PRIVATE_KEY']
+    logger = create_logger(ID)
+    cache = CIDCache(args.cache_dir, args.cache_mb << 20, logger) if args.cache_mb > 0 else None
+    tracer = Tracer(ID, os.path.join(args.trace_dir, f'{ID}.trace.jsonl') if args.trace_dir else None, logger)
+    w3 = shared.w3
+    contract = shared.contract
+
+    wallet_address = shared.config[str(ID)]['ACCOUNT_ADDRESS']
+    wallet_private_key = shared.config[str(ID)]['PRIVATE_KEY']
     ecdh_private_key_hex_str, ecdh_public_key_hex_str = generate_key()
     ecdh_private_key = load_private_key_from_hex(ecdh_private_key_hex_str)
     ecdh_public_key = load_public_key_from_hex(ecdh_public_key_hex_str)
 
     sharedKey = None
 
-    http_provider = config['global']['HTTP_PROVIDER']
-    w3 = Web3(Web3.HTTPProvider(http_provider))
-    if not w3.is_connected():
-        print("Could not connect to Ethereum node.")
-    else:
-        print("Connected to Ethereum node.")
-
-    # Create a contract instance
-    contract = w3.eth.contract(address=contract_address, abi=contract_abi)
-    # Prepare and sign transactions using the wallet's private key
-    def sign_transaction(tx):
-        signed_tx = w3.eth.account.sign_transaction(tx, private_key=wallet_private_key)
-        return signed_tx.raw_transaction
-    
+    # Prepare and sign transactions using the wallet's private key, with locally tracked nonces
+    tx_manager = TransactionManager(w3, wallet_address, wallet_private_key, logger=logger, reader=shared.reader)
+    # Keeps the global weights of the round and the error feedback residual
+    encoder = UpdateEncoder(shared.compression)
+    next_join = None
+    upload_receipt = None
+
+    # View calls of all clients in this process go out in shared batch requests;
+    # scope 'project' or 'round' caches the result (utils.reader)
+    def call(fn, scope=None):
+        return shared.reader.call(fn, wallet_address, scope, projectID)
+
     model = None
     projectID = args.projectID
-    (x_train, y_train), (x_test, y_test) = load_mnist_dataset()
 
     niter = 0
-    nlimit = 10
-
+    nlimit = args.rounds
 
     first_join = True
     flag = False
-        
+    # Stages that overlap the next one: the client's datasets are built while it joins,
+    # and the evaluation of a round runs while its update is uploaded and the client
+    # waits for the next round
+    # With --batch_size auto they wait for the architecture
+    datasets = asyncio.ensure_future(asyncio.to_thread(shared.client_datasets, ID)) if args.batch_size != 'auto' else None
+    batch_size = args.batch_size
+    engine = None
+    batched = False
+    evaluation = None
+    global_future = None
+    # Lowest iteration a join can still be answered for; replies below it belong to a
+    # join that timed out in an earlier round
+    key_iteration = 0
+
     while True:
         if first_join:
-            serverPK_pem = contract.functions.getMainPK(projectID).call({'from': wallet_address})
+            serverPK_pem, flag = await asyncio.gather(call(contract.functions.getMainPK(projectID), 'project'),
+                                                      call(contract.functions.isTrainable(projectID)))
             serverPK = load_public_key_from_hex(serverPK_pem)
             sharedKey = achieve_shared_secret(ecdh_private_key, serverPK)
-            flag = contract.functions.isTrainable(projectID).call({'from': wallet_address})
             first_join = False
-        
+
         if not flag:
             print('Project is not trainable, waiting.')
-            event_filter = contract.events.GlobalModelUpdated.create_filter(from_block='latest')
-            await filter_GlobalModelUpdated(event_filter, 2, projectID)
+            with tracer.span('wait_global', niter, cpu=False):
+                key_iteration = await filter_GlobalModelUpdated(global_future or shared.dispatcher.expect('GlobalModelUpdated', projectId=projectID))
         flag = False
 
-        print('Start joining...')
-        start_time_1 = time.time()
-        if model is None:
-            oneTimeFee = contract.functions.beforeJoin(projectID).call({'from': wallet_address}) * 0.1
-            # oneTimeFee = 20
-            print(f'One time fee: {oneTimeFee}')
-            fees = w3.to_wei(oneTimeFee, 'ether')
-            transaction = contract.functions.join(projectID, ecdh_public_key_hex_str).build_transaction({
-                'chainId': 1337,  # Replace with the correct chain ID
-                'gas': 2000000,    # Adjust gas limit as needed
-                'gasPrice': w3.to_wei('2', 'gwei'),  # Adjust gas price as needed
-                'nonce': w3.eth.get_transaction_count(wallet_address),
-                'value': fees
-            })
-        else:
-            transaction = contract.functions.join(projectID, ecdh_public_key_hex_str).build_transaction({
-                'chainId': 1337,  # Replace with the correct chain ID
-                'gas': 2000000,    # Adjust gas limit as needed
-                'gasPrice': w3.to_wei('2', 'gwei'),  # Adjust gas price as needed
-                'nonce': w3.eth.get_transaction_count(wallet_address)
-            })
+        # Critical path of the round, from joining to the local_upload transaction
+        critical_path = contextlib.ExitStack()
+        critical_path.enter_context(tracer.span('round', niter, cpu=False))
 
-        # Sign and send the transaction
-        signed_transaction = sign_transaction(transaction)
-        tx_hash = w3.eth.send_raw_transaction(signed_transaction)
+        print('Start joining...')
+        with tracer.span('join', niter, cpu=False):
+            # Registered before join is sent, so the manager's reply cannot be missed
+            key_future = shared.dispatcher.expect('EncryptedKey', lambda event_args, since=key_iteration: event_args['iteration'] >= since,
+                                                  projectId=projectID, clientAddress=wallet_address)
+            if model is None:
+                oneTimeFee = await call(contract.functions.beforeJoin(projectID)) * 0.1
+                # oneTimeFee = 20
+                print(f'One time fee: {oneTimeFee}')
+                fees = w3.to_wei(oneTimeFee, 'ether')
+                join_receipt = await tx_manager.send(contract.functions.join(projectID, ecdh_public_key_hex_str), fees)
+            elif next_join is not None:
+                join_receipt = await tx_manager.submit(next_join)
+            else:
+                join_receipt = await tx_manager.send(contract.functions.join(projectID, ecdh_public_key_hex_str))
 
-        event_filter = contract.events.EncryptedKey.create_filter(from_block='latest')
-        aesKey = await filter_EncryptedKey(event_filter, 2, projectID, wallet_address, sharedKey)
+        # The manager only answers once join is mined, so its receipt is not on the critical path
+        with tracer.span('key_wait', niter, cpu=False):
+            try:
+                key_event = await asyncio.wait_for(wait_for_key(key_future, join_receipt), args.key_timeout or None)
+            except asyncio.TimeoutError:
+                logger.warning(f'No round key within {args.key_timeout} s of joining.')
+                key_event = None
+            if key_event is None:
+                key_future.cancel()
+            else:
+                aesKey, keys = await filter_EncryptedKey(key_future, sharedKey, projectID, wallet_address)
+        if key_event is None:
+            # Missed this round: join again once the next global model is out
+            print('Join was not answered, waiting for the next round.')
+            critical_path.close()
+            next_join = None
+            global_future = shared.dispatcher.expect('GlobalModelUpdated', projectId=projectID)
+            continue
 
-        # Wait for the transaction receipt
-        tx_receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
-        end_time_1 = time.time()
-        logger.info(f"Joining time: {end_time_1 - start_time_1}")
+        print('Loading model weights from IPFS...')
+        with tracer.span('cid_lookup', niter, cpu=False):
+            if model is None:
+                arch_ipfs_hash, weights_ipfs_hash = await asyncio.gather(call(contract.functions.participateReturn(projectID), 'project'),
+                                                                         call(contract.functions.joinReturn(projectID), 'round'))
+            else:
+                weights_ipfs_hash = await call(contract.functions.joinReturn(projectID), 'round')
 
+        # model = load_weight_from_ipfs(weights_ipfs_hash, model)
+        download = asyncio.ensure_future(tracer.run('download', fetch_decrypted_payload, weights_ipfs_hash, aesKey, cache, round=niter, nbytes=len))
         if model is None:
-            start_time_2 = time.time()
             print('Loading model architecture from IPFS...', 'Decrypt with key:', aesKey)
-            arch_ipfs_hash = contract.functions.participateReturn(projectID).call({'from': wallet_address})
-            end_time_2 = time.time()
-            logger.info(f"Getting model arch CID time: {end_time_2 - start_time_2}")
-            # model = load_model_from_ipfs(arch_ipfs_hash)
-            start_time_2 = time.time()
-            model = dec_load_model_from_ipfs(arch_ipfs_hash, aesKey)
             # model = load_model_from_ipfs(arch_ipfs_hash)
-            model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
-            end_time_2 = time.time()
-            logger.info(f"Loading model arch time: {end_time_2 - start_time_2}")
-            
-        start_time_3 = time.time()
-        print('Loading model weights from IPFS...')
-        weights_ipfs_hash = contract.functions.joinReturn(projectID).call({'from': wallet_address})
-        end_time_3 = time.time()
-        logger.info(f"Getting model weights CID time: {end_time_3 - start_time_3}")
+            model = await tracer.run('load_arch', dec_load_model_from_ipfs, arch_ipfs_hash, aesKey, cache, round=niter)
+            model.compile(optimizer='adam', loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+            if datasets is None:
+                batch_size = await tracer.run('autotune', shared.batch_size, model, round=niter)
+                datasets = asyncio.ensure_future(asyncio.to_thread(shared.client_datasets, ID, batch_size))
+            if args.engine == 'compiled':
+                engine = TrainingEngine(model, jit_compile=not args.no_jit)
+            batched = args.engine == 'batched' and supports_batched(model)
+            if args.engine == 'batched' and not batched:
+                print('The architecture cannot be trained batched, training with fit.')
+        payload = await download
+        # The previous round's evaluation still reads the model
+        if evaluation is not None:
+            await evaluation
+        await tracer.run('decode', assign_payload, model, payload, cache, round=niter)
+        if shared.compression.delta:
+            encoder.set_base(model.get_weights(), weights_ipfs_hash)
 
-        start_time_3 = time.time()
-        # model = load_weight_from_ipfs(weights_ipfs_hash, model)
-        model = dec_load_weight_from_ipfs(weights_ipfs_hash, model, aesKey)
-        end_time_3 = time.time()
-        logger.info(f"Loading model weights time: {end_time_3 - start_time_3}")
-
-
-        start_time_4 = time.time()
-        train_model(model, x_train, y_train, epochs=1)
-        end_time_4 = time.time()
-        logger.info(f"Training time: {end_time_4 - start_time_4}")
+        # Training shares a bounded executor so concurrent clients do not oversubscribe the CPU
+        train_ds, val_ds = await datasets
+        if batched:
+            with tracer.span('train', niter, cpu=False):
+                await shared.batched.train(ID, model, shared.client_shard(ID), batch_size)
+        elif shared.pool is not None:
+            with tracer.span('train', niter, cpu=False):
+                result = await shared.pool.train(ID, model, shared.shard_spec(ID), batch_size)
+                add_phase('queue', result['queued'])
+                add_phase('worker_train', result['end'] - result['start'])
+            print(f"Model training completed in worker {result['worker']}, loss {result['loss']:.4f}.")
+        elif engine is not None:
+            await tracer.run('train', engine.train, train_ds, 1, round=niter, executor=shared.train_executor)
+        else:
+            await tracer.run('train', train_model, model, train_ds, 1, round=niter, executor=shared.train_executor)
 
-        evaluate_model(model, x_test, y_test)
+        # Validation and evaluation only read the model, alongside encoding; the next
+        # round's weights are assigned after they finished
+        evaluation = None
+        test = bool(args.eval_every) and niter % args.eval_every == 0
+        if val_ds is not None or test:
+            evaluation = asyncio.ensure_future(evaluate_round(shared, tracer, model, niter, val_ds, engine, test))
 
         # upload_hash_value = upload_weight_to_ipfs(model)
-        start_time_5 = time.time()
-        upload_hash_value = enc_upload_weight_to_ipfs(model, sharedKey)
-        end_time_5 = time.time()
-        logger.info(f"Uploading model weights time: {end_time_5 - start_time_5}")
+        # The manager weights the update by the samples it was trained on
+        meta = {'samples': len(shared.client_shard(ID))}
+        if shared.compression.enabled:
+            message = await tracer.run('encode', encoder.encode, model.get_weights(), model_weight_names(model), meta, round=niter, nbytes=len)
+        else:
+            message = await tracer.run('encode', serialize_weights, model, args.weight_format, meta, round=niter, nbytes=len)
+        upload_hash_value = await tracer.run('upload', enc_upload_bytes_to_ipfs, message, keys.upload, args.cipher, round=niter,
+                                             nbytes=lambda _: len(message))
         print(f"Model uploaded to IPFS with hash: {upload_hash_value}")
 
-
         print('Upoading local model IPFS address to blockchain...')
-        start_time_5 = time.time()
-        transaction = contract.functions.local_upload(projectID, upload_hash_value).build_transaction({
-            'chainId': 1337,  # Replace with the correct chain ID
-            'gas': 2000000,    # Adjust gas limit as needed
-            'gasPrice': w3.to_wei('2', 'gwei'),  # Adjust gas price as needed
-            'nonce': w3.eth.get_transaction_count(wallet_address)
-        })
-        # Sign and send the transaction
-        signed_transaction = sign_transaction(transaction)
-        tx_hash = w3.eth.send_raw_transaction(signed_transaction)
-        end_time_5 = time.time()
-        logger.info(f"Uploading model weights CID time: {end_time_5 - start_time_5}")
+        tx_receipt = await join_receipt
+        if tx_receipt['status'] != 1:
+            logger.warning(f"Join transaction {tx_receipt['transactionHash'].hex()} reverted")
+        # The next round can follow quickly once the last update is in; wait for it from here
+        global_future = shared.dispatcher.expect('GlobalModelUpdated', projectId=projectID) if niter + 1 < nlimit else None
+        with tracer.span('tx_send', niter, cpu=False):
+            upload_receipt = await tx_manager.send(contract.functions.local_upload(projectID, upload_hash_value))
+        critical_path.close()
         print('Finished.')
-        
+
         niter += 1
         if niter >= nlimit:
             break
+        # Sign the next join ahead of time while waiting for the next round
+        next_join = await tx_manager.prepare(contract.functions.join(projectID, ecdh_public_key_hex_str))
+
+    if evaluation is not None:
+        await evaluation
+    if upload_receipt is not None:
+        await upload_receipt
+    tracer.close()
+    print(f'Training completed for client {ID}.')
 
+async def main():
+    args = parse_args()
+    client_ids = args.clients if args.clients is not None else [args.id]
+    configure_pool(args.ipfs_pool_size)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    # Every client keeps a few blocking node/IPFS calls in flight
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max(32, 4 * len(client_ids))))
+    shared = SharedContext(args)
+    # TensorFlow is first needed to load the model after joining; import it meanwhile
+    preload('tensorflow')
+    shared.dispatcher.start()
+    if shared.pool is not None:
+        shared.pool.start()
+    await asyncio.gather(*(run_client(ID, args, shared) for ID in client_ids))
+    await shared.dispatcher.stop()
+    print(f'{shared.reader.calls} node reads answered with {shared.reader.requests} batch requests.')
+    if shared.pool is not None:
+        print(shared.pool.report())
+        shared.pool.close()
     print('Training completed.')
-    
+
 if __name__ == '__main__':
     asyncio.run(main())
     # main()
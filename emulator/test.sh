@@ -3,6 +3,8 @@
 for i in {0..4}; do
     python script.py --id "$i" --projectID 13 &
 done
+# Or run all wallets in a single process:
+# python script.py --clients 0-4 --projectID 13 &
 # Wait for all background processes to finish
 wait
 echo "All scripts have finished execution."
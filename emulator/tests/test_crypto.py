@@ -0,0 +1,71 @@
+# Chunked AES-GCM payloads of utils.crypto and their detection when fetched from IPFS.
+# Run from emulator/: python -m pytest tests
+import os
+import pytest
+from utils.crypto import (StreamDecryptor, StreamEncryptor, decrypt_payload, encrypt, encrypt_payload, TAG_SIZE,
+                          _STREAM_HEADER)
+from utils.ipfs import cat_decrypted
+
+KEY = bytes(range(32))
+SEGMENT = 64
+
+class FakeIPFS:
+    # cat() streams a stored payload in chunks of chunk_size bytes
+    def __init__(self, payload, chunk_size):
+        self.payload = payload
+        self.chunk_size = chunk_size
+
+    def cat(self, hash_value, stream=False):
+        return (self.payload[i:i + self.chunk_size] for i in range(0, len(self.payload), self.chunk_size))
+
+@pytest.mark.parametrize('size', [0, 1, SEGMENT - 1, SEGMENT, SEGMENT + 1, 3 * SEGMENT])
+def test_round_trip_at_segment_boundaries(size):
+    message = os.urandom(size)
+    payload = encrypt_payload(message, KEY, SEGMENT)
+    segments = max(1, -(-size // SEGMENT))
+    assert len(payload) == _STREAM_HEADER.size + size + segments * TAG_SIZE
+    assert decrypt_payload(payload, KEY) == message
+
+@pytest.mark.parametrize('size', [0, SEGMENT, SEGMENT + 1])
+def test_incremental_round_trip(size):
+    message = os.urandom(size)
+    encryptor = StreamEncryptor(KEY, SEGMENT)
+    payload = b''.join([encryptor.update(message[i:i + 7]) for i in range(0, size, 7)]) + encryptor.finalize()
+    decryptor = StreamDecryptor(KEY)
+    out = b''.join(decryptor.update(payload[i:i + 5]) for i in range(0, len(payload), 5))
+    assert out + decryptor.finalize() == message
+
+@pytest.mark.parametrize('cut', [1, TAG_SIZE, SEGMENT + TAG_SIZE])
+def test_truncation_is_rejected(cut):
+    payload = encrypt_payload(os.urandom(3 * SEGMENT), KEY, SEGMENT)
+    with pytest.raises(ValueError):
+        decrypt_payload(payload[:-cut], KEY)
+
+def test_dropping_whole_final_segment_is_rejected():
+    # What is left ends on a segment that was not sealed as the last one
+    payload = encrypt_payload(os.urandom(2 * SEGMENT), KEY, SEGMENT)
+    with pytest.raises(ValueError):
+        decrypt_payload(payload[:_STREAM_HEADER.size + SEGMENT + TAG_SIZE], KEY)
+
+@pytest.mark.parametrize('position', [-1, _STREAM_HEADER.size + 3, 5])
+def test_tampering_is_rejected(position):
+    # A tag byte, a ciphertext byte and a header byte (authenticated as associated data)
+    payload = bytearray(encrypt_payload(os.urandom(2 * SEGMENT), KEY, SEGMENT))
+    payload[position] ^= 1
+    with pytest.raises(ValueError):
+        decrypt_payload(bytes(payload), KEY)
+
+def test_wrong_key_is_rejected():
+    payload = encrypt_payload(b'weights', KEY, SEGMENT)
+    with pytest.raises(ValueError):
+        decrypt_payload(payload, bytes(32))
+
+def test_legacy_ecb_fallback():
+    message = b'{"legacy": true}'
+    assert decrypt_payload(encrypt(message, KEY), KEY) == message
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 1 << 16])
+def test_cat_decrypted_detects_format_across_small_chunks(chunk_size):
+    message = os.urandom(2 * SEGMENT + 5)
+    assert cat_decrypted(FakeIPFS(encrypt_payload(message, KEY, SEGMENT), chunk_size), 'cid', KEY) == message
+    assert cat_decrypted(FakeIPFS(encrypt(message, KEY), chunk_size), 'cid', KEY) == message
@@ -0,0 +1,44 @@
+# Client shards of utils.ml.partition_indices. Run from emulator/: python -m pytest tests
+import numpy as np
+import pytest
+from utils.ml import partition_indices, split_client_shard
+
+def labels(n=6000, classes=10):
+    return np.random.default_rng(0).integers(0, classes, n)
+
+def shards(y, num_shards, **kwargs):
+    return [partition_indices(y, num_shards, i, **kwargs) for i in range(num_shards)]
+
+@pytest.mark.parametrize('method', ['iid', 'dirichlet'])
+def test_shards_are_disjoint_and_cover_the_data(method):
+    y = labels()
+    parts = shards(y, 20, method=method)
+    combined = np.concatenate(parts)
+    assert len(combined) == len(np.unique(combined)) == len(y)
+
+def test_low_alpha_dirichlet_gives_every_shard_min_size():
+    # MNIST-sized: without resampling, alpha=0.1 leaves some of 60 shards near empty
+    y = labels(60000)
+    parts = shards(y, 60, method='dirichlet', alpha=0.1, min_size=50)
+    assert min(len(p) for p in parts) >= 50
+    # Still skewed: most shards are dominated by few classes
+    assert np.median([np.bincount(y[p], minlength=10).max() / len(p) for p in parts]) > 0.5
+
+def test_dirichlet_partition_is_the_same_for_every_shard_id():
+    y = labels()
+    first = shards(y, 30, method='dirichlet', alpha=0.05)
+    assert all(np.array_equal(a, b) for a, b in zip(first, shards(y, 30, method='dirichlet', alpha=0.05)))
+
+def test_impossible_min_size_fails_loudly():
+    y = labels(100)
+    with pytest.raises(ValueError, match='at least'):
+        partition_indices(y, 20, 0, method='dirichlet', min_size=10)
+    with pytest.raises(ValueError, match='at least'):
+        partition_indices(y, 5, 0, method='dirichlet', alpha=0.01, min_size=20)
+
+def test_validation_split_keeps_training_samples():
+    y = labels()
+    train, val = split_client_shard(y, 0, 10, validation_split=0.2)
+    assert len(train) == 480 and len(val) == 120
+    with pytest.raises(ValueError, match='no training samples'):
+        split_client_shard(y, 0, 10, validation_split=1.0)
@@ -0,0 +1,72 @@
+# Session key schemes of utils.session, against the frontend's deriveSessionKeys/unwrapKey.
+# Run from emulator/: python -m pytest tests
+import hashlib
+import hmac
+import os
+import pytest
+from utils.session import SessionKeyCache, SessionKeys, derive_session_keys, key_scheme, unwrap_key, wrap_key
+
+SECRET = bytes(range(32, 64))
+PROJECT_ID = 3
+PEER = '0xAbCdEf0123456789aBcDeF0123456789ABCDEF01'
+ITERATION = 7
+ROUND_KEY = bytes(range(100, 132))
+# hkdf-v1 keys for the arguments above, and ROUND_KEY wrapped under them with iv 00..0f
+UPLOAD_KEY = bytes.fromhex('7adfcfcf39d18c8312871f6409ce053dbf9149e7c62c81d46a9905316fc5e6fc')
+WRAP_KEY = bytes.fromhex('386dceefe9cc4e04813a947618a0908a8a9f9e6c4aba1721dcc29dcccfd5e8d5')
+WRAPPED = 'v1:AAECAwQFBgcICQoLDA0OD4xhN1/H7PaX6dW300vRCqBEEvtvD0nfzfCwfELbLKGMm8j/YvGxSHxHjb8nT9p3uw=='
+
+def frontend_session_keys(secret, project_id, peer, iteration):
+    # deriveSessionKeys of frontend/src/components/utils.js: one HMAC-SHA256 extract
+    # and a single-block expand per purpose
+    prk = hmac.new(b'fl-session/v1', secret, hashlib.sha256).digest()
+    def expand(purpose):
+        info = f'fl-session/v1/{purpose}/{project_id}/{peer.lower()}/{iteration}'.encode()
+        return hmac.new(prk, info + b'\x01', hashlib.sha256).digest()
+    return SessionKeys(expand('upload'), expand('wrap'))
+
+def test_fixed_vector():
+    keys = derive_session_keys(SECRET, PROJECT_ID, PEER, ITERATION)
+    assert keys == SessionKeys(UPLOAD_KEY, WRAP_KEY)
+    assert keys == frontend_session_keys(SECRET, PROJECT_ID, PEER, ITERATION)
+    assert unwrap_key(WRAPPED, keys) == ROUND_KEY
+
+@pytest.mark.parametrize('project_id, iteration', [(0, 1), (12, 345)])
+def test_matches_frontend_derivation(project_id, iteration):
+    secret = os.urandom(32)
+    assert derive_session_keys(secret, project_id, PEER, iteration) == frontend_session_keys(secret, project_id, PEER, iteration)
+
+def test_peer_address_case_is_ignored():
+    keys = derive_session_keys(SECRET, PROJECT_ID, PEER, ITERATION)
+    assert derive_session_keys(SECRET, PROJECT_ID, PEER.lower(), ITERATION) == keys
+    assert derive_session_keys(SECRET, PROJECT_ID, '0x' + PEER[2:].upper(), ITERATION) == keys
+
+def test_keys_differ_per_purpose_project_peer_and_iteration():
+    keys = derive_session_keys(SECRET, PROJECT_ID, PEER, ITERATION)
+    assert keys.upload != keys.wrap
+    assert derive_session_keys(SECRET, PROJECT_ID + 1, PEER, ITERATION) != keys
+    assert derive_session_keys(SECRET, PROJECT_ID, '0x' + '0' * 40, ITERATION) != keys
+    assert derive_session_keys(SECRET, PROJECT_ID, PEER, ITERATION + 1) != keys
+
+def test_hkdf_round_trip():
+    cache = SessionKeyCache()
+    # The manager wraps with the checksummed address, the client derives from the lowercase one
+    wrapped = wrap_key(ROUND_KEY, cache.get('hkdf-v1', SECRET, PROJECT_ID, PEER, ITERATION), 'hkdf-v1')
+    assert wrapped.startswith('v1:')
+    assert key_scheme(wrapped) == 'hkdf-v1'
+    keys = cache.get(key_scheme(wrapped), SECRET, PROJECT_ID, PEER.lower(), ITERATION)
+    assert keys == SessionKeys(UPLOAD_KEY, WRAP_KEY)
+    assert unwrap_key(wrapped, keys) == ROUND_KEY
+    assert len(cache) == 1
+
+def test_raw_round_trip():
+    keys = SessionKeyCache().get('raw', SECRET, PROJECT_ID, PEER, ITERATION)
+    assert keys == SessionKeys(SECRET, SECRET)
+    wrapped = wrap_key(ROUND_KEY, keys, 'raw')
+    assert not wrapped.startswith('v1:')
+    assert key_scheme(wrapped) == 'raw'
+    assert unwrap_key(wrapped, keys) == ROUND_KEY
+
+def test_unknown_scheme():
+    with pytest.raises(ValueError):
+        SessionKeyCache().get('hkdf-v2', SECRET, PROJECT_ID, PEER, ITERATION)
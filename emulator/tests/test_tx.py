@@ -0,0 +1,122 @@
+# TransactionManager against eth-tester's py-evm chain (benchmarks/stub_evm.py) over
+# HTTP JSON-RPC. Run from emulator/: python -m pytest tests
+import asyncio
+import pytest
+from web3 import Web3
+
+pytest.importorskip('eth_tester')
+from benchmarks.stub_evm import StubEVM
+from utils.tx import TransactionManager
+
+class Transfer:
+    # Stands in for a contract function: a plain value transfer to `to`
+    def __init__(self, to):
+        self.to = to
+
+    def build_transaction(self, tx):
+        return {**tx, 'to': self.to, 'value': tx.get('value', 0)}
+
+@pytest.fixture(scope='module')
+def chain():
+    evm = StubEVM(num_accounts=3)
+    yield evm, Web3(Web3.HTTPProvider(evm.url))
+    evm.server.shutdown()
+
+def manager(chain, account=0):
+    evm, w3 = chain
+    address, key = evm.accounts[account]
+    return TransactionManager(w3, address, key, gas=21000, poll_interval=0.01)
+
+def test_concurrent_sends_get_consecutive_nonces(chain):
+    _, w3 = chain
+    tm = manager(chain)
+    to = chain[0].accounts[1][0]
+    start = w3.eth.get_transaction_count(tm.address)
+
+    async def run():
+        tasks = await asyncio.gather(*(tm.send(Transfer(to), value=i + 1) for i in range(5)))
+        return await asyncio.gather(*tasks)
+
+    receipts = asyncio.run(run())
+    assert all(r['status'] == 1 for r in receipts)
+    nonces = sorted(w3.eth.get_transaction(r['transactionHash'])['nonce'] for r in receipts)
+    assert nonces == list(range(start, start + 5))
+    assert w3.eth.get_transaction_count(tm.address) == start + 5
+
+def test_stale_nonce_resyncs(chain, caplog):
+    _, w3 = chain
+    tm = manager(chain)
+    to = chain[0].accounts[1][0]
+
+    async def run():
+        await (await tm.send(Transfer(to)))
+        # Another sender uses the account's next nonce behind the manager's back
+        other = manager(chain)
+        await (await other.send(Transfer(to)))
+        return await (await tm.send(Transfer(to)))
+
+    receipt = asyncio.run(run())
+    assert 'resyncing nonce' in caplog.text
+    assert receipt['status'] == 1
+    assert w3.eth.get_transaction(receipt['transactionHash'])['nonce'] == w3.eth.get_transaction_count(tm.address) - 1
+
+def test_nonce_gap_resyncs(chain, caplog):
+    _, w3 = chain
+    tm = manager(chain)
+    to = chain[0].accounts[1][0]
+
+    async def run():
+        await (await tm.send(Transfer(to)))
+        # A nonce the node cannot accept yet, as after a dropped transaction
+        tm._nonce += 3
+        receipt = await (await tm.send(Transfer(to)))
+        # Resynced: later transactions follow on without a gap
+        return receipt, await (await tm.send(Transfer(to)))
+
+    first, second = asyncio.run(run())
+    count = w3.eth.get_transaction_count(tm.address)
+    assert 'resyncing nonce' in caplog.text
+    assert first['status'] == second['status'] == 1
+    assert [w3.eth.get_transaction(r['transactionHash'])['nonce'] for r in (first, second)] == [count - 2, count - 1]
+
+def test_wait_for_receipt_polls_until_mined(chain):
+    _, w3 = chain
+    tm = manager(chain)
+    to = chain[0].accounts[1][0]
+
+    async def run():
+        prepared = await tm.prepare(Transfer(to))
+        tx_hash = Web3.keccak(prepared.raw_transaction)
+        # Waiting starts before the transaction is sent
+        waiter = asyncio.create_task(tm.wait_for_receipt(tx_hash))
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        await tm.submit(prepared)
+        return await asyncio.wait_for(waiter, 10)
+
+    receipt = asyncio.run(run())
+    assert receipt['status'] == 1
+
+def test_failure_in_a_prepared_batch_resyncs_once(chain, caplog):
+    # As the manager answers a batch of joins: all nonces reserved and signed first
+    _, w3 = chain
+    tm = manager(chain)
+    to = chain[0].accounts[1][0]
+    start = w3.eth.get_transaction_count(tm.address)
+
+    async def run():
+        prepared = [await tm.prepare(Transfer(to), value=i + 1) for i in range(5)]
+        tasks = [await tm.submit(tx) for tx in prepared[:2]]
+        # Another sender takes the third nonce, so the third send fails and resyncs
+        other = manager(chain)
+        await (await other.send(Transfer(to)))
+        tasks += [await tm.submit(tx) for tx in prepared[2:]]
+        return await asyncio.gather(*tasks)
+
+    receipts = asyncio.run(run())
+    assert all(r['status'] == 1 for r in receipts)
+    # The rest of the batch is signed again after the resync instead of failing in turn
+    assert caplog.text.count('resyncing nonce') == 1
+    sent = [w3.eth.get_transaction(r['transactionHash']) for r in receipts]
+    assert [tx['value'] for tx in sent] == [1, 2, 3, 4, 5]
+    assert [tx['nonce'] for tx in sent] == [start, start + 1, start + 3, start + 4, start + 5]
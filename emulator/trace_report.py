@@ -0,0 +1,60 @@
+# Merge the span files written by script.py (./res/{ID}.trace.jsonl) across clients
+# into per-round percentile tables of one metric per phase.
+# python trace_report.py ./res/*.trace.jsonl [--metric wall --percentiles 50,90,99 --json]
+import argparse
+import json
+from collections import defaultdict
+import numpy as np
+
+METRICS = ('wall', 'cpu', 'process_cpu', 'bytes', 'peak_rss')
+
+def load_spans(paths):
+    spans = []
+    for path in paths:
+        with open(path) as f:
+            spans.extend(json.loads(line) for line in f if line.strip())
+    return spans
+
+def percentile_tables(spans, metric='wall', percentiles=(50, 90, 99)):
+    # round -> phase -> {'n', 'p50', ..., 'max'}; sub-phases are keyed 'parent/phase'
+    values = defaultdict(lambda: defaultdict(list))
+    for span in spans:
+        value = span.get(metric)
+        if value is None:
+            continue
+        phase = f"{span['parent']}/{span['phase']}" if span.get('parent') else span['phase']
+        values[span['round']][phase].append(value)
+    tables = {}
+    for round_, phases in values.items():
+        tables[round_] = {}
+        for phase, vals in phases.items():
+            vals = np.asarray(vals, dtype=np.float64)
+            row = {'n': len(vals)}
+            row.update({f'p{p:g}': float(v) for p, v in zip(percentiles, np.percentile(vals, percentiles))})
+            row['max'] = float(vals.max())
+            tables[round_][phase] = row
+    return tables
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='+', help='Span files of the clients')
+    parser.add_argument('--metric', type=str, default='wall', choices=METRICS, help='Span field to summarise')
+    parser.add_argument('--percentiles', type=str, default='50,90,99', help='Comma-separated percentiles')
+    parser.add_argument('--json', action='store_true', help='Print the tables as JSON')
+    args = parser.parse_args()
+
+    percentiles = [float(p) for p in args.percentiles.split(',')]
+    tables = percentile_tables(load_spans(args.files), args.metric, percentiles)
+    order = sorted(tables, key=lambda r: (r is None, r if r is not None else 0))
+    if args.json:
+        print(json.dumps({str(r): tables[r] for r in order}, indent=2))
+        return
+    columns = ['n'] + [f'p{p:g}' for p in percentiles] + ['max']
+    for round_ in order:
+        print(f'\nround {round_} ({args.metric})')
+        print(f'{"phase":<20}' + ''.join(f'{c:>12}' for c in columns))
+        for phase, row in sorted(tables[round_].items()):
+            print(f'{phase:<20}{row["n"]:>12}' + ''.join(f'{row[c]:>12.4g}' for c in columns[1:]))
+
+if __name__ == '__main__':
+    main()
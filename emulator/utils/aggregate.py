@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import threading
+import time
+import numpy as np
+
+ACCUMULATORS = ('float64', 'kahan')
+
+class FedAvg:
+    # Sample-weighted average of client weight lists, accumulated in place. Buffers
+    # are allocated once from the first update, and every later update is folded in
+    # layer by layer through a reusable scratch buffer, so memory stays at a few
+    # copies of the model regardless of how many clients contribute. The running sum
+    # is kept in float64, or in float32 with Kahan compensation ('kahan'), which
+    # needs the same memory but stays exact to float32 precision over many clients.
+    def __init__(self, accumulator='float64'):
+        if accumulator not in ACCUMULATORS:
+            raise ValueError(f'Unknown accumulator {accumulator!r}, expected one of {ACCUMULATORS}.')
+        self.accumulator = accumulator
+        self._sum = None
+        self._scratch = None
+        self._comp = None
+        self._next = None
+        self.total_samples = 0
+        self.count = 0
+
+    def _allocate(self, weights):
+        dtype = np.float64 if self.accumulator == 'float64' else np.float32
+        self._sum = [np.zeros(np.shape(w), dtype=dtype) for w in weights]
+        self._scratch = [np.empty_like(s) for s in self._sum]
+        if self.accumulator == 'kahan':
+            self._comp = [np.zeros_like(s) for s in self._sum]
+            self._next = [np.empty_like(s) for s in self._sum]
+
+    def add(self, weights, n_samples=1):
+        if self._sum is None:
+            self._allocate(weights)
+        if len(weights) != len(self._sum):
+            raise ValueError(f'Expected {len(self._sum)} tensors, got {len(weights)}.')
+        for i, w in enumerate(weights):
+            acc, scratch = self._sum[i], self._scratch[i]
+            np.multiply(np.reshape(w, acc.shape), n_samples, out=scratch)
+            if self._comp is None:
+                acc += scratch
+                continue
+            # y = x - c; t = sum + y; c = (t - sum) - y; sum = t
+            comp, nxt = self._comp[i], self._next[i]
+            scratch -= comp
+            np.add(acc, scratch, out=nxt)
+            np.subtract(nxt, acc, out=comp)
+            comp -= scratch
+            self._sum[i], self._next[i] = nxt, acc
+        self.total_samples += n_samples
+        self.count += 1
+
+    def result(self, dtype='float32'):
+        if not self.count:
+            raise ValueError('No client updates to aggregate.')
+        if self._comp is None:
+            return [(acc / self.total_samples).astype(dtype, copy=False) for acc in self._sum]
+        return [((acc.astype(np.float64) - comp) / self.total_samples).astype(dtype, copy=False)
+                for acc, comp in zip(self._sum, self._comp)]
+
+class StreamingRound:
+    # One aggregation round fed by upload events. Every submitted update is fetched
+    # in a worker thread (at most max_inflight at once) and folded into the FedAvg as
+    # soon as it is decoded, so the average is ready the moment the round closes.
+    # fetch returns the update's weights and the number of samples it was trained on,
+    # its weight in the average.
+    # wait() returns why the round closed:
+    #   'all'      every trainer has uploaded (mark_complete) and all updates are in;
+    #   'quorum'   quorum updates are folded (quorum=0 waits for every trainer);
+    #   'deadline' deadline seconds have passed since the round opened and at least
+    #              one update is folded.
+    # Updates still in flight when the round closes are dropped.
+    def __init__(self, fetch, quorum=0, deadline=None, max_inflight=8, accumulator='float64', logger=None):
+        self.fetch = fetch
+        self.quorum = quorum
+        self.deadline = deadline
+        self.logger = logger or logging.getLogger(__name__)
+        self.fedavg = FedAvg(accumulator)
+        self.folded = []
+        self.failed = []
+        self.dropped = []
+        self.opened = time.perf_counter()
+        self.last_fold = None
+        self.closed = None
+        self._lock = threading.Lock()
+        self._slots = asyncio.Semaphore(max_inflight)
+        self._changed = asyncio.Event()
+        self._tasks = set()
+        self._complete = False
+
+    def submit(self, key, *args):
+        # Called from an event callback; args are passed to fetch in a worker thread
+        if self.closed is not None:
+            self.dropped.append(key)
+            return
+        task = asyncio.create_task(self._fold(key, args))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def mark_complete(self):
+        self._complete = True
+        self._changed.set()
+
+    def _done(self, task):
+        self._tasks.discard(task)
+        self._changed.set()
+
+    def _add(self, key, args):
+        weights, n_samples = self.fetch(*args)
+        with self._lock:
+            if self.closed is not None:
+                self.dropped.append(key)
+                return
+            self.fedavg.add(weights, n_samples)
+            self.folded.append(key)
+            self.last_fold = time.perf_counter()
+
+    async def _fold(self, key, args):
+        async with self._slots:
+            if self.closed is not None:
+                self.dropped.append(key)
+                return
+            try:
+                await asyncio.to_thread(self._add, key, args)
+            except Exception as e:
+                self.logger.warning(f'Fetching update of {key} failed ({e}), leaving it out of the average.')
+                self.failed.append(key)
+
+    def _close_reason(self):
+        if self._complete and not self._tasks:
+            return 'all'
+        if self.quorum and self.fedavg.count >= self.quorum:
+            return 'quorum'
+        if self.deadline and self.fedavg.count and time.perf_counter() - self.opened >= self.deadline:
+            return 'deadline'
+        return None
+
+    async def wait(self):
+        while True:
+            self._changed.clear()
+            reason = self._close_reason()
+            if reason is not None:
+                break
+            timeout = None
+            if self.deadline:
+                timeout = max(self.opened + self.deadline - time.perf_counter(), 0) or None
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        with self._lock:
+            self.closed = time.perf_counter()
+        return reason
+
+    def result(self, dtype='float32'):
+        return self.fedavg.result(dtype)
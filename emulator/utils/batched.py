@@ -0,0 +1,232 @@
+import asyncio
+import time
+import numpy as np
+from utils.lazy import lazy_import
+from utils.ml import architecture_key, make_stacked_dataset
+
+tf = lazy_import('tensorflow')
+
+# Layers BatchedTrainer can stack: convolutions, pooling and dense layers of
+# Sequential-style models such as the MNIST CNN (ResNet-18 needs BatchNormalization
+# and non-linear topologies, and trains per client)
+_SPATIAL = ('Conv2D', 'MaxPooling2D', 'AveragePooling2D')
+_STATELESS = ('Activation', 'ReLU', 'Dropout')
+SUPPORTED_LAYERS = ('InputLayer', 'Flatten', 'Dense') + _SPATIAL + _STATELESS
+
+def _layers(model):
+    return [layer for layer in model.layers if type(layer).__name__ != 'InputLayer']
+
+def supports_batched(model):
+    # Whether BatchedTrainer can train model: a chain of supported layers whose
+    # variables are all trainable float32 (no frozen layers, no BatchNormalization)
+    if not isinstance(model, tf.keras.Sequential):
+        return False
+    if model.non_trainable_weights or any(v.dtype != 'float32' for v in model.weights):
+        return False
+    # Feature maps until a Flatten, vectors after it
+    flat = len(model.input_shape) <= 2
+    for layer in _layers(model):
+        name = type(layer).__name__
+        if name not in SUPPORTED_LAYERS or (name in _SPATIAL and flat) or (name == 'Dense' and not flat):
+            return False
+        flat = flat or name == 'Flatten'
+        if name == 'Conv2D' and (layer.data_format != 'channels_last' or layer.groups != 1
+                                 or tuple(layer.dilation_rate) != (1, 1)):
+            return False
+        if name in ('MaxPooling2D', 'AveragePooling2D') and layer.data_format != 'channels_last':
+            return False
+    return True
+
+class BatchedTrainer:
+    # Local training of `clients` models of one architecture as one graph: every
+    # variable is stacked along a leading client axis, convolutions run as one grouped
+    # convolution (a group per client) and dense layers as batched matmuls, so a step
+    # costs a few large kernels instead of many small ones per client. Each client has
+    # its own Adam state (same update as Keras' Adam) and step count, and clients
+    # without data in a step are left unchanged, so the result matches training the
+    # models one by one on the same batches up to float rounding. Feature maps are
+    # kept as [batch, height, width, client, channel], which grouped convolution and
+    # pooling read as [batch, height, width, client * channel] without copying.
+    def __init__(self, model, clients, learning_rate=0.001, beta_1=0.9, beta_2=0.999, epsilon=1e-7, jit_compile=False):
+        if not supports_batched(model):
+            raise ValueError(f'Model {model.name} cannot be trained batched')
+        self.clients = clients
+        self.layers = _layers(model)
+        self.learning_rate, self.beta_1, self.beta_2, self.epsilon = learning_rate, beta_1, beta_2, epsilon
+        self.variables = [tf.Variable(tf.zeros((clients, *v.shape)), name=f'batched_{i}')
+                          for i, v in enumerate(model.trainable_variables)]
+        self._index = {id(v): i for i, v in enumerate(model.trainable_variables)}
+        self._m = [tf.Variable(tf.zeros_like(v)) for v in self.variables]
+        self._v = [tf.Variable(tf.zeros_like(v)) for v in self.variables]
+        self.iterations = tf.Variable(tf.zeros(clients, dtype=tf.int64))
+        self._train_step = tf.function(self._step, jit_compile=jit_compile)
+
+    def load(self, slot, model):
+        # Start client slot from model's weights
+        for stacked, v in zip(self.variables, model.trainable_variables):
+            stacked[slot].assign(v.value)
+
+    def store(self, slot, model):
+        for stacked, v in zip(self.variables, model.trainable_variables):
+            v.assign(stacked[slot])
+
+    def _forward(self, x, training):
+        # x: [clients, batch, ...] -> probabilities [clients, batch, classes]
+        k = self.clients
+        h = tf.transpose(x, [1, *range(2, len(x.shape) - 1), 0, len(x.shape) - 1]) if len(x.shape) > 3 else x
+        flat = len(x.shape) <= 3
+        for layer in self.layers:
+            name = type(layer).__name__
+            if name == 'Conv2D':
+                kernel, bias = self._weights(layer)
+                _, height, width, _, c = h.shape
+                kh, kw, _, f = kernel.shape[1:]
+                grouped = tf.reshape(tf.transpose(kernel, [1, 2, 3, 0, 4]), (kh, kw, c, k * f))
+                h = tf.nn.conv2d(tf.reshape(h, (-1, height, width, k * c)), grouped, layer.strides, layer.padding.upper())
+                if bias is not None:
+                    h = tf.nn.bias_add(h, tf.reshape(bias, (k * f,)))
+                h = tf.reshape(layer.activation(h), (-1, *h.shape[1:3], k, f))
+            elif name in ('MaxPooling2D', 'AveragePooling2D'):
+                _, height, width, _, c = h.shape
+                pool = tf.nn.max_pool2d if name == 'MaxPooling2D' else tf.nn.avg_pool2d
+                h = pool(tf.reshape(h, (-1, height, width, k * c)), layer.pool_size, layer.strides, layer.padding.upper())
+                h = tf.reshape(h, (-1, *h.shape[1:3], k, c))
+            elif name == 'Flatten':
+                if not flat:
+                    # Back to [client, batch, features], flattened in each client's own order
+                    h = tf.transpose(h, [len(h.shape) - 2, 0, *range(1, len(h.shape) - 2), len(h.shape) - 1])
+                    h = tf.reshape(h, (k, -1, int(np.prod(h.shape[2:]))))
+                    flat = True
+            elif name == 'Dense':
+                kernel, bias = self._weights(layer)
+                h = tf.matmul(h, kernel)
+                if bias is not None:
+                    h = h + bias[:, tf.newaxis]
+                h = layer.activation(h)
+            elif name == 'Dropout':
+                if training and layer.rate > 0:
+                    h = tf.nn.dropout(h, layer.rate)
+            else:
+                h = layer(h)
+        return h
+
+    def _weights(self, layer):
+        bias = self.variables[self._index[id(layer.bias)]] if layer.use_bias else None
+        return self.variables[self._index[id(layer.kernel)]], bias
+
+    def _loss(self, x, y, mask):
+        # Per-client mean sparse categorical crossentropy over the unmasked samples,
+        # computed like Keras does from probabilities
+        probs = self._forward(x, training=True)
+        probs = probs / tf.reduce_sum(probs, axis=-1, keepdims=True)
+        probs = tf.clip_by_value(probs, 1e-7, 1 - 1e-7)
+        ce = -tf.math.log(tf.gather(probs, tf.cast(y, tf.int32), axis=-1, batch_dims=2))
+        mask = tf.cast(mask, tf.float32)
+        count = tf.reduce_sum(mask, axis=1)
+        return tf.reduce_sum(ce * mask, axis=1) / tf.maximum(count, 1.0), count
+
+    def _step(self, x, y, mask):
+        with tf.GradientTape() as tape:
+            losses, count = self._loss(x, y, mask)
+            # Clients are independent, so the gradient of the sum is each client's own
+            total = tf.reduce_sum(losses)
+        gradients = tape.gradient(total, self.variables)
+        # Adam with per-client step counts; the rates of clients without samples are 0
+        active = tf.cast(count > 0, tf.float32)
+        steps = self.iterations + tf.cast(active, tf.int64)
+        t = tf.cast(tf.maximum(steps, 1), tf.float32)
+        alpha = active * self.learning_rate * tf.sqrt(1 - tf.pow(self.beta_2, t)) / (1 - tf.pow(self.beta_1, t))
+        for var, grad, m, v in zip(self.variables, gradients, self._m, self._v):
+            shape = (self.clients,) + (1,) * (len(var.shape) - 1)
+            on = tf.reshape(active, shape)
+            m.assign_add((grad - m) * (on * (1 - self.beta_1)))
+            v.assign_add((tf.square(grad) - v) * (on * (1 - self.beta_2)))
+            var.assign_sub(tf.reshape(alpha, shape) * m / (tf.sqrt(v) + self.epsilon))
+        self.iterations.assign(steps)
+        return losses * count, count
+
+    def train(self, dataset):
+        # dataset yields (x, y, mask) stacked over clients (utils.ml.make_stacked_dataset);
+        # returns each client's mean loss and sample count
+        total_loss, samples = np.zeros(self.clients), np.zeros(self.clients)
+        start_time = time.perf_counter()
+        for x, y, mask in dataset:
+            loss, count = self._train_step(x, y, mask)
+            total_loss += loss.numpy()
+            samples += count.numpy()
+        elapsed = time.perf_counter() - start_time
+        n = int((samples > 0).sum())
+        print(f'Trained {n} clients on {int(samples.sum())} samples in {elapsed:.2f} s '
+              f'({samples.sum() / elapsed:.0f} samples/s, {n / elapsed:.1f} client-rounds/s)')
+        return total_loss / np.maximum(samples, 1), samples
+
+class BatchedTraining:
+    # Local training of every client in the process through one BatchedTrainer per
+    # architecture. A client's train() call waits until all clients asked, or `window`
+    # seconds after the first did, and the waiting clients then train together, each
+    # in its own slot (and so with its own optimizer state across rounds).
+    def __init__(self, data, client_ids, window=1.0, executor=None, seed=42):
+        self.data = data
+        self.slots = {ID: slot for slot, ID in enumerate(client_ids)}
+        self.window = window
+        self.executor = executor
+        self.seed = seed
+        self._trainers = {}
+        self._pending = []
+        self._ready = None
+        self._flusher = None
+        self.rounds = 0
+
+    async def train(self, ID, model, indices, batch_size=512):
+        # Train model on the samples at indices of data; returns the client's mean loss
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((ID, model, indices, batch_size, future))
+        if self._flusher is None or self._flusher.done():
+            self._schedule()
+        elif len(self._pending) >= len(self.slots):
+            self._ready.set()
+        return await future
+
+    def _schedule(self):
+        self._ready = asyncio.Event()
+        if len(self._pending) >= len(self.slots):
+            self._ready.set()
+        self._flusher = asyncio.ensure_future(self._flush())
+
+    async def _flush(self):
+        try:
+            await asyncio.wait_for(self._ready.wait(), self.window)
+        except asyncio.TimeoutError:
+            pass
+        pending, self._pending = self._pending, []
+        groups = {}
+        for request in pending:
+            groups.setdefault((architecture_key(request[1]), request[3]), []).append(request)
+        loop = asyncio.get_running_loop()
+        for (arch, batch_size), group in groups.items():
+            try:
+                losses = await loop.run_in_executor(self.executor, self._run, arch, batch_size, group)
+            except Exception as e:
+                for *_, future in group:
+                    future.set_exception(e)
+                continue
+            for (*_, future), loss in zip(group, losses):
+                future.set_result(loss)
+        if self._pending:
+            self._schedule()
+
+    def _run(self, arch, batch_size, group):
+        trainer = self._trainers.get(arch)
+        if trainer is None:
+            trainer = self._trainers[arch] = BatchedTrainer(group[0][1], len(self.slots))
+        shards = [None] * len(self.slots)
+        for ID, model, indices, *_ in group:
+            trainer.load(self.slots[ID], model)
+            shards[self.slots[ID]] = indices
+        x, y = self.data
+        dataset = make_stacked_dataset(x, y, shards, batch_size, seed=self.seed + self.rounds)
+        self.rounds += 1
+        losses, _ = trainer.train(dataset)
+        for ID, model, *_ in group:
+            trainer.store(self.slots[ID], model)
+        return [float(losses[self.slots[ID]]) for ID, *_ in group]
@@ -0,0 +1,69 @@
+import logging
+import mmap
+import os
+import threading
+
+# On-disk cache of decrypted IPFS payloads keyed by CID. A CID names immutable
+# content, so entries never need invalidation, only eviction. Recency is tracked
+# through file mtimes (touched on every hit) so several client processes can share
+# one directory without a common index; eviction drops the least recently used
+# entries once the directory grows past max_bytes.
+class CIDCache:
+    def __init__(self, root='./cache', max_bytes=1 << 30, logger=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.logger = logger or logging.getLogger(__name__)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, cid, kind):
+        return os.path.join(self.root, f'{cid}.{kind}')
+
+    def get(self, cid, kind='bin'):
+        path = self._path(cid, kind)
+        try:
+            with open(path, 'rb') as f:
+                # Memory-mapped, so decoded tensors are views into the page cache
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            data = None
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            self.logger.info(f"Cache {'hit' if data is not None else 'miss'} for {cid}.{kind} (hits: {self.hits}, misses: {self.misses})")
+        return data
+
+    def put(self, cid, data, kind='bin'):
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(cid, kind)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,167 @@
+import math
+import numpy as np
+from utils.weights import encode_weights, decode_weights, decode_weights_with_names, weights_meta
+
+# Compressed client updates. A spec is a comma-separated list of options:
+#   none      full float32 weights (default)
+#   delta     send the difference to the global weights the client started from
+#   topk=F    keep only the fraction F of the delta entries with the largest magnitude
+#   fp16      send values as float16
+#   int8      send values as int8 with one float32 scale per tensor
+# e.g. 'delta,topk=0.01,int8'. What a lossy option does not send is kept on the client
+# and added to its next update (error feedback). Updates travel in the binary weight
+# container with the codec in the header metadata, so the decoder needs no
+# configuration and plain weight payloads decode unchanged.
+QUANTIZATIONS = ('fp16', 'int8')
+
+class CompressionConfig:
+    def __init__(self, delta=False, topk=None, quantize=None):
+        if topk is not None and not delta:
+            raise ValueError('topk sparsification needs delta.')
+        if topk is not None and not 0 < topk <= 1:
+            raise ValueError(f'topk must be a fraction in (0, 1], got {topk}.')
+        if quantize is not None and quantize not in QUANTIZATIONS:
+            raise ValueError(f'Unknown quantization {quantize!r}, expected one of {QUANTIZATIONS}.')
+        self.delta = delta
+        self.topk = topk
+        self.quantize = quantize
+
+    @property
+    def enabled(self):
+        return self.delta or self.quantize is not None
+
+    @property
+    def lossy(self):
+        return self.topk is not None or self.quantize is not None
+
+    def __str__(self):
+        options = ['delta'] if self.delta else []
+        if self.topk is not None:
+            options.append(f'topk={self.topk:g}')
+        if self.quantize is not None:
+            options.append(self.quantize)
+        return ','.join(options) or 'none'
+
+def parse_compression(spec):
+    kwargs = {}
+    for option in (spec or 'none').split(','):
+        name, _, value = option.strip().partition('=')
+        if name == 'none':
+            continue
+        elif name == 'delta':
+            kwargs['delta'] = True
+        elif name == 'topk':
+            kwargs['topk'] = float(value)
+        elif name in QUANTIZATIONS:
+            if 'quantize' in kwargs:
+                raise ValueError('Only one of fp16 and int8 can be used.')
+            kwargs['quantize'] = name
+        else:
+            raise ValueError(f'Unknown compression option: {option!r}')
+    return CompressionConfig(**kwargs)
+
+def _quantize(values, method):
+    if method == 'fp16':
+        return values.astype(np.float16), None
+    if method == 'int8':
+        peak = float(np.max(np.abs(values))) if values.size else 0.0
+        scale = peak / 127 if peak > 0 else 1.0
+        return np.rint(values / scale).astype(np.int8), scale
+    return values, None
+
+def _dequantize(values, scale):
+    values = values.astype(np.float32)
+    if scale is not None:
+        values *= scale
+    return values
+
+class UpdateEncoder:
+    # Per-client encoder: remembers the global weights the local model started from
+    # (set_base after every download) and the error feedback residual across rounds.
+    def __init__(self, config):
+        self.config = config
+        self.base = None
+        self.base_cid = None
+        self.residual = None
+
+    def set_base(self, weights, cid):
+        self.base = [np.array(w, dtype=np.float32) for w in weights]
+        self.base_cid = cid
+
+    def encode(self, weights, names=None, meta=None):
+        # meta: further header metadata of the update, e.g. its sample count
+        config = self.config
+        if not config.enabled:
+            return encode_weights(weights, names, meta)
+        if config.delta and self.base is None:
+            raise ValueError('Delta updates need the global weights, call set_base first.')
+        if names is None:
+            names = [str(i) for i in range(len(weights))]
+        if config.lossy and self.residual is None:
+            self.residual = [np.zeros(np.size(w), dtype=np.float32) for w in weights]
+
+        tensors, tensor_names, layers = [], [], []
+        for i, (name, w) in enumerate(zip(names, weights)):
+            x = np.asarray(w, dtype=np.float32)
+            x = x - self.base[i] if config.delta else x.copy()
+            flat = x.ravel()
+            if self.residual is not None:
+                flat += self.residual[i]
+
+            indices = None
+            if config.topk is not None:
+                k = max(1, math.ceil(config.topk * flat.size))
+                if k < flat.size:
+                    indices = np.sort(np.argpartition(np.abs(flat), flat.size - k)[flat.size - k:]).astype(np.uint32)
+            values = flat if indices is None else flat[indices]
+            values, scale = _quantize(values, config.quantize)
+
+            if self.residual is not None:
+                residual = self.residual[i]
+                residual[:] = flat
+                sent = _dequantize(values, scale)
+                if indices is None:
+                    residual -= sent
+                else:
+                    residual[indices] -= sent
+
+            tensors.append(values)
+            tensor_names.append(f'{name}/values')
+            if indices is not None:
+                tensors.append(indices)
+                tensor_names.append(f'{name}/indices')
+            layers.append({'shape': list(x.shape), 'scale': scale, 'sparse': indices is not None})
+
+        meta = {**(meta or {}), 'update': {'codec': str(config), 'delta': config.delta, 'base': self.base_cid, 'layers': layers}}
+        return encode_weights(tensors, tensor_names, meta)
+
+def update_samples(payload):
+    # Training samples behind a client update, recorded by the client in the header
+    # metadata; None for payloads without one (legacy JSON weights)
+    return weights_meta(payload).get('samples')
+
+def decode_update(payload, base=None, base_cid=None):
+    # Full weights of a client update; base is the global model of the round
+    meta = weights_meta(payload).get('update')
+    if meta is None:
+        return decode_weights(payload)
+    if meta['delta']:
+        if base is None:
+            raise ValueError('Delta update received without the global weights to apply it to.')
+        if base_cid is not None and meta['base'] != base_cid:
+            raise ValueError(f"Update is relative to {meta['base']}, not to the current global model {base_cid}.")
+
+    arrays = iter(decode_weights_with_names(payload)[1])
+    weights = []
+    for i, layer in enumerate(meta['layers']):
+        values = _dequantize(next(arrays), layer['scale'])
+        if layer['sparse']:
+            x = np.zeros(math.prod(layer['shape']), dtype=np.float32)
+            x[next(arrays)] = values
+        else:
+            x = values
+        x = x.reshape(layer['shape'])
+        if meta['delta']:
+            x += base[i]
+        weights.append(x)
+    return weights
@@ -10,6 +10,8 @@ from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import serialization
 
 import binascii
+import os
+import struct
 
 def encrypt(message, key):
     raw = pad(message, 16)
@@ -17,12 +19,150 @@ def encrypt(message, key):
     ciphertext = base64.b64encode(cipher.encrypt(raw))
     return ciphertext
 
-def decrypt(ciphertext, key):
+def decrypt_bytes(ciphertext, key):
     enc = base64.b64decode(ciphertext)
     cipher = AES.new(key, AES.MODE_ECB)
-    message = unpad(cipher.decrypt(enc),16).decode("utf-8", "ignore")
+    return unpad(cipher.decrypt(enc),16)
+
+def decrypt(ciphertext, key):
+    message = decrypt_bytes(ciphertext, key).decode("utf-8", "ignore")
     return message
 
+# Chunked AEAD payload format (STREAM construction over AES-GCM):
+#   header = STREAM_MAGIC | version (u8) | segment size (u32 BE) | random nonce prefix (7B)
+#   segment i = AES-GCM(plaintext_i) || tag (16B), nonce = prefix | i (u32 BE) | last flag (u8)
+# Every segment authenticates the header, and the last-segment flag in the nonce
+# detects truncation. Payloads not starting with STREAM_MAGIC are legacy base64 AES-ECB.
+STREAM_MAGIC = b'\x93W3E'
+STREAM_VERSION = 1
+DEFAULT_SEGMENT_SIZE = 1 << 20
+TAG_SIZE = 16
+_STREAM_HEADER = struct.Struct('>4sBI7s')
+
+class StreamEncryptor:
+    def __init__(self, key, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.key = key
+        self.segment_size = segment_size
+        self.header = _STREAM_HEADER.pack(STREAM_MAGIC, STREAM_VERSION, segment_size, os.urandom(7))
+        self._prefix = self.header[-7:]
+        self._counter = 0
+        self._buf = bytearray()
+        self._started = False
+
+    def _seal(self, segment, last):
+        nonce = self._prefix + struct.pack('>IB', self._counter, last)
+        self._counter += 1
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(self.header)
+        ciphertext, tag = cipher.encrypt_and_digest(segment)
+        return ciphertext + tag
+
+    def _start(self):
+        if self._started:
+            return []
+        self._started = True
+        return [self.header]
+
+    def update(self, data):
+        # Only seal a segment once more data follows it, so the final one is sealed by finalize()
+        out = self._start()
+        self._buf += data
+        n = self.segment_size
+        pos = 0
+        with memoryview(self._buf) as view:
+            while len(self._buf) - pos > n:
+                out.append(self._seal(view[pos:pos + n], last=False))
+                pos += n
+        del self._buf[:pos]
+        return b''.join(out)
+
+    def finalize(self):
+        out = self._start()
+        out.append(self._seal(bytes(self._buf), last=True))
+        self._buf = bytearray()
+        return b''.join(out)
+
+class StreamDecryptor:
+    def __init__(self, key):
+        self.key = key
+        self.header = None
+        self._counter = 0
+        self._buf = bytearray()
+
+    def _open(self, segment, last):
+        nonce = self._prefix + struct.pack('>IB', self._counter, last)
+        self._counter += 1
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(self.header)
+        return cipher.decrypt_and_verify(segment[:-TAG_SIZE], segment[-TAG_SIZE:])
+
+    def _read_header(self):
+        if self.header is None and len(self._buf) >= _STREAM_HEADER.size:
+            magic, version, segment_size, prefix = _STREAM_HEADER.unpack_from(self._buf)
+            if magic != STREAM_MAGIC:
+                raise ValueError('Not a chunked AEAD payload.')
+            if version != STREAM_VERSION:
+                raise ValueError(f'Unsupported AEAD payload version: {version}')
+            self.header = bytes(self._buf[:_STREAM_HEADER.size])
+            self._prefix = prefix
+            self._sealed_size = segment_size + TAG_SIZE
+            del self._buf[:_STREAM_HEADER.size]
+
+    def update(self, data):
+        self._buf += data
+        self._read_header()
+        if self.header is None:
+            return b''
+        out = []
+        n = self._sealed_size
+        pos = 0
+        with memoryview(self._buf) as view:
+            while len(self._buf) - pos > n:
+                out.append(self._open(view[pos:pos + n], last=False))
+                pos += n
+        del self._buf[:pos]
+        return b''.join(out)
+
+    def finalize(self):
+        if self.header is None or len(self._buf) < TAG_SIZE:
+            raise ValueError('Truncated AEAD payload.')
+        message = self._open(bytes(self._buf), last=True)
+        self._buf = bytearray()
+        return message
+
+def iter_encrypt(chunks, key, segment_size=DEFAULT_SEGMENT_SIZE):
+    encryptor = StreamEncryptor(key, segment_size)
+    for chunk in chunks:
+        out = encryptor.update(chunk)
+        if out:
+            yield out
+    yield encryptor.finalize()
+
+def iter_decrypt(chunks, key):
+    decryptor = StreamDecryptor(key)
+    for chunk in chunks:
+        out = decryptor.update(chunk)
+        if out:
+            yield out
+    yield decryptor.finalize()
+
+def iter_slices(data, size=DEFAULT_SEGMENT_SIZE):
+    view = memoryview(data)
+    for pos in range(0, len(view), size):
+        yield view[pos:pos + size]
+
+def is_stream_payload(data):
+    return bytes(data[:len(STREAM_MAGIC)]) == STREAM_MAGIC
+
+def encrypt_payload(message, key, segment_size=DEFAULT_SEGMENT_SIZE):
+    return b''.join(iter_encrypt(iter_slices(message, segment_size), key, segment_size))
+
+def decrypt_payload(ciphertext, key):
+    if not is_stream_payload(ciphertext):
+        return decrypt_bytes(ciphertext, key)
+    decryptor = StreamDecryptor(key)
+    return decryptor.update(ciphertext) + decryptor.finalize()
+
 def generate_key():
     # Generate Alice's private and public key pair
     private_key = ec.generate_private_key(ec.SECP256K1(), default_backend())
@@ -55,14 +195,8 @@ def load_private_key_from_hex(hex_str):
 def load_public_key_from_hex(hex_str):
     if not hex_str.startswith("04"):
         raise ValueError("Public key must be in uncompressed format (starts with '04').")
-    
-    public_key_bytes = bytes.fromhex(hex_str)
-    x = int.from_bytes(public_key_bytes[1:33], byteorder="big")
-    y = int.from_bytes(public_key_bytes[33:], byteorder="big")
-    
-    public_numbers = ec.EllipticCurvePublicNumbers(x, y, ec.SECP256K1())
-    public_key = public_numbers.public_key(default_backend())
-    return public_key
+    # The SEC1 point is decoded and checked to lie on the curve by OpenSSL
+    return ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256K1(), bytes.fromhex(hex_str))
 
 def achieve_shared_secret(a_private_key, b_public_key):
     shared_secret = a_private_key.exchange(ec.ECDH(), b_public_key)
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+from web3 import AsyncWeb3, Web3, WebSocketProvider
+
+def _normalize(value):
+    if isinstance(value, str) and value.startswith('0x') and len(value) == 42:
+        return Web3.to_checksum_address(value)
+    return value
+
+def _uint_topic(value):
+    return '0x' + format(value, '064x')
+
+class EventDispatcher:
+    # One log subscription per node connection, shared by every client in the process.
+    # Logs are filtered by the node on event signature (topic 0) and the indexed
+    # projectId (topic 2); remaining indexed args are matched by a dict lookup when
+    # routing a log to the futures of the clients waiting for it. Logs arrive through
+    # eth_subscribe when a WebSocket endpoint is configured, otherwise (or when the
+    # subscription drops) through eth_getLogs polling whose interval backs off while
+    # nothing arrives and snaps back as soon as a log does or a client expects one.
+    def __init__(self, w3, contract, project_ids, event_names=('GlobalModelUpdated', 'EncryptedKey'),
+                 ws_url=None, min_interval=0.05, max_interval=2.0, logger=None):
+        self.w3 = w3
+        self.contract = contract
+        self.ws_url = ws_url
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self._events = {getattr(contract.events, name).topic: getattr(contract.events, name)() for name in event_names}
+        self._filter = {
+            'address': contract.address,
+            'topics': [list(self._events), None, [_uint_topic(pid) for pid in project_ids]],
+        }
+        # event name -> tuple of arg names -> tuple of arg values -> [(future, accept)]
+        self._waiters = {name: {} for name in event_names}
+        # event name -> [(args, callback)], called for every matching log
+        self._listeners = {name: [] for name in event_names}
+        self._has_waiters = asyncio.Event()
+        # Poll interval, and an event cutting the current poll sleep short
+        self._interval = min_interval
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def expect(self, event_name, accept=None, **args):
+        # Register interest before triggering the transaction that causes the event,
+        # so that a fast reply cannot slip past; await the returned future for the event.
+        # accept(event_args) can reject a matching event (e.g. a late reply to an older
+        # request), which leaves the future waiting for the next one.
+        names = tuple(sorted(args))
+        values = tuple(_normalize(args[n]) for n in names)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[event_name].setdefault(names, {}).setdefault(values, []).append((future, accept))
+        self._has_waiters.set()
+        # The reply may come within a block or two: poll at the fastest rate again now,
+        # not after the sleep of a backed-off interval
+        self._interval = self.min_interval
+        self._wake.set()
+        return future
+
+    async def wait_for(self, event_name, accept=None, **args):
+        return await self.expect(event_name, accept, **args)
+
+    def listen(self, event_name, callback, **args):
+        # Persistent handler, e.g. for the manager reacting to every AchieveKey
+        args = {n: _normalize(v) for n, v in args.items()}
+        self._listeners[event_name].append((args, callback))
+        self._has_waiters.set()
+
+    def _pending(self):
+        # Futures cancelled by their client (e.g. after a timeout) no longer count
+        return any(self._listeners.values()) or any(
+            not future.done() for by_names in self._waiters.values()
+            for by_values in by_names.values() for futures in by_values.values() for future, _ in futures)
+
+    def _route(self, log):
+        handler = self._events.get(Web3.to_hex(log['topics'][0]))
+        if handler is None:
+            return
+        event = handler.process_log(log)
+        for names, by_values in self._waiters[event['event']].items():
+            values = tuple(_normalize(event['args'][n]) for n in names)
+            waiting = []
+            for future, accept in by_values.pop(values, []):
+                if future.done():
+                    continue
+                if accept is None or accept(event['args']):
+                    future.set_result(event)
+                else:
+                    waiting.append((future, accept))
+            if waiting:
+                by_values[values] = waiting
+        for args, callback in self._listeners[event['event']]:
+            if all(_normalize(event['args'][n]) == v for n, v in args.items()):
+                callback(event)
+        if not self._pending():
+            self._has_waiters.clear()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        from_block = await asyncio.to_thread(lambda: self.w3.eth.block_number) + 1
+        while True:
+            if self.ws_url:
+                try:
+                    from_block = await self._subscribe(from_block)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.logger.warning(f'Log subscription over {self.ws_url} failed ({e}), polling eth_getLogs instead.')
+                    self.ws_url = None
+            from_block = await self._poll(from_block)
+
+    async def _subscribe(self, from_block):
+        async with AsyncWeb3(WebSocketProvider(self.ws_url)) as aw3:
+            await aw3.eth.subscribe('logs', self._filter)
+            # Catch up on anything mined before the subscription became active
+            from_block, _ = await self._fetch(from_block)
+            async for message in aw3.socket.process_subscriptions():
+                log = message['result']
+                from_block = max(from_block, log['blockNumber'] + 1)
+                self._route(log)
+        return from_block
+
+    async def _fetch(self, from_block):
+        head = await asyncio.to_thread(lambda: self.w3.eth.block_number)
+        if head < from_block:
+            return from_block, 0
+        logs = await asyncio.to_thread(self.w3.eth.get_logs, {**self._filter, 'fromBlock': from_block, 'toBlock': head})
+        for log in logs:
+            self._route(log)
+        return head + 1, len(logs)
+
+    async def _poll(self, from_block):
+        self._interval = self.min_interval
+        while True:
+            if not self._has_waiters.is_set():
+                head = await asyncio.to_thread(lambda: self.w3.eth.block_number)
+                try:
+                    await asyncio.wait_for(self._has_waiters.wait(), self.max_interval)
+                except asyncio.TimeoutError:
+                    # Nobody was waiting: only follow the head, so that a later waiter
+                    # is not handed a log mined long before it registered. Only up to
+                    # the head seen before the wait, so a log mined while a client was
+                    # about to expect() it is still fetched
+                    from_block = max(from_block, head + 1)
+                    continue
+                self._interval = self.min_interval
+            self._wake.clear()
+            from_block, received = await self._fetch(from_block)
+            self._interval = self.min_interval if received else min(self._interval * 2, self.max_interval)
+            try:
+                await asyncio.wait_for(self._wake.wait(), self._interval)
+            except asyncio.TimeoutError:
+                pass
@@ -1,70 +1,306 @@
-from ipfshttpclient import connect
-import tensorflow as tf
-import tensorflowjs as tfjs
+import contextlib
+import io
+import os
+import queue
+import threading
 import json
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.saving import register_keras_serializable
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from utils.crypto import encrypt, decrypt
+from utils.lazy import lazy_import
+from utils.ml import model_from_json
+from utils.trace import phase, timed_chunks
+from utils.crypto import encrypt, decrypt_bytes, StreamDecryptor, iter_encrypt, iter_slices, is_stream_payload, STREAM_MAGIC
+from utils.weights import WEIGHT_FORMATS, WeightLayout, serialize_weights, decode_weights, encode_weights, is_binary_weights, weights_header
+from utils.manifest import (DEFAULT_CHUNK_SIZE, is_manifest, chunk_digest, plan_chunks, chunk_span, encode_manifest,
+                            decode_manifest, chunk_tensors, tensor_views, held_chunk)
+
+# Loaded on first use; tensorflowjs is only needed by upload_model_to_ipfs
+ipfshttpclient = lazy_import('ipfshttpclient')
+tf = lazy_import('tensorflow')
+tfjs = lazy_import('tensorflowjs')
+
+CIPHER_SCHEMES = ('aead', 'ecb')
+# How global weights are stored: one encrypted payload, or a manifest of chunks (utils.manifest)
+WEIGHT_STORAGE = ('blob', 'manifest')
+
+class ClientPool:
+    # Persistent ipfshttpclient clients (one keep-alive HTTP session each), created
+    # lazily on first use and shared by every helper in this module. At most `size`
+    # clients exist; each is lent to one thread at a time, so emulated clients
+    # running in threads of one process can share the pool safely.
+    def __init__(self, size=4, addr=None, **kwargs):
+        self.size = size
+        self.addr = addr
+        self.kwargs = kwargs
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextlib.contextmanager
+    def client(self):
+        with self._slots:
+            try:
+                client = self._idle.get_nowait()
+            except queue.Empty:
+                client = ipfshttpclient.connect(self.addr or ipfshttpclient.DEFAULT_ADDR, session=True, **self.kwargs)
+            try:
+                yield client
+            except BaseException:
+                # The session may be left mid-response, do not hand it out again
+                client.close()
+                raise
+            self._idle.put(client)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def configure_pool(size=4, addr=None, **kwargs):
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = ClientPool(size, addr, **kwargs)
+    return _pool
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ClientPool()
+        return _pool
+
+class ChunkReader(io.RawIOBase):
+    # File-like view over a generator of byte chunks, so that ipfshttpclient can
+    # stream a payload that is still being produced (e.g. encrypted on the fly)
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._pending:
+            self._pending = next(self._chunks, None)
+            if self._pending is None:
+                self._pending = b''
+                return 0
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+def add_encrypted(client, message, aesKey, scheme='aead'):
+    if scheme == 'ecb':
+        with phase('encrypt'):
+            ciphertext = encrypt(message, aesKey)
+        return client.add_bytes(ciphertext)
+    if scheme != 'aead':
+        raise ValueError(f'Unknown cipher scheme: {scheme}')
+    # Segments are encrypted as the multipart body is being sent
+    result = client.add(ChunkReader(timed_chunks(iter_encrypt(iter_slices(message), aesKey), 'encrypt')))
+    return result['Hash']
+
+def cat_decrypted(client, hash_value, aesKey):
+    chunks = iter(client.cat(hash_value, stream=True))
+    # The format is told by the magic bytes, which may span several chunks
+    first = b''
+    for chunk in chunks:
+        first += chunk
+        if len(first) >= len(STREAM_MAGIC):
+            break
+    if not is_stream_payload(first):
+        # Legacy base64 AES-ECB payload can only be decrypted once complete
+        ciphertext = b''.join([first, *chunks])
+        with phase('decrypt'):
+            return decrypt_bytes(ciphertext, aesKey)
+    # Segments are authenticated and decrypted as they arrive
+    decryptor = StreamDecryptor(aesKey)
+    with phase('decrypt'):
+        out = [decryptor.update(first)]
+    for chunk in chunks:
+        with phase('decrypt'):
+            out.append(decryptor.update(chunk))
+    with phase('decrypt'):
+        out.append(decryptor.finalize())
+    return b''.join(out)
 
 def upload_weight_to_ipfs(model):
     weights = model.get_weights()
     weights_json = [w.ravel().tolist() for w in weights]
-    client = connect()
-    result = client.add_json(weights_json)
+    with get_pool().client() as client:
+        result = client.add_json(weights_json)
     return result
 
-def enc_upload_weight_to_ipfs(model, aesKey):
-    weights = model.get_weights()
-    weights_list = [w.ravel().tolist() for w in weights]
-    weights_json = json.dumps(weights_list)
-    ciphertext = encrypt(weights_json.encode(), aesKey)
-    client = connect()
-    result = client.add_bytes(ciphertext)
+def _assign(local_model, arrays):
+    for variable, value in zip(local_model.weights, arrays):
+        variable.assign(value)
+    return local_model
+
+def assign_weights(local_model, weightsArr):
+    # Payloads hold model.get_weights(), i.e. every variable including non-trainable
+    # ones such as BatchNormalization statistics, in model.weights order
+    return _assign(local_model, WeightLayout.of(local_model).arrange(weightsArr))
+
+def assign_payload(local_model, payload, cache=None):
+    # A payload written from the same architecture is assigned straight from views
+    # into it, so the variables' assign is the only copy
+    if is_manifest(payload):
+        return assign_manifest(local_model, decode_manifest(payload), cache)
+    return _assign(local_model, WeightLayout.of(local_model).load(payload))
+
+def fetch_chunk(chunk, cache=None):
+    # Decrypted plaintext of a manifest chunk; the shared cache is keyed by content
+    # digest, so a chunk fetched by any client on this host (or in an earlier round)
+    # is not fetched again
+    data = cache.get(chunk['sha256'], kind='chunk') if cache is not None else None
+    if data is None:
+        with get_pool().client() as client:
+            data = cat_decrypted(client, chunk['cid'], bytes.fromhex(chunk['key']))
+        if chunk_digest(data) != chunk['sha256']:
+            raise ValueError(f"Chunk {chunk['cid']} does not match its manifest digest")
+        if cache is not None:
+            cache.put(chunk['sha256'], data, kind='chunk')
+    return data
+
+def assign_manifest(local_model, manifest, cache=None):
+    # Chunks are fetched in parallel and their tensors assigned as each one arrives.
+    # Chunks of non-trainable variables are compared with the model first and not
+    # fetched when unchanged (frozen layers, statistics left alone by training).
+    layout = WeightLayout.of(local_model)
+    tensors = manifest['tensors']
+    if len(tensors) != len(layout):
+        raise ValueError(f'Expected {len(layout)} weight tensors, got {len(tensors)}')
+    variables = local_model.weights
+    pending = []
+    for chunk in manifest['chunks']:
+        indices = chunk_tensors(manifest, chunk)
+        if not any(variables[i].trainable for i in indices):
+            current = {i: variables[i].numpy() for i in indices}
+            if chunk_digest(held_chunk(manifest, chunk, current)) == chunk['sha256']:
+                continue
+        pending.append(chunk)
+    with ThreadPoolExecutor(max(1, min(get_pool().size, len(pending)))) as executor:
+        futures = {executor.submit(fetch_chunk, chunk, cache): chunk for chunk in pending}
+        remaining = as_completed(futures)
+        with phase('first_chunk'):
+            done = next(remaining, None)
+        while done is not None:
+            with phase('assign'):
+                for i, arr in tensor_views(manifest, futures[done], done.result()):
+                    variables[i].assign(np.reshape(arr, layout.shapes[i]))
+            with phase('fetch'):
+                done = next(remaining, None)
+    return local_model
+
+def enc_upload_bytes_to_ipfs(message, aesKey, scheme='aead'):
+    with get_pool().client() as client:
+        result = add_encrypted(client, message, aesKey, scheme)
     return result
 
+def enc_upload_weight_to_ipfs(model, aesKey, fmt='binary', scheme='aead'):
+    return enc_upload_bytes_to_ipfs(serialize_weights(model, fmt), aesKey, scheme)
+
+def enc_upload_manifest_to_ipfs(model, aesKey, scheme='aead', previous=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Weights as chunks encrypted under keys of their own, stored in parallel, plus the
+    # manifest encrypted with aesKey. Chunks listed in previous (digest -> chunk, as
+    # returned for an earlier upload) are referenced instead of stored again. Returns
+    # the manifest CID and the chunks of this upload by digest.
+    payload = serialize_weights(model, 'binary')
+    header, data_start = weights_header(payload)
+    tensors = header['tensors']
+    previous = previous or {}
+
+    def store(tensor_range):
+        start, end = chunk_span(tensors, *tensor_range)
+        data = memoryview(payload)[data_start + start:data_start + end]
+        digest = chunk_digest(data)
+        chunk = previous.get(digest)
+        if chunk is None:
+            key = os.urandom(32)
+            with get_pool().client() as client:
+                chunk = {'cid': add_encrypted(client, data, key), 'key': key.hex(), 'sha256': digest}
+        return {**chunk, 'offset': start, 'nbytes': end - start}
+
+    ranges = plan_chunks(tensors, chunk_size, [v.trainable for v in model.weights])
+    with ThreadPoolExecutor(max(1, min(get_pool().size, len(ranges)))) as executor:
+        chunks = list(executor.map(store, ranges))
+    manifest_hash = enc_upload_bytes_to_ipfs(encode_manifest(header, chunks), aesKey, scheme)
+    return manifest_hash, {c['sha256']: {k: c[k] for k in ('cid', 'key', 'sha256')} for c in chunks}
+
 def load_weight_from_ipfs(hash_value, local_model):
-    client = connect()
-    weightsArr_json = client.cat(hash_value)
-    
-    weightsArr = json.loads(weightsArr_json)
-    for i, layer in enumerate(local_model.trainable_weights):
-        layer.assign(tf.constant(weightsArr[i], shape=layer.shape, dtype='float32'))
+    with get_pool().client() as client:
+        payload = client.cat(hash_value)
+    return assign_payload(local_model, payload)
 
-    return local_model
+def fetch_decrypted_payload(hash_value, aesKey, cache=None):
+    payload = cache.get(hash_value) if cache is not None else None
+    if payload is None:
+        with get_pool().client() as client:
+            payload = cat_decrypted(client, hash_value, aesKey)
+        if cache is not None:
+            # Legacy JSON payloads are stored in the binary format so hits decode zero-copy
+            if not is_binary_weights(payload) and not is_manifest(payload):
+                payload = encode_weights(decode_weights(payload))
+            cache.put(hash_value, payload)
+    return payload
 
-def dec_load_weight_from_ipfs(hash_value, local_model, aesKey):
-    register_keras_serializable()(Sequential)
-    client = connect()
-    enc = client.cat(hash_value).decode('utf-8')
-    weightsArr_json = decrypt(enc, aesKey)
-    weightsArr = json.loads(weightsArr_json)
-    for i, layer in enumerate(local_model.trainable_weights):
-        layer.assign(tf.constant(weightsArr[i], shape=layer.shape, dtype='float32'))
+def fetch_manifest_weights(manifest, cache=None):
+    # Every tensor of a manifest, its chunks fetched in parallel
+    weights = [None] * len(manifest['tensors'])
+    with ThreadPoolExecutor(max(1, min(get_pool().size, len(manifest['chunks'])))) as executor:
+        for chunk, data in zip(manifest['chunks'], executor.map(lambda c: fetch_chunk(c, cache), manifest['chunks'])):
+            for i, arr in tensor_views(manifest, chunk, data):
+                weights[i] = arr
+    return weights
 
-    return local_model
+def fetch_decrypted_weights(hash_value, aesKey, cache=None):
+    payload = fetch_decrypted_payload(hash_value, aesKey, cache)
+    if is_manifest(payload):
+        return fetch_manifest_weights(decode_manifest(payload), cache)
+    return decode_weights(payload)
+
+def dec_load_weight_from_ipfs(hash_value, local_model, aesKey, cache=None):
+    tf.keras.utils.register_keras_serializable()(tf.keras.models.Sequential)
+    return assign_payload(local_model, fetch_decrypted_payload(hash_value, aesKey, cache))
 
 def upload_model_to_ipfs(model):
     # json_string = model.to_json()
     json_string = tfjs.converters.serialize_keras_model(model).decode('utf-8')
-    client = connect()
-    result = client.add_json(json_string)
+    with get_pool().client() as client:
+        result = client.add_json(json_string)
+    return result
+
+def enc_upload_model_to_ipfs(model, aesKey, scheme='aead'):
+    with get_pool().client() as client:
+        result = add_encrypted(client, model.to_json().encode(), aesKey, scheme)
     return result
 
-def dec_load_model_from_ipfs(hash_value, aesKey):
-    client = connect()
-    enc = client.cat(hash_value).decode('utf-8')
-    result = decrypt(enc, aesKey)
+def dec_load_model_from_ipfs(hash_value, aesKey, cache=None):
+    payload = cache.get(hash_value, kind='json') if cache is not None else None
+    if payload is None:
+        with get_pool().client() as client:
+            payload = cat_decrypted(client, hash_value, aesKey)
+        if cache is not None:
+            cache.put(hash_value, payload, kind='json')
+    result = bytes(payload).decode('utf-8')
     # load model by tfjs.converters.deserialize_keras_model
     # loaded_model = tf.keras.models.model_from_json(result)
     custom_objects = {'Sequential': tf.keras.models.Sequential}
     # loaded_model = tfjs.converters.deserialize_keras_model(result)
-    loaded_model = tf.keras.models.model_from_json(result, custom_objects=custom_objects)
+    loaded_model = model_from_json(result, custom_objects=custom_objects)
     loaded_model.summary()
     return loaded_model
 
 def load_model_from_ipfs(hash_value):
-    client = connect()
-    result = client.cat(hash_value)
-    loaded_model = tf.keras.models.model_from_json(result)
+    with get_pool().client() as client:
+        result = client.cat(hash_value)
+    loaded_model = model_from_json(result)
     return loaded_model
\ No newline at end of file
@@ -0,0 +1,96 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from utils.crypto import load_private_key_from_hex, load_public_key_from_hex, achieve_shared_secret
+from utils.session import session_keys, wrap_key
+
+def _derive(private_key_hex, public_key_hexes):
+    # Runs in a worker process (key objects do not pickle, so keys travel as hex).
+    # A malformed client key gives None instead of failing the whole batch.
+    private_key = load_private_key_from_hex(private_key_hex)
+    secrets = []
+    for public_key_hex in public_key_hexes:
+        try:
+            secrets.append(achieve_shared_secret(private_key, load_public_key_from_hex(public_key_hex)))
+        except ValueError:
+            secrets.append(None)
+    return secrets
+
+class KeyDistributor:
+    # Wraps the round key for every client that joined: an ECDH shared secret with the
+    # manager's key per client, then the AES key encrypted under it. Secrets are cached
+    # per (client PK, manager PK), so a client only costs an ECDH the first time it
+    # joins; batches of new keys at least min_batch long are split across worker
+    # processes, smaller ones are derived in a thread. Round keys are wrapped and
+    # uploads decrypted with session keys of the given scheme (utils.session).
+    def __init__(self, private_key_hex, public_key_hex, workers=4, min_batch=32, scheme='raw', sessions=session_keys):
+        self._private_key_hex = private_key_hex
+        self.public_key_hex = public_key_hex
+        self.scheme = scheme
+        self.sessions = sessions
+        self.workers = workers
+        self.min_batch = min_batch
+        self._secrets = {}
+        self._pool = None
+
+    def _executor(self):
+        if self._pool is None:
+            # forkserver workers neither inherit the manager's threads nor re-import its
+            # entry point (and TensorFlow) the way spawn would
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['utils.keydist'])
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=context)
+        return self._pool
+
+    def start(self):
+        # Start the worker processes ahead of the first large batch
+        if self.workers > 1:
+            for _ in range(self.workers):
+                self._executor().submit(int)
+
+    def cached(self, client_pk):
+        return self._secrets.get((client_pk, self.public_key_hex))
+
+    def shared_key(self, client_pk):
+        secret = self.cached(client_pk)
+        if secret is None:
+            secret = _derive(self._private_key_hex, [client_pk])[0]
+            if secret is None:
+                raise ValueError(f'Invalid client public key: {client_pk}')
+            self._secrets[(client_pk, self.public_key_hex)] = secret
+        return secret
+
+    def session_keys(self, client_pk, project_id, peer, iteration):
+        return self.sessions.get(self.scheme, self.shared_key(client_pk), project_id, peer, iteration)
+
+    async def derive(self, client_pks):
+        # Shared secret of every key in client_pks (None for malformed ones)
+        missing = list(dict.fromkeys(pk for pk in client_pks if self.cached(pk) is None))
+        if missing:
+            if self.workers > 1 and len(missing) >= self.min_batch:
+                loop = asyncio.get_running_loop()
+                n = min(self.workers, len(missing) // (self.min_batch // 2 or 1))
+                chunks = [missing[i * len(missing) // n:(i + 1) * len(missing) // n] for i in range(n)]
+                results = await asyncio.gather(*(loop.run_in_executor(self._executor(), _derive, self._private_key_hex, chunk)
+                                                 for chunk in chunks))
+                secrets = [secret for result in results for secret in result]
+            else:
+                secrets = await asyncio.to_thread(_derive, self._private_key_hex, missing)
+            for pk, secret in zip(missing, secrets):
+                if secret is not None:
+                    self._secrets[(pk, self.public_key_hex)] = secret
+        return [self.cached(pk) for pk in client_pks]
+
+    async def wrap(self, aes_key, client_pks, project_id=None, sessions=None):
+        # encryptedKey argument of updateEncryptedKey for every client (None for
+        # malformed keys); sessions holds the (client address, iteration) of every key,
+        # which only the hkdf-v1 scheme needs
+        secrets = await self.derive(client_pks)
+        sessions = sessions or [(None, None)] * len(client_pks)
+        return [wrap_key(aes_key, self.sessions.get(self.scheme, secret, project_id, peer, iteration), self.scheme)
+                if secret is not None else None for secret, (peer, iteration) in zip(secrets, sessions)]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
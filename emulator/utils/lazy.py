@@ -0,0 +1,33 @@
+import importlib
+import threading
+
+class LazyModule:
+    # Stand-in for a heavy module (tensorflow, tensorflowjs, ipfshttpclient) that is
+    # imported on the first attribute access, so importing our modules stays cheap and
+    # a process only pays for what it actually uses.
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f'<lazy module {self._name!r} ({state})>'
+
+def lazy_import(name):
+    return LazyModule(name)
+
+def preload(*names):
+    # Import in a background thread, e.g. TensorFlow while a client is still waiting
+    # on the chain; a first use that comes earlier simply waits on the import lock
+    thread = threading.Thread(target=lambda: [importlib.import_module(name) for name in names],
+                              name='preload', daemon=True)
+    thread.start()
+    return thread
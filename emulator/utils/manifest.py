@@ -0,0 +1,81 @@
+import hashlib
+import json
+import struct
+import numpy as np
+
+# Weights stored as a manifest of separately encrypted chunks instead of one blob:
+#   MANIFEST_MAGIC | version (u8) | manifest JSON
+# The JSON keeps the tensor list of the binary weight container ('tensors', offsets
+# relative to its data section) and its layout signature, plus the chunks that data
+# section is cut into:
+#   {"cid": ..., "key": <hex AES key>, "sha256": <hex digest of the plaintext>,
+#    "offset": n, "nbytes": n}
+# A chunk holds whole tensors, consecutive in model.weights order, and is its own
+# AEAD payload under a random key of its own, so a chunk whose content did not change
+# keeps its CID across rounds even though every round has a new round key; only the
+# manifest is encrypted with that. Readers fetch chunks in parallel, assign tensors as
+# their chunk arrives, and skip chunks whose digest matches what they already hold.
+MANIFEST_MAGIC = b'\x93W3M'
+MANIFEST_VERSION = 1
+DEFAULT_CHUNK_SIZE = 1 << 20
+_PREFIX = struct.Struct('<4sB')
+
+def is_manifest(payload):
+    return bytes(payload[:len(MANIFEST_MAGIC)]) == MANIFEST_MAGIC
+
+def chunk_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def plan_chunks(tensors, chunk_size=DEFAULT_CHUNK_SIZE, trainable=None):
+    # (first, end) index ranges of consecutive tensors, cut once a chunk reaches
+    # chunk_size and wherever trainability changes, so frozen variables and
+    # non-trainable statistics end up in chunks of their own
+    ranges = []
+    first, size = 0, 0
+    for i, t in enumerate(tensors):
+        if i > first and (size >= chunk_size or (trainable is not None and trainable[i] != trainable[i - 1])):
+            ranges.append((first, i))
+            first, size = i, 0
+        size += t['nbytes']
+    if tensors:
+        ranges.append((first, len(tensors)))
+    return ranges
+
+def chunk_span(tensors, first, end):
+    # Byte range of tensors[first:end] in the data section, without trailing padding
+    return tensors[first]['offset'], tensors[end - 1]['offset'] + tensors[end - 1]['nbytes']
+
+def encode_manifest(header, chunks):
+    manifest = {'tensors': header['tensors'], 'layout': header.get('layout'), 'chunks': chunks}
+    return _PREFIX.pack(MANIFEST_MAGIC, MANIFEST_VERSION) + json.dumps(manifest, separators=(',', ':')).encode()
+
+def decode_manifest(payload):
+    _, version = _PREFIX.unpack_from(payload, 0)
+    if version != MANIFEST_VERSION:
+        raise ValueError(f'Unsupported manifest version: {version}')
+    return json.loads(bytes(payload[_PREFIX.size:]))
+
+def chunk_tensors(manifest, chunk):
+    # Indices of the tensors stored in chunk
+    start, end = chunk['offset'], chunk['offset'] + chunk['nbytes']
+    return [i for i, t in enumerate(manifest['tensors']) if start <= t['offset'] < end]
+
+def tensor_views(manifest, chunk, data):
+    # (index, array) of every tensor in a chunk's plaintext, without copying
+    views = []
+    for i in chunk_tensors(manifest, chunk):
+        t = manifest['tensors'][i]
+        dtype = np.dtype(t['dtype'])
+        arr = np.frombuffer(data, dtype=dtype, count=t['nbytes'] // dtype.itemsize, offset=t['offset'] - chunk['offset'])
+        views.append((i, arr.reshape(t['shape'])))
+    return views
+
+def held_chunk(manifest, chunk, arrays):
+    # Plaintext the chunk would have if it held arrays (indexed like the manifest's
+    # tensors), to compare digests with what a reader already has
+    data = bytearray(chunk['nbytes'])
+    for i in chunk_tensors(manifest, chunk):
+        t = manifest['tensors'][i]
+        start = t['offset'] - chunk['offset']
+        data[start:start + t['nbytes']] = np.ascontiguousarray(arrays[i], dtype=t['dtype']).tobytes()
+    return data
@@ -1,7 +1,21 @@
-import tensorflow as tf
 import numpy as np
-from sklearn.metrics import confusion_matrix, precision_score, recall_score, f1_score
-from sklearn.model_selection import train_test_split
+import fcntl
+import hashlib
+import json
+import os
+import platform
+import time
+from utils.lazy import lazy_import
+
+tf = lazy_import('tensorflow')
+
+PARTITIONS = ('iid', 'dirichlet')
+ENGINES = ('fit', 'compiled', 'batched', 'pool')
+PRECISIONS = ('float32', 'mixed_bfloat16', 'mixed_float16')
+BATCH_CANDIDATES = (32, 64, 128, 256, 512, 1024)
+# Smallest Dirichlet shard, and how often the proportions are redrawn to reach it
+MIN_SHARD_SIZE = 10
+PARTITION_ATTEMPTS = 100
 
 def create_model():
     model = tf.keras.Sequential([
@@ -13,46 +27,360 @@ def create_model():
         tf.keras.layers.Dense(units=128, activation='relu'),
         tf.keras.layers.Dense(units=10, activation='softmax')
     ])
-    model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
+    model.compile(optimizer='adam', loss='sparse_categorical_crossentropy', metrics=['accuracy'])
     return model
 
 def load_mnist_dataset():
-    # load data
+    # Raw uint8 images with a channel axis and integer labels; scaling to float32
+    # happens per batch in the input pipeline, so no float or one-hot copy is kept
     (x_train, y_train), (x_test, y_test) = tf.keras.datasets.mnist.load_data()
+    return (x_train[..., np.newaxis], y_train), (x_test[..., np.newaxis], y_test)
+
+def prepare_mnist_memmap(root='./data'):
+    # Normalised float32 MNIST written once as .npy files that every client process
+    # on the host maps read-only, so the pages are shared through the page cache and
+    # later runs skip decoding and scaling. The lock keeps concurrently starting
+    # processes from preparing it twice; the ready marker is written last.
+    path = os.path.join(root, 'mnist')
+    ready = os.path.join(path, 'ready')
+    if os.path.exists(ready):
+        return path
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(root, 'mnist.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(ready):
+            (x_train, y_train), (x_test, y_test) = load_mnist_dataset()
+            arrays = {'x_train': x_train, 'y_train': y_train, 'x_test': x_test, 'y_test': y_test}
+            for name, arr in arrays.items():
+                if name.startswith('x'):
+                    arr = arr.astype(np.float32) / 255
+                tmp = os.path.join(path, f'{name}.tmp.npy')
+                np.save(tmp, arr)
+                os.replace(tmp, os.path.join(path, f'{name}.npy'))
+            open(ready, 'w').close()
+    return path
+
+def load_mnist_memmap(root='./data'):
+    path = prepare_mnist_memmap(root)
+    load = lambda name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+    return (load('x_train'), load('y_train')), (load('x_test'), load('y_test'))
+
+def partition_indices(labels, num_shards, shard_id, method='iid', alpha=0.5, seed=42, min_size=MIN_SHARD_SIZE):
+    # Sample indices of one client's shard. Every process draws the same partition
+    # from the shared seed, so shards of different clients never overlap.
+    #   iid        a random permutation cut into num_shards equal parts;
+    #   dirichlet  each class is split between shards in proportions drawn from
+    #              Dir(alpha), so smaller alpha gives more skewed label mixes. The
+    #              proportions are redrawn until every shard has min_size samples.
+    rng = np.random.default_rng(seed)
+    if method == 'iid':
+        return np.sort(np.array_split(rng.permutation(len(labels)), num_shards)[shard_id])
+    if method == 'dirichlet':
+        if num_shards * min_size > len(labels):
+            raise ValueError(f'{len(labels)} samples cannot give {num_shards} shards of at least {min_size} samples.')
+        classes = np.unique(labels)
+        for _ in range(PARTITION_ATTEMPTS):
+            splits, sizes = [], np.zeros(num_shards, dtype=int)
+            for c in classes:
+                idx = rng.permutation(np.flatnonzero(labels == c))
+                proportions = rng.dirichlet(np.full(num_shards, alpha))
+                # As in the usual Dirichlet partitioners, shards that already hold their
+                # even share get no more samples, which keeps most draws above min_size
+                proportions[sizes >= len(labels) / num_shards] = 0
+                if proportions.sum() == 0:
+                    # Every open shard's proportion underflowed (tiny alpha); draw again
+                    break
+                proportions /= proportions.sum()
+                cuts = (np.cumsum(proportions) * len(idx)).astype(int)[:-1]
+                splits.append(np.split(idx, cuts))
+                sizes += [len(part) for part in splits[-1]]
+            if len(splits) == len(classes) and sizes.min() >= min_size:
+                return np.sort(np.concatenate([split[shard_id] for split in splits]))
+        raise ValueError(f'No Dirichlet partition with alpha={alpha} gives all {num_shards} shards at least {min_size} '
+                         f'samples after {PARTITION_ATTEMPTS} draws; use a larger alpha or fewer shards.')
+    raise ValueError(f'Unknown partition method: {method}')
+
+def _scale(x, y):
+    return tf.cast(x, tf.float32) / 255, y
+
+def make_dataset(x, y, batch_size=512, shuffle=False, seed=None, cache=True):
+    ds = tf.data.Dataset.from_tensor_slices((x, y))
+    if cache:
+        ds = ds.cache()
+    if shuffle:
+        ds = ds.shuffle(len(x), seed=seed, reshuffle_each_iteration=True)
+    # Scaling whole batches is much cheaper than mapping every sample
+    ds = ds.batch(batch_size).map(_scale, num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+def make_indexed_dataset(x, y, indices=None, batch_size=512, shuffle=False, seed=None):
+    # Pipeline over x[indices] that gathers one batch at a time, so a client's shard
+    # is never copied out of the (memory-mapped) arrays as a whole
+    if indices is None:
+        indices = np.arange(len(x))
 
-    # data preprocessing
-    x_train = x_train.reshape(x_train.shape[0], 28, 28, 1).astype('float32') / 255
-    x_test = x_test.reshape(x_test.shape[0], 28, 28, 1).astype('float32') / 255
+    def gather(idx):
+        idx = np.sort(idx)
+        xb = x[idx]
+        if xb.dtype == np.uint8:
+            xb = xb.astype(np.float32) / 255
+        return xb, y[idx]
 
-    y_train = tf.keras.utils.to_categorical(y_train, 10)
-    y_test = tf.keras.utils.to_categorical(y_test, 10)
+    def load(idx):
+        xb, yb = tf.numpy_function(gather, [idx], (tf.float32, tf.as_dtype(y.dtype)))
+        xb.set_shape((None, *x.shape[1:]))
+        yb.set_shape((None,))
+        return xb, yb
 
-    # Randomly select 10% of the training data
-    x_real_train, _, y_real_train, _ = train_test_split(
-        x_train, y_train, test_size=0.9, random_state=42
-    )
+    ds = tf.data.Dataset.from_tensor_slices(indices)
+    if shuffle:
+        ds = ds.shuffle(len(indices), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size).map(load, num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.prefetch(tf.data.AUTOTUNE)
 
-    return (x_real_train, y_real_train), (x_test, y_test)
+def split_client_shard(labels, shard_id, num_shards, method='iid', alpha=0.5, validation_split=0.0, seed=42):
+    # Training and validation indices of this client's shard
+    idx = partition_indices(labels, num_shards, shard_id, method, alpha, seed)
+    n_val = int(len(idx) * validation_split)
+    if n_val >= len(idx):
+        raise ValueError(f'Validation split {validation_split} leaves no training samples in shard {shard_id} of {len(idx)} samples.')
+    rng = np.random.default_rng(seed + shard_id)
+    idx = rng.permutation(idx)
+    return np.sort(idx[n_val:]), np.sort(idx[:n_val])
 
-def train_model(model, x_train, y_train, epochs=5, batch_size=512):
-    model.fit(x_train, y_train, epochs=epochs, batch_size=batch_size, validation_split=0.25)
+def make_stacked_dataset(x, y, shards, batch_size=512, epochs=1, seed=None):
+    # Pipeline of (x, y, mask) batches stacked over clients, shaped [clients, batch, ...]:
+    # step i holds the i-th batch of every client's shard (shuffled per epoch), so each
+    # client still sees only its own samples. Shards that run out early, and the
+    # clients whose shard is None, are padded with masked samples.
+    rng = np.random.default_rng(seed)
+    orders = [np.concatenate([rng.permutation(shard) for _ in range(epochs)]) if shard is not None else np.empty(0, np.int64)
+              for shard in shards]
+    steps = max(-(-len(order) // batch_size) for order in orders)
+    steps_idx = np.full((steps * batch_size, len(shards)), -1, dtype=np.int64)
+    for k, order in enumerate(orders):
+        steps_idx[:len(order), k] = order
+    steps_idx = steps_idx.reshape(steps, batch_size, len(shards)).transpose(0, 2, 1)
+
+    def gather(idx):
+        mask = idx >= 0
+        idx = np.where(mask, idx, 0)
+        xb = x[idx.ravel()].reshape(*idx.shape, *x.shape[1:])
+        if xb.dtype == np.uint8:
+            xb = xb.astype(np.float32) / 255
+        return xb, y[idx], mask
+
+    def load(idx):
+        xb, yb, mask = tf.numpy_function(gather, [idx], (tf.float32, tf.as_dtype(y.dtype), tf.bool))
+        xb.set_shape((len(shards), batch_size, *x.shape[1:]))
+        yb.set_shape((len(shards), batch_size))
+        mask.set_shape((len(shards), batch_size))
+        return xb, yb, mask
+
+    ds = tf.data.Dataset.from_tensor_slices(steps_idx).map(load, num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+def load_client_datasets(data, shard_id, num_shards, method='iid', alpha=0.5, batch_size=512,
+                         validation_split=0.0, seed=42):
+    # Training and validation pipelines over this client's shard only
+    x_train, y_train = data
+    train_idx, val_idx = split_client_shard(y_train, shard_id, num_shards, method, alpha, validation_split, seed)
+    train_ds = make_indexed_dataset(x_train, y_train, train_idx, batch_size, shuffle=True, seed=seed + shard_id)
+    val_ds = make_indexed_dataset(x_train, y_train, val_idx, batch_size) if len(val_idx) else None
+    return train_ds, val_ds
+
+def train_model(model, train_ds, epochs=5, val_ds=None):
+    model.fit(train_ds, epochs=epochs, validation_data=val_ds)
     print('Model training completed.')
 
-def evaluate_model(model, x_test, y_test):
-    evaluation = model.evaluate(x_test, y_test)
-    loss, accuracy = evaluation[0], evaluation[1]
-    print(f'Accuracy: {accuracy}')
-    y_pred = model.predict(x_test)
-    y_true = np.argmax(y_test, axis=1)
-    y_pred = np.argmax(y_pred, axis=1)
-
-    cm = confusion_matrix(y_true, y_pred)
-    accuracy = np.sum(np.diag(cm)) / np.sum(cm)
-    precision = precision_score(y_true, y_pred, average='weighted')
-    recall = recall_score(y_true, y_pred, average='weighted')
-    f1 = f1_score(y_true, y_pred, average='weighted')
-
-    print(f'Accuracy: {accuracy}')
-    print(f'Precision: {precision}')
-    print(f'Recall: {recall}')
-    print(f'F1 Score: {f1}')
+def validate_model(model, val_ds):
+    metrics = model.evaluate(val_ds, return_dict=True, verbose=0)
+    print(f"Validation loss: {metrics['loss']}, accuracy: {metrics.get('accuracy')}")
+    return metrics
+
+def set_precision(policy):
+    # Applies to layers built afterwards, so it must be set before the model is loaded
+    # (with model_from_json)
+    tf.keras.mixed_precision.set_global_policy(policy)
+
+def _apply_policy(config, policy, outputs=True):
+    # Set the dtype of every layer in a model config to policy, and of the output
+    # layers to float32, recursing into nested models
+    model = config['config']
+    names = model.get('output_layers') or []
+    if names and isinstance(names[0], str):
+        names = [names]
+    names = {name[0] for name in names} if outputs else set()
+    layers = model.get('layers', [])
+    if outputs and config['class_name'] == 'Sequential' and layers:
+        names.add(layers[-1]['config']['name'])
+    for layer in layers:
+        if layer['class_name'] == 'InputLayer':
+            continue
+        if 'layers' in layer['config']:
+            _apply_policy(layer, policy, outputs=False)
+        layer['config']['dtype'] = 'float32' if layer['config']['name'] in names else policy
+
+def model_from_json(arch, custom_objects=None):
+    # tf.keras.models.model_from_json under the global dtype policy (set_precision).
+    # Every layer config carries the policy the model was saved with, float32 for the
+    # architectures on IPFS, which would otherwise override it. The output layers stay
+    # float32, as Keras recommends, so softmax and loss are computed in full precision.
+    policy = tf.keras.mixed_precision.global_policy().name
+    if policy != 'float32':
+        config = json.loads(arch)
+        _apply_policy(config, policy)
+        arch = json.dumps(config)
+    return tf.keras.models.model_from_json(arch, custom_objects=custom_objects)
+
+def architecture_key(model):
+    # Digest of the layers' types, configurations and weight shapes; unlike to_json()
+    # it ignores model and layer names, which differ between copies of one
+    # architecture loaded in the same process
+    layers = [(type(layer).__name__, {k: v for k, v in layer.get_config().items() if k != 'name'},
+               [list(w.shape) for w in layer.weights]) for layer in model.layers]
+    return hashlib.sha256(json.dumps(layers, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+class TrainingEngine:
+    # Training loop around one tf.function train step, XLA-compiled with jit_compile
+    # and traced once per input shape, instead of fit's per-call setup. Under a mixed
+    # precision policy (set_precision) the step computes in bfloat16/float16 while the
+    # variables, and so the exchanged weights, stay float32; float16 adds loss
+    # scaling. The optimizer state carries over between rounds, as with fit.
+    def __init__(self, model, jit_compile=True, learning_rate=0.001):
+        self.model = model
+        optimizer = tf.keras.optimizers.Adam(learning_rate)
+        if tf.keras.mixed_precision.global_policy().name == 'mixed_float16':
+            optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+        optimizer.build(model.trainable_variables)
+        self.optimizer = optimizer
+        self.loss_fn = tf.keras.losses.SparseCategoricalCrossentropy()
+        self._train_step = tf.function(self._step, jit_compile=jit_compile, reduce_retracing=True)
+        self._eval_step = tf.function(self._evaluate, jit_compile=jit_compile, reduce_retracing=True)
+
+    def _step(self, x, y):
+        variables = self.model.trainable_variables
+        with tf.GradientTape() as tape:
+            # Outputs are cast up so the loss is computed in float32
+            loss = self.loss_fn(y, tf.cast(self.model(x, training=True), tf.float32))
+            scaled_loss = self.optimizer.scale_loss(loss)
+        self.optimizer.apply_gradients(zip(tape.gradient(scaled_loss, variables), variables))
+        return loss
+
+    def _evaluate(self, x, y):
+        probs = tf.cast(self.model(x, training=False), tf.float32)
+        correct = tf.reduce_sum(tf.cast(tf.equal(tf.argmax(probs, axis=-1, output_type=tf.int64), tf.cast(y, tf.int64)), tf.float32))
+        return self.loss_fn(y, probs) * tf.cast(tf.shape(x)[0], tf.float32), correct
+
+    def train(self, dataset, epochs=1):
+        samples, total_loss = 0, 0.0
+        start_time = time.perf_counter()
+        for _ in range(epochs):
+            for x, y in dataset:
+                # Losses stay on the device until the end, so steps are not synchronised
+                total_loss += self._train_step(x, y) * x.shape[0]
+                samples += x.shape[0]
+        loss = float(total_loss) / max(samples, 1)
+        elapsed = time.perf_counter() - start_time
+        print(f'Trained on {samples} samples in {elapsed:.2f} s ({samples / elapsed:.0f} samples/s), loss {loss:.4f}')
+        return {'loss': loss, 'samples': samples, 'seconds': elapsed}
+
+    def validate(self, dataset):
+        samples, total_loss, correct = 0, 0.0, 0.0
+        for x, y in dataset:
+            loss, hits = self._eval_step(x, y)
+            total_loss += loss
+            correct += hits
+            samples += x.shape[0]
+        metrics = {'loss': float(total_loss) / max(samples, 1), 'accuracy': float(correct) / max(samples, 1)}
+        print(f"Validation loss: {metrics['loss']}, accuracy: {metrics['accuracy']}")
+        return metrics
+
+def autotune_batch_size(model, jit_compile=True, cache_path=None, candidates=BATCH_CANDIDATES, steps=5):
+    # Training batch size for this architecture on this host: the smallest candidate
+    # within 10% of the best throughput (smaller batches take more optimizer steps per
+    # round), measured once on random inputs with a fresh copy of the model. Results
+    # are cached in cache_path by architecture, precision, XLA setting and host; the
+    # lock lets processes starting together wait for one measurement.
+    policy = tf.keras.mixed_precision.global_policy().name
+    key = hashlib.sha256(json.dumps([architecture_key(model), policy, jit_compile, platform.node(), os.cpu_count(),
+                                     tf.__version__]).encode()).hexdigest()[:16]
+    lock = open(f'{cache_path}.lock', 'w') if cache_path else None
+    try:
+        if lock is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        cache = {}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path) as f:
+                cache = json.load(f)
+        if key in cache:
+            return cache[key]['batch_size']
+
+        rng = np.random.default_rng(0)
+        num_classes = model.output_shape[-1]
+        throughput = {}
+        for batch_size in candidates:
+            engine = TrainingEngine(tf.keras.models.clone_model(model), jit_compile)
+            x = rng.random((batch_size, *model.input_shape[1:]), dtype=np.float32)
+            y = rng.integers(0, num_classes, batch_size)
+            engine._train_step(x, y)
+            start_time = time.perf_counter()
+            for _ in range(steps):
+                loss = engine._train_step(x, y)
+            float(loss)
+            throughput[batch_size] = batch_size * steps / (time.perf_counter() - start_time)
+        best = max(throughput.values())
+        batch_size = min(b for b, t in throughput.items() if t >= 0.9 * best)
+        print(f'Batch size autotune: {batch_size} ({", ".join(f"{b}: {t:.0f}/s" for b, t in throughput.items())})')
+
+        if cache_path:
+            cache[key] = {'batch_size': batch_size, 'samples_per_s': {str(b): t for b, t in throughput.items()}}
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(cache, f, indent=2)
+            os.replace(tmp_path, cache_path)
+        return batch_size
+    finally:
+        if lock is not None:
+            lock.close()
+
+def confusion_matrix(y_true, y_pred, num_classes):
+    return np.bincount(y_true * num_classes + y_pred, minlength=num_classes * num_classes).reshape(num_classes, num_classes)
+
+def classification_metrics(cm):
+    # Accuracy and support-weighted precision, recall and F1 (sklearn's 'weighted'
+    # average, with 0 for classes that are never predicted)
+    tp = np.diag(cm).astype(np.float64)
+    support = cm.sum(axis=1)
+    predicted = cm.sum(axis=0)
+    total = support.sum()
+    precision = np.divide(tp, predicted, out=np.zeros_like(tp), where=predicted > 0)
+    recall = np.divide(tp, support, out=np.zeros_like(tp), where=support > 0)
+    f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros_like(tp), where=precision + recall > 0)
+    weights = support / total
+    return {
+        'accuracy': float(tp.sum() / total),
+        'precision': float(precision @ weights),
+        'recall': float(recall @ weights),
+        'f1': float(f1 @ weights),
+    }
+
+def evaluate_model(model, test_ds):
+    # One inference pass: per batch, the loss is summed and predictions are counted
+    # into a confusion matrix from which all metrics follow
+    num_classes = model.output_shape[-1]
+    cm = np.zeros((num_classes, num_classes), dtype=np.int64)
+    loss = 0.0
+    for x, y in test_ds:
+        probs = np.asarray(model.predict_on_batch(x))
+        y = np.asarray(y, dtype=np.int64)
+        loss -= np.log(np.maximum(probs[np.arange(len(y)), y], 1e-7)).sum()
+        cm += confusion_matrix(y, probs.argmax(axis=1), num_classes)
+    metrics = classification_metrics(cm)
+    metrics['loss'] = loss / cm.sum()
+
+    print(f'Accuracy: {metrics["accuracy"]}')
+    print(f'Precision: {metrics["precision"]}')
+    print(f'Recall: {metrics["recall"]}')
+    print(f'F1 Score: {metrics["f1"]}')
+    return metrics
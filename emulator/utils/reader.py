@@ -0,0 +1,144 @@
+import asyncio
+import logging
+from eth_utils.abi import function_abi_to_4byte_selector, get_abi_input_types, get_abi_output_types
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.datastructures import AttributeDict
+from web3.exceptions import ContractLogicError, Web3RPCError
+
+SCOPES = (None, 'project', 'round')
+# Receipt and log fields by how w3.eth.get_transaction_receipt formats them; others
+# are left as the node sent them
+_QUANTITIES = {'blockNumber', 'blobGasPrice', 'blobGasUsed', 'cumulativeGasUsed', 'effectiveGasPrice', 'gasUsed',
+               'logIndex', 'status', 'transactionIndex', 'type'}
+_BYTES = {'blockHash', 'data', 'logsBloom', 'topics', 'transactionHash'}
+_ADDRESSES = {'address', 'contractAddress', 'from', 'to'}
+
+def _quantity(value):
+    return value if isinstance(value, int) else int(value, 16)
+
+def _encode_call(w3, fn):
+    # Call data of a contract function bound to positional arguments
+    if fn.kwargs:
+        raise ValueError(f'Pass the arguments of {fn.abi["name"]} positionally to batch its call.')
+    return Web3.to_hex(function_abi_to_4byte_selector(fn.abi) + w3.codec.encode(get_abi_input_types(fn.abi), fn.args))
+
+def _decode_value(abi_type, value):
+    # Addresses checksummed, as fn.call() returns them
+    if abi_type.endswith(']'):
+        return [_decode_value(abi_type[:abi_type.rindex('[')], v) for v in value]
+    return Web3.to_checksum_address(value) if abi_type == 'address' else value
+
+def _format_receipt(value, key=None):
+    # The receipt as w3.eth.get_transaction_receipt returns it
+    if isinstance(value, dict):
+        return AttributeDict({k: _format_receipt(v, k) for k, v in value.items()})
+    if isinstance(value, list):
+        return [_format_receipt(v, key) for v in value]
+    if not isinstance(value, str):
+        return value
+    if key in _QUANTITIES:
+        return int(value, 16)
+    if key in _ADDRESSES:
+        return Web3.to_checksum_address(value)
+    return HexBytes(value) if key in _BYTES else value
+
+class ContractReader:
+    # Contract view calls and node lookups of every client in the process, sent as
+    # JSON-RPC batch requests: whatever is asked while a batch is in flight, or within
+    # `window` seconds of the first request, goes out together in the next one. A
+    # failing call (e.g. a revert) only fails its own caller. Identical calls share one
+    # request, and results can be cached per project:
+    #   'project'  values fixed once the project exists (manager PK, architecture CID)
+    #   'round'    values of the current round (global weights CID), dropped when the
+    #              project's next GlobalModelUpdated arrives (see watch())
+    # The contract gates some views by caller (participateReturn, joinReturn), so a
+    # cached value is handed only to clients at the same point of the protocol.
+    def __init__(self, w3, max_batch=100, window=0.002, logger=None):
+        self.w3 = w3
+        self.max_batch = max_batch
+        self.window = window
+        self.logger = logger or logging.getLogger(__name__)
+        # (scope, project, key) -> future of the value
+        self._cache = {}
+        self._queue = []
+        self._flusher = None
+        self.calls = 0
+        self.requests = 0
+
+    def watch(self, dispatcher, project_id):
+        dispatcher.listen('GlobalModelUpdated', lambda event: self.invalidate(project_id), projectId=project_id)
+
+    def invalidate(self, project_id):
+        for key in [key for key in self._cache if key[0] == 'round' and key[1] == project_id]:
+            del self._cache[key]
+
+    def request(self, method, params, cache_key=None):
+        # Future of the result of one JSON-RPC call; cache_key makes it shared and kept
+        # (see call() for scopes)
+        self.calls += 1
+        if cache_key is not None:
+            future = self._cache.get(cache_key)
+            if future is not None and not (future.done() and future.exception() is not None):
+                return future
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((method, params, future))
+        if cache_key is not None:
+            self._cache[cache_key] = future
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush())
+        return future
+
+    async def call(self, fn, sender, scope=None, project=None):
+        # Result of a contract view call from sender, decoded like fn.call() would
+        if scope not in SCOPES:
+            raise ValueError(f'Unknown cache scope: {scope}')
+        tx = {'from': sender, 'to': fn.address, 'data': _encode_call(self.w3, fn)}
+        cache_key = (scope, project, (fn.address, tx['data'])) if scope is not None else None
+        data = await asyncio.shield(self.request('eth_call', [tx, 'latest'], cache_key))
+        output_types = get_abi_output_types(fn.abi)
+        result = [_decode_value(t, v) for t, v in zip(output_types, self.w3.codec.decode(output_types, HexBytes(data)))]
+        return result[0] if len(result) == 1 else result
+
+    async def chain_id(self):
+        return _quantity(await asyncio.shield(self.request('eth_chainId', [], ('node', None, 'eth_chainId'))))
+
+    async def gas_price(self):
+        return _quantity(await self.request('eth_gasPrice', []))
+
+    async def transaction_count(self, address, block='pending'):
+        return _quantity(await self.request('eth_getTransactionCount', [address, block]))
+
+    async def receipt(self, tx_hash):
+        # Receipt of a mined transaction, None while it is pending
+        result = await self.request('eth_getTransactionReceipt', [HexBytes(tx_hash).to_0x_hex()])
+        return _format_receipt(result) if result else None
+
+    async def _flush(self):
+        while self._queue:
+            await asyncio.sleep(self.window)
+            batch, self._queue = self._queue[:self.max_batch], self._queue[self.max_batch:]
+            try:
+                responses = await asyncio.to_thread(self.w3.provider.make_batch_request, [(m, p) for m, p, _ in batch])
+                if not isinstance(responses, list):
+                    # The node rejected the whole batch
+                    raise Web3RPCError(str(responses.get('error', responses)), rpc_response=responses)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.requests += 1
+            for (method, _, future), response in zip(batch, responses):
+                if future.done():
+                    continue
+                if 'error' in response:
+                    error = response['error']
+                    message = error.get('message', str(error)) if isinstance(error, dict) else str(error)
+                    if method == 'eth_call':
+                        future.set_exception(ContractLogicError(message, data=error.get('data') if isinstance(error, dict) else None))
+                    else:
+                        future.set_exception(Web3RPCError(message, rpc_response=response))
+                else:
+                    future.set_result(response['result'])
+        self.logger.debug(f'{self.calls} calls answered with {self.requests} batch requests')
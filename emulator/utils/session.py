@@ -0,0 +1,84 @@
+import base64
+import binascii
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad, unpad
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from utils.crypto import encrypt, decrypt
+
+# Keys derived from the ECDH secret of a client and the manager. The manager picks the
+# scheme; clients recognise it from the wrapped round key they receive.
+#   raw      the secret (ECDH x-coordinate) is the AES key both for the client's
+#            uploads and for wrapping the round key, which is sent as AES-ECB of its
+#            hex string. This is what Manager.js and older clients speak.
+#   hkdf-v1  HKDF-SHA256 with salt 'fl-session/v1' over the secret, expanded into one
+#            32-byte key per purpose with info
+#              'fl-session/v1/<purpose>/<project id>/<client address, lowercase>/<iteration>'
+#            for purposes 'upload' and 'wrap'. The round key is sent as
+#              'v1:' + base64(iv | AES-256-CBC-PKCS7(key)).
+#            Mirrored by deriveSessionKeys/unwrapKey in frontend/src/components/utils.js.
+KEY_SCHEMES = ('raw', 'hkdf-v1')
+_LABEL = 'fl-session/v1'
+_WRAP_PREFIX = 'v1:'
+
+SessionKeys = namedtuple('SessionKeys', ['upload', 'wrap'])
+
+def derive_session_keys(secret, project_id, peer, iteration):
+    def derive(purpose):
+        info = f'{_LABEL}/{purpose}/{project_id}/{peer.lower()}/{iteration}'.encode()
+        return HKDF(algorithm=hashes.SHA256(), length=32, salt=_LABEL.encode(), info=info).derive(secret)
+    return SessionKeys(derive('upload'), derive('wrap'))
+
+class SessionKeyCache:
+    # Session keys per (secret, project, peer, iteration), least recently used first;
+    # entries expire ttl seconds after they were derived and at most maxsize are kept.
+    # Thread-safe, one per process is shared by every emulated client.
+    def __init__(self, maxsize=4096, ttl=3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, scheme, secret, project_id, peer, iteration):
+        if scheme == 'raw':
+            return SessionKeys(secret, secret)
+        if scheme != 'hkdf-v1':
+            raise ValueError(f'Unknown key scheme: {scheme}')
+        key = (secret, project_id, peer.lower(), iteration)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[1]
+        keys = derive_session_keys(secret, project_id, peer, iteration)
+        with self._lock:
+            self._entries[key] = (now + self.ttl, keys)
+            self._entries.move_to_end(key)
+            while self._entries and (len(self._entries) > self.maxsize or next(iter(self._entries.values()))[0] <= now):
+                self._entries.popitem(last=False)
+        return keys
+
+    def __len__(self):
+        return len(self._entries)
+
+session_keys = SessionKeyCache()
+
+def key_scheme(encrypted_key):
+    return 'hkdf-v1' if encrypted_key.startswith(_WRAP_PREFIX) else 'raw'
+
+def wrap_key(aes_key, keys, scheme):
+    if scheme == 'raw':
+        return encrypt(aes_key.hex().encode(), keys.wrap).decode()
+    iv = os.urandom(16)
+    return _WRAP_PREFIX + base64.b64encode(iv + AES.new(keys.wrap, AES.MODE_CBC, iv).encrypt(pad(aes_key, 16))).decode()
+
+def unwrap_key(encrypted_key, keys):
+    if key_scheme(encrypted_key) == 'raw':
+        return binascii.unhexlify(decrypt(encrypted_key, keys.wrap))
+    data = base64.b64decode(encrypted_key[len(_WRAP_PREFIX):])
+    return unpad(AES.new(keys.wrap, AES.MODE_CBC, data[:16]).decrypt(data[16:]), 16)
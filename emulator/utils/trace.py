@@ -0,0 +1,169 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import resource
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Per-phase spans of an emulated client. Every span becomes one JSON line
+#   {"client": 3, "round": 2, "phase": "download", "start": <unix time>, "wall": s,
+#    "cpu": s, "process_cpu": s, "bytes": n, "peak_rss": bytes, "parent": null}
+# in ./res/{ID}.trace.jsonl, and is added to process-wide counters that can be
+# scraped in Prometheus text format (start_metrics_server). 'cpu' is the CPU time of
+# the thread that ran the span, so blocking work is traced inside its worker thread
+# (Tracer.run); spans that only await something are recorded without it. TensorFlow
+# computes on its own thread pool, whose time shows up in 'process_cpu' only.
+# Helpers deeper down (decryption, encryption) report sub-phases with phase(), which
+# adds to the innermost open span and is written as its own line with a parent.
+
+_current = contextvars.ContextVar('span', default=None)
+
+def _peak_rss():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class Span:
+    def __init__(self, phase):
+        self.phase = phase
+        self.bytes = 0
+        self.phases = defaultdict(lambda: [0.0, 0.0, 0])
+
+@contextlib.contextmanager
+def phase(name):
+    span = _current.get()
+    if span is None:
+        yield
+        return
+    start_wall, start_cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        acc = span.phases[name]
+        acc[0] += time.perf_counter() - start_wall
+        acc[1] += time.thread_time() - start_cpu
+        acc[2] += 1
+
+def add_phase(name, wall, cpu=0.0):
+    # Sub-phase measured elsewhere, e.g. in a worker process, added to the innermost span
+    span = _current.get()
+    if span is not None:
+        acc = span.phases[name]
+        acc[0] += wall
+        acc[1] += cpu
+        acc[2] += 1
+
+def timed_chunks(chunks, name):
+    # Attribute the time spent producing each chunk (e.g. encrypting it) to a phase
+    chunks = iter(chunks)
+    while True:
+        with phase(name):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+class MetricsRegistry:
+    # Process-wide totals per (client, phase), exposed in Prometheus text format
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = defaultdict(lambda: {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'bytes': 0})
+
+    def add(self, record):
+        with self._lock:
+            totals = self._totals[(record['client'], record['phase'])]
+            totals['count'] += 1
+            totals['wall'] += record['wall']
+            totals['cpu'] += record['cpu'] or 0.0
+            totals['bytes'] += record['bytes']
+
+    def render(self):
+        lines = []
+        metrics = [('count', 'fl_phase_total', 'Completed spans'),
+                   ('wall', 'fl_phase_seconds_total', 'Wall time spent in the phase'),
+                   ('cpu', 'fl_phase_cpu_seconds_total', 'CPU time of the thread running the phase'),
+                   ('bytes', 'fl_phase_bytes_total', 'Bytes moved by the phase')]
+        with self._lock:
+            items = sorted(self._totals.items(), key=lambda kv: (str(kv[0][0]), kv[0][1]))
+            for key, name, help_text in metrics:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} counter')
+                for (client, phase_name), totals in items:
+                    lines.append(f'{name}{{client="{client}",phase="{phase_name}"}} {totals[key]}')
+        lines.append('# HELP fl_peak_rss_bytes Peak resident set size of the process')
+        lines.append('# TYPE fl_peak_rss_bytes gauge')
+        lines.append(f'fl_peak_rss_bytes {_peak_rss()}')
+        return '\n'.join(lines) + '\n'
+
+registry = MetricsRegistry()
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_metrics_server(port, host='0.0.0.0'):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+class Tracer:
+    def __init__(self, client, path=None, logger=None):
+        self.client = client
+        self.logger = logger or logging.getLogger(__name__)
+        self._file = open(path, 'a', buffering=1) if path else None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, round=None, cpu=True):
+        span = Span(name)
+        token = _current.set(span)
+        start, start_wall = time.time(), time.perf_counter()
+        start_cpu, start_process = time.thread_time(), time.process_time()
+        try:
+            yield span
+        finally:
+            _current.reset(token)
+            self._emit(name, round, start, time.perf_counter() - start_wall,
+                       time.thread_time() - start_cpu if cpu else None,
+                       time.process_time() - start_process, span.bytes, None)
+            for sub, (wall, sub_cpu, calls) in span.phases.items():
+                self._emit(sub, round, start, wall, sub_cpu, None, 0, name, calls=calls)
+
+    async def run(self, name, fn, *args, round=None, executor=None, nbytes=None):
+        # Run blocking fn in a worker thread inside a span opened on that thread;
+        # nbytes(result) gives the bytes moved
+        def traced():
+            with self.span(name, round) as span:
+                result = fn(*args)
+                if nbytes is not None:
+                    span.bytes = nbytes(result)
+            return result
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(contextvars.copy_context().run, traced))
+
+    def _emit(self, name, round, start, wall, cpu, process_cpu, nbytes, parent, **extra):
+        record = {'client': self.client, 'round': round, 'phase': name, 'start': start, 'wall': wall,
+                  'cpu': cpu, 'process_cpu': process_cpu, 'bytes': nbytes, 'peak_rss': _peak_rss(),
+                  'parent': parent, **extra}
+        registry.add(record)
+        self.logger.info(f"{name} time: {wall}" + (f", {nbytes} bytes" if nbytes else ''))
+        if self._file is not None:
+            with self._lock:
+                self._file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
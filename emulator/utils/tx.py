@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from web3.exceptions import TransactionNotFound
+
+class PreparedTransaction:
+    def __init__(self, fn, value, nonce, raw_transaction, epoch=0):
+        self.fn = fn
+        self.value = value
+        self.nonce = nonce
+        self.raw_transaction = raw_transaction
+        # Nonce resyncs of the manager before this was signed
+        self.epoch = epoch
+
+async def _value(value):
+    return value
+
+class TransactionManager:
+    # Per-account transaction pipeline. Nonces are handed out locally (fetched from
+    # the node once, and again after a failed send), chainId is fetched once and the
+    # gas price is cached for gas_price_ttl seconds, so building and signing a
+    # transaction needs no RPC. send() returns as soon as the node has accepted the
+    # raw transaction, with an asyncio task that resolves to the receipt once mined.
+    # Transactions prepared before a resync are signed again when submitted, as the
+    # resync may hand their nonces out again. With a ContractReader, lookups and
+    # receipt polls join its batch requests.
+    def __init__(self, w3, address, private_key, gas=2000000, gas_price=None, gas_price_ttl=30,
+                 poll_interval=0.1, logger=None, reader=None):
+        self.w3 = w3
+        self.reader = reader
+        self.address = address
+        self.private_key = private_key
+        self.gas = gas
+        self.fixed_gas_price = gas_price
+        self.gas_price_ttl = gas_price_ttl
+        self.poll_interval = poll_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self._chain_id = None
+        self._gas_price = None
+        self._gas_price_time = 0
+        self._nonce = None
+        self._epoch = 0
+        self._lock = asyncio.Lock()
+
+    async def _fill_cache(self):
+        refresh_gas_price = self.fixed_gas_price is None and time.monotonic() - self._gas_price_time > self.gas_price_ttl
+        if self.reader is not None:
+            # Whatever is missing goes out in one batch request, with other clients' reads
+            self._chain_id, gas_price, self._nonce = await asyncio.gather(
+                self.reader.chain_id() if self._chain_id is None else _value(self._chain_id),
+                self.reader.gas_price() if refresh_gas_price else _value(self._gas_price),
+                self.reader.transaction_count(self.address) if self._nonce is None else _value(self._nonce))
+            if refresh_gas_price:
+                self._gas_price, self._gas_price_time = gas_price, time.monotonic()
+            return
+        if self._chain_id is None:
+            self._chain_id = await asyncio.to_thread(lambda: self.w3.eth.chain_id)
+        if refresh_gas_price:
+            self._gas_price = await asyncio.to_thread(lambda: self.w3.eth.gas_price)
+            self._gas_price_time = time.monotonic()
+        if self._nonce is None:
+            self._nonce = await asyncio.to_thread(self.w3.eth.get_transaction_count, self.address, 'pending')
+
+    def _sign(self, fn, value, nonce):
+        tx = {
+            'chainId': self._chain_id,
+            'gas': self.gas,
+            'gasPrice': self.fixed_gas_price if self.fixed_gas_price is not None else self._gas_price,
+            'nonce': nonce,
+        }
+        if value is not None:
+            tx['value'] = value
+        transaction = fn.build_transaction(tx)
+        signed_tx = self.w3.eth.account.sign_transaction(transaction, private_key=self.private_key)
+        return signed_tx.raw_transaction
+
+    async def prepare(self, fn, value=None):
+        # Reserve the next nonce and sign now, e.g. while the previous step is still running
+        async with self._lock:
+            await self._fill_cache()
+            nonce = self._nonce
+            self._nonce += 1
+            epoch = self._epoch
+        return PreparedTransaction(fn, value, nonce, self._sign(fn, value, nonce), epoch)
+
+    async def resync(self):
+        async with self._lock:
+            self._nonce = None
+            self._epoch += 1
+            self._gas_price_time = 0
+            await self._fill_cache()
+
+    async def submit(self, prepared):
+        if prepared.epoch != self._epoch:
+            # Signed before a resync, e.g. later in a batch whose earlier send failed
+            prepared = await self.prepare(prepared.fn, prepared.value)
+        try:
+            tx_hash = await asyncio.to_thread(self.w3.eth.send_raw_transaction, prepared.raw_transaction)
+        except Exception as e:
+            # Most likely a stale nonce (another sender, dropped transaction); resync and retry once
+            self.logger.warning(f'Sending transaction with nonce {prepared.nonce} failed ({e}), resyncing nonce.')
+            await self.resync()
+            prepared = await self.prepare(prepared.fn, prepared.value)
+            tx_hash = await asyncio.to_thread(self.w3.eth.send_raw_transaction, prepared.raw_transaction)
+        return asyncio.create_task(self.wait_for_receipt(tx_hash))
+
+    async def send(self, fn, value=None):
+        return await self.submit(await self.prepare(fn, value))
+
+    async def wait_for_receipt(self, tx_hash):
+        while True:
+            if self.reader is not None:
+                receipt = await self.reader.receipt(tx_hash)
+                if receipt is not None:
+                    return receipt
+                await asyncio.sleep(self.poll_interval)
+                continue
+            try:
+                return await asyncio.to_thread(self.w3.eth.get_transaction_receipt, tx_hash)
+            except TransactionNotFound:
+                await asyncio.sleep(self.poll_interval)
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import struct
+import weakref
+import numpy as np
+
+# Binary weight container:
+#   MAGIC | version (u8) | header length (u32 LE) | header JSON | padding | tensor buffers
+# The header lists name, shape, dtype, offset and nbytes of every tensor, plus optional
+# free-form metadata ('meta', e.g. the codec of a compressed update). Offsets are
+# relative to the start of the data section, which (like each tensor) is ALIGN-aligned.
+# The magic starts with a non-ASCII byte, so it can never be confused with the legacy
+# JSON payload (a list of flat float lists). Payloads written from a model also carry
+# the signature of its WeightLayout ('layout'), so a reader holding the same layout can
+# take the tensors at known offsets without looking at the tensor list.
+MAGIC = b'\x93W3W'
+VERSION = 1
+ALIGN = 64
+_PREFIX = struct.Struct('<4sBI')
+WEIGHT_FORMATS = ('binary', 'json')
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+def model_weight_names(model):
+    return [getattr(v, 'path', v.name) for v in model.weights]
+
+class WeightLayout:
+    # Shapes, dtypes and offsets of a model's variables in model.weights order, i.e.
+    # trainable and non-trainable ones (BatchNormalization statistics) alike, laid out
+    # as in the binary container. Variable names are not part of the signature: Keras
+    # numbers layers per process, so the same architecture may be named differently.
+    def __init__(self, shapes, dtypes):
+        self.shapes = [tuple(int(d) for d in shape) for shape in shapes]
+        self.dtypes = [np.dtype(dtype).newbyteorder('<') for dtype in dtypes]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.offsets = []
+        offset = 0
+        for size, dtype in zip(self.sizes, self.dtypes):
+            self.offsets.append(offset)
+            offset = _align(offset + size * dtype.itemsize)
+        self.nbytes = offset
+        spec = [[list(shape), dtype.str] for shape, dtype in zip(self.shapes, self.dtypes)]
+        self.signature = hashlib.sha256(json.dumps(spec, separators=(',', ':')).encode()).hexdigest()[:16]
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def views(self, buffer, start=0):
+        # Arrays of every variable over buffer, without copying
+        return [np.frombuffer(buffer, dtype=dtype, count=size, offset=start + offset).reshape(shape)
+                for shape, dtype, size, offset in zip(self.shapes, self.dtypes, self.sizes, self.offsets)]
+
+    def arrange(self, weights):
+        # weights as arrays of the layout's shapes and dtypes; flat (legacy JSON) or
+        # differently typed tensors are packed into one aligned buffer
+        if len(weights) != len(self):
+            raise ValueError(f'Expected {len(self)} weight tensors, got {len(weights)}')
+        for i, (w, size) in enumerate(zip(weights, self.sizes)):
+            if np.size(w) != size:
+                raise ValueError(f'Weight tensor {i} has {np.size(w)} values, expected shape {self.shapes[i]}')
+        if all(np.shape(w) == shape and np.asarray(w).dtype == dtype
+               for w, shape, dtype in zip(weights, self.shapes, self.dtypes)):
+            return list(weights)
+        views = self.views(bytearray(self.nbytes))
+        for view, w in zip(views, weights):
+            view.reshape(-1)[...] = np.ravel(w)
+        return views
+
+    def load(self, payload):
+        # Arrays of a weight payload in this layout: views into the payload when it was
+        # written with the same layout, decoded and checked otherwise
+        if is_binary_weights(payload):
+            header, data_start = _read_header(payload)
+            if header.get('layout') == self.signature and not header.get('meta') and len(payload) >= data_start + self.nbytes:
+                return self.views(payload, data_start)
+        return self.arrange(decode_weights(payload))
+
+    @classmethod
+    def of(cls, model):
+        layout = _layouts.get(model)
+        if layout is None:
+            variables = model.weights
+            layout = cls([v.shape for v in variables], [getattr(v.dtype, 'name', v.dtype) for v in variables])
+            if variables:
+                _layouts[model] = layout
+        return layout
+
+_layouts = weakref.WeakKeyDictionary()
+
+def encode_weights(weights, names=None, meta=None, layout=None):
+    if names is None:
+        names = [str(i) for i in range(len(weights))]
+    arrays = [np.asarray(w) for w in weights]
+
+    tensors = []
+    offset = 0
+    for name, arr in zip(names, arrays):
+        dtype = arr.dtype.newbyteorder('<')
+        tensors.append({'name': name, 'shape': list(arr.shape), 'dtype': dtype.str,
+                        'offset': offset, 'nbytes': arr.nbytes})
+        offset = _align(offset + arr.nbytes)
+    header = {'tensors': tensors}
+    if layout:
+        header['layout'] = layout
+    if meta:
+        header['meta'] = meta
+    header = json.dumps(header, separators=(',', ':')).encode()
+    data_start = _align(_PREFIX.size + len(header))
+
+    buf = bytearray(data_start + offset)
+    _PREFIX.pack_into(buf, 0, MAGIC, VERSION, len(header))
+    buf[_PREFIX.size:_PREFIX.size + len(header)] = header
+    for t, arr in zip(tensors, arrays):
+        start = data_start + t['offset']
+        dst = np.frombuffer(buf, dtype=t['dtype'], count=arr.size, offset=start)
+        dst[...] = arr.ravel()
+    return bytes(buf)
+
+def encode_model_weights(model, meta=None):
+    return encode_weights(model.get_weights(), model_weight_names(model), meta, WeightLayout.of(model).signature)
+
+def encode_weights_json(weights):
+    # Legacy format, still the only one understood by the frontend manager
+    return json.dumps([np.asarray(w).ravel().tolist() for w in weights]).encode()
+
+def serialize_weights(model, fmt='binary', meta=None):
+    # meta is only kept by the binary format
+    if fmt == 'binary':
+        return encode_model_weights(model, meta)
+    if fmt == 'json':
+        return encode_weights_json(model.get_weights())
+    raise ValueError(f'Unknown weight format: {fmt}')
+
+def is_binary_weights(payload):
+    return bytes(payload[:len(MAGIC)]) == MAGIC
+
+def _read_header(payload):
+    _, version, header_len = _PREFIX.unpack_from(payload, 0)
+    if version != VERSION:
+        raise ValueError(f'Unsupported weight format version: {version}')
+    header = json.loads(bytes(payload[_PREFIX.size:_PREFIX.size + header_len]))
+    return header, _align(_PREFIX.size + header_len)
+
+def weights_header(payload):
+    # Header of a binary payload and the offset of its data section
+    return _read_header(payload)
+
+def weights_meta(payload):
+    if not is_binary_weights(payload):
+        return {}
+    return _read_header(payload)[0].get('meta', {})
+
+def decode_weights_with_names(payload):
+    if not is_binary_weights(payload):
+        # Legacy payload: JSON list of flattened float32 tensors, no names or shapes
+        weights = [np.asarray(w, dtype='float32') for w in json.loads(payload)]
+        return [None] * len(weights), weights
+
+    header, data_start = _read_header(payload)
+
+    names, weights = [], []
+    for t in header['tensors']:
+        dtype = np.dtype(t['dtype'])
+        # Zero-copy view into the payload; read-only when the payload is bytes
+        arr = np.frombuffer(payload, dtype=dtype, count=t['nbytes'] // dtype.itemsize,
+                            offset=data_start + t['offset'])
+        names.append(t['name'])
+        weights.append(arr.reshape(t['shape']))
+    return names, weights
+
+def decode_weights(payload):
+    return decode_weights_with_names(payload)[1]
@@ -0,0 +1,196 @@
+import asyncio
+import multiprocessing
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from utils.weights import WeightLayout
+
+def cpu_sets(workers, cpus=None):
+    # Disjoint CPU sets, one per worker, cut from the CPUs this process may run on; with
+    # more workers than CPUs, workers share single CPUs round-robin
+    cpus = sorted(cpus or os.sched_getaffinity(0))
+    if workers >= len(cpus):
+        return [[cpus[i % len(cpus)]] for i in range(workers)]
+    return [cpus[i * len(cpus) // workers:(i + 1) * len(cpus) // workers] for i in range(workers)]
+
+# State of a worker process, set up by _init_worker
+_worker = {}
+
+def _init_worker(sets, counter, started, data_dir, inter_op_threads, precision):
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    cpus = sets[index % len(sets)]
+    os.sched_setaffinity(0, cpus)
+    # TensorFlow sizes its thread pools when it starts, which is only here
+    os.environ['OMP_NUM_THREADS'] = str(len(cpus))
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(len(cpus))
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    if precision != 'float32':
+        from utils.ml import set_precision
+        set_precision(precision)
+    _worker.update(index=index, cpus=cpus, started=started, data_dir=data_dir, models={}, shards={}, data=None)
+
+def _model(arch, key):
+    # One compiled model per architecture, reused by every job of that architecture
+    from utils.ml import model_from_json
+    model = _worker['models'].get(key)
+    if model is None:
+        model = model_from_json(arch)
+        model.compile(optimizer='adam', loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+        model.optimizer.build(model.trainable_variables)
+        _worker['models'][key] = model
+    return model
+
+def _dataset(shard, batch_size):
+    from utils.ml import load_mnist_memmap, make_indexed_dataset, split_client_shard
+    if _worker['data'] is None:
+        _worker['data'] = load_mnist_memmap(_worker['data_dir'])[0]
+    shard_id, num_shards, method, alpha, validation_split = shard
+    key = (shard, batch_size)
+    if key not in _worker['shards']:
+        x_train, y_train = _worker['data']
+        train_idx, _ = split_client_shard(y_train, shard_id, num_shards, method, alpha, validation_split)
+        _worker['shards'][key] = make_indexed_dataset(x_train, y_train, train_idx, batch_size, shuffle=True, seed=42 + shard_id)
+    return _worker['shards'][key]
+
+def _train(arch, key, shm_name, shapes, dtypes, shard, batch_size, epochs):
+    # Runs in a worker: the model weights followed by its optimizer variables are read
+    # from the client's shared memory segment, trained on and written back in place
+    with _worker['started'].get_lock():
+        _worker['started'].value += 1
+    start = time.time()
+    model = _model(arch, key)
+    variables = model.weights + model.optimizer.variables
+    layout = WeightLayout(shapes, dtypes)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        views = layout.views(shm.buf)
+        for v, view in zip(variables, views):
+            v.assign(view)
+        history = model.fit(_dataset(shard, batch_size), epochs=epochs, verbose=0)
+        for view, v in zip(views, variables):
+            view[...] = v.numpy()
+    finally:
+        # The segment can only be closed once no array refers to it
+        views = view = None
+        shm.close()
+    return {'worker': _worker['index'], 'start': start, 'end': time.time(),
+            'loss': history.history['loss'][-1], 'accuracy': history.history.get('accuracy', [None])[-1]}
+
+class TrainingPool:
+    # Local training in a fixed set of worker processes instead of the clients' own
+    # threads, so that many clients on one host do not each run TensorFlow over every
+    # core. Each worker is pinned to its own CPU set (cpu_sets) with intra-op threads
+    # matching it. A client's model weights and optimizer state travel through a shared
+    # memory segment it keeps across rounds; the job itself only names the segment,
+    # the architecture and the client's shard, which workers load from the memory-
+    # mapped dataset. The optimizer state stays with the client's model, so training
+    # matches `fit` in the client's process; precision is the clients' dtype policy.
+    # stats()/report() give queue depth, queue wait, training time and per-worker
+    # utilisation for sizing the pool.
+    def __init__(self, workers, data_dir='./data', cpus=None, inter_op_threads=1, precision='float32'):
+        self.workers = workers
+        self.sets = cpu_sets(workers, cpus)
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['utils.workers'])
+        self._started = context.Value('q', 0)
+        self._pool = ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                                         initargs=(self.sets, context.Value('i', 0), self._started, data_dir,
+                                                   inter_op_threads, precision))
+        self._segments = {}
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._depths = []
+        self._jobs = []
+        self._opened = time.time()
+
+    def start(self):
+        # Start the workers, and TensorFlow in them, ahead of the first job; the futures
+        # are done once they are up
+        return [self._pool.submit(int) for _ in range(self.workers)]
+
+    def _segment(self, client, nbytes):
+        with self._lock:
+            shm = self._segments.get(client)
+            if shm is None or shm.size < nbytes:
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+                shm = self._segments[client] = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+            return shm
+
+    async def train(self, client, model, shard, batch_size=512, epochs=1):
+        # Train a compiled model of client on shard ((shard id, shards, partition, alpha,
+        # validation split) as in split_client_shard) in a worker; model's weights and
+        # optimizer state are updated in place. Returns the job's timings and metrics.
+        from utils.ml import architecture_key
+        if not model.optimizer.built:
+            model.optimizer.build(model.trainable_variables)
+        variables = model.weights + model.optimizer.variables
+        layout = WeightLayout([v.shape for v in variables], [getattr(v.dtype, 'name', v.dtype) for v in variables])
+        shm = self._segment(client, layout.nbytes)
+        views = layout.views(shm.buf)
+        try:
+            for view, v in zip(views, variables):
+                view[...] = v.numpy()
+            with self._lock:
+                self._submitted += 1
+                self._depths.append(self._submitted - self._started.value)
+            submitted = time.time()
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self._pool, _train, model.to_json(), architecture_key(model), shm.name,
+                                                layout.shapes, layout.dtypes, shard, batch_size, epochs)
+            for v, view in zip(variables, views):
+                v.assign(view)
+        finally:
+            views = view = None
+        result['queued'] = result['start'] - submitted
+        with self._lock:
+            self._jobs.append(result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            jobs, depths = list(self._jobs), list(self._depths)
+            queued = self._submitted - self._started.value
+        elapsed = time.time() - self._opened
+        busy = [0.0] * self.workers
+        for job in jobs:
+            busy[job['worker'] % self.workers] += job['end'] - job['start']
+        waits = sorted(job['queued'] for job in jobs)
+        trains = sorted(job['end'] - job['start'] for job in jobs)
+        return {
+            'workers': self.workers,
+            'cpus': self.sets,
+            'jobs': len(jobs),
+            'queue_depth': queued,
+            'queue_depth_mean': statistics.mean(depths) if depths else 0.0,
+            'queue_depth_max': max(depths, default=0),
+            'queue_wait_p50_s': statistics.median(waits) if waits else 0.0,
+            'queue_wait_max_s': waits[-1] if waits else 0.0,
+            'train_p50_s': statistics.median(trains) if trains else 0.0,
+            'utilisation': [b / elapsed for b in busy],
+        }
+
+    def report(self):
+        s = self.stats()
+        lines = [f"Training pool: {s['workers']} workers, {s['jobs']} jobs, queue depth {s['queue_depth']} "
+                 f"(mean {s['queue_depth_mean']:.1f}, max {s['queue_depth_max']} at submission), "
+                 f"queue wait p50 {s['queue_wait_p50_s']:.2f} s (max {s['queue_wait_max_s']:.2f} s), "
+                 f"training p50 {s['train_p50_s']:.2f} s"]
+        for i, (cpus, utilisation) in enumerate(zip(s['cpus'], s['utilisation'])):
+            lines.append(f'  worker {i}: CPUs {",".join(map(str, cpus))}, {utilisation * 100:.0f}% busy')
+        return '\n'.join(lines)
+
+    def close(self):
+        self._pool.shutdown(cancel_futures=True)
+        with self._lock:
+            for shm in self._segments.values():
+                shm.close()
+                shm.unlink()
+            self._segments.clear()
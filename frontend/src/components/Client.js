@@ -1,6 +1,6 @@
 import React, { useState, useEffect, useRef } from 'react';
 import ContractArtifact from "./EncFederatedLearningDeployment#EncFederatedLearningContract.json";
-import { waitForTransaction, loadMNISTDataset, trainModel, loadModelFromIPFS, storeWeightsOnIPFS, loadWeightsFromIPFS, decLoadModelFromIPFS, encStoreWeightsOnIPFS, decLoadWeightsFromIPFS, loadPrivateKeyFromHex, loadPublicKeyFromHex, generateECDHKeyPair, decryptMessage } from './utils';
+import { waitForTransaction, loadMNISTDataset, trainModel, loadModelFromIPFS, storeWeightsOnIPFS, loadWeightsFromIPFS, decLoadModelFromIPFS, encStoreWeightsOnIPFS, decLoadWeightsFromIPFS, loadPrivateKeyFromHex, loadPublicKeyFromHex, generateECDHKeyPair, decryptMessage, sharedSecretToKey, unwrapKey } from './utils';
 import CryptoJS, { enc } from 'crypto-js';
 const { ethers } = require('ethers');
 
@@ -69,13 +69,14 @@ const Client = () => {
 
         var local_sharedKey = sharedKey;
         var aesKey = null;
+        var uploadKey = null;
 
         if(local_sharedKey==null){
           const serverPublicKeyString = await contract.getMainPK(project);
           console.log("serverPublicKeyString:", serverPublicKeyString);
           const serverPublicKey = loadPublicKeyFromHex(serverPublicKeyString);
           const sharedSecret = ECDHPrivateKey.derive(serverPublicKey.getPublic());
-          local_sharedKey = CryptoJS.enc.Hex.parse(sharedSecret.toString(16));
+          local_sharedKey = sharedSecretToKey(sharedSecret);
           setSharedKey(local_sharedKey);
         }
 
@@ -93,7 +94,7 @@ const Client = () => {
         }
 
         await new Promise((resolve) => {
-          contract.on('EncryptedKey', async (clientAddr, projId, _, encryptedKey) => {
+          contract.on('EncryptedKey', async (clientAddr, projId, iteration, encryptedKey) => {
             console.log('EncryptedKey event received');
             if (String(clientAddr) !== String(clientAddress) || Number(projId) !== Number(project)) {
               console.log('Event is not for me or this project.', clientAddr, Number(projId));
@@ -101,9 +102,8 @@ const Client = () => {
             } else {
               console.log("sharedKey:", local_sharedKey.toString());
               console.log("encryptedKey:", encryptedKey);
-              const aesKeyStr = decryptMessage(encryptedKey, local_sharedKey);
-              console.log("aesKeyStr:", aesKeyStr);
-              aesKey = CryptoJS.enc.Hex.parse(aesKeyStr);
+              // Legacy or hkdf-v1 wrapping, whichever the manager used
+              ({ aesKey, uploadKey } = unwrapKey(encryptedKey, local_sharedKey, Number(projId), String(clientAddress), Number(iteration)));
               console.log('AES Key:', aesKey);
               contract.removeAllListeners('EncryptedKey');
               resolve();
@@ -139,7 +139,7 @@ const Client = () => {
 
         console.log('Storing local model weights on IPFS...');
         // const weightIPFSHash = await storeWeightsOnIPFS(local_model);
-        const weightIPFSHash = await encStoreWeightsOnIPFS(local_model, local_sharedKey);
+        const weightIPFSHash = await encStoreWeightsOnIPFS(local_model, uploadKey);
         console.log('Done. New model weights stored on IPFS with hash:', weightIPFSHash);
         setIPFSHash(weightIPFSHash);
         // setModel(local_model);
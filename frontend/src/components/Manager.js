@@ -2,7 +2,7 @@ import React, { useState, useEffect, useRef } from 'react';
 import * as tf from '@tensorflow/tfjs';
 import ContractArtifact from "./EncFederatedLearningDeployment#EncFederatedLearningContract.json";
 
-import { waitForTransaction, saveWeight, loadWeight, aggregate, loadMNISTDataset, evaluateModel, storeWeightsOnIPFS, loadWeightsFromIPFS, storeModelOnIPFS, exportModelToBytes, encStoreModelOnIPFS, encStoreWeightsOnIPFS, decLoadWeightsFromIPFS, generateRandomKey, loadPrivateKeyFromHex, loadPublicKeyFromHex, encryptMessage, decryptMessage, dtree, generateECDHKeyPair } from './utils';
+import { waitForTransaction, saveWeight, loadWeight, aggregate, loadMNISTDataset, evaluateModel, storeWeightsOnIPFS, loadWeightsFromIPFS, storeModelOnIPFS, exportModelToBytes, encStoreModelOnIPFS, encStoreWeightsOnIPFS, decLoadWeightsFromIPFS, generateRandomKey, loadPrivateKeyFromHex, loadPublicKeyFromHex, encryptMessage, decryptMessage, dtree, generateECDHKeyPair, sharedSecretToKey } from './utils';
 import ModelUploader from './ModelUploader';
 import CryptoJS, { enc } from 'crypto-js';
 import{ Mutex } from 'async-mutex';
@@ -248,7 +248,7 @@ const Manager = () => {
         var newKeyList = keyListRef.current;
         const clientPublicKey = loadPublicKeyFromHex(clientPK);
         const sharedSecret = ECDHPrivateKey.derive(clientPublicKey.getPublic());
-        sharedKey = CryptoJS.enc.Hex.parse(sharedSecret.toString(16));
+        sharedKey = sharedSecretToKey(sharedSecret);
         newKeyList.set(clientAddress, sharedKey);
         setKeyList(newKeyList);
       }
@@ -48,6 +48,39 @@ export function decryptMessage(cipherText, aesKey) {
   return message;
 }
 
+// Key scheme hkdf-v1, as in emulator/utils/session.py: HKDF-SHA256 (salt 'fl-session/v1')
+// over the ECDH secret, one 32-byte key per purpose ('upload', 'wrap'), project, client
+// address and iteration. The round key then arrives as 'v1:' + base64(iv | AES-256-CBC(key));
+// any other encryptedKey is the legacy AES-ECB of the hex key under the raw secret.
+const SESSION_LABEL = 'fl-session/v1';
+
+export function sharedSecretToKey(sharedSecret) {
+  // The ECDH x-coordinate as 32 bytes, keeping leading zeros
+  return CryptoJS.enc.Hex.parse(sharedSecret.toString(16).padStart(64, '0'));
+}
+
+export function deriveSessionKeys(sharedKey, projectId, clientAddress, iteration) {
+  const prk = CryptoJS.HmacSHA256(sharedKey, CryptoJS.enc.Utf8.parse(SESSION_LABEL));
+  const expand = (purpose) => {
+    const info = `${SESSION_LABEL}/${purpose}/${projectId}/${clientAddress.toLowerCase()}/${iteration}`;
+    return CryptoJS.HmacSHA256(CryptoJS.enc.Utf8.parse(info).concat(CryptoJS.enc.Hex.parse('01')), prk);
+  };
+  return { upload: expand('upload'), wrap: expand('wrap') };
+}
+
+export function unwrapKey(encryptedKey, sharedKey, projectId, clientAddress, iteration) {
+  // Returns the round key and the key to encrypt this round's upload with
+  if (!encryptedKey.startsWith('v1:')) {
+    return { aesKey: CryptoJS.enc.Hex.parse(decryptMessage(encryptedKey, sharedKey)), uploadKey: sharedKey };
+  }
+  const keys = deriveSessionKeys(sharedKey, projectId, clientAddress, iteration);
+  const data = CryptoJS.enc.Base64.parse(encryptedKey.slice(3)).toString(CryptoJS.enc.Hex);
+  const aesKey = CryptoJS.AES.decrypt(
+    { ciphertext: CryptoJS.enc.Hex.parse(data.slice(32)) }, keys.wrap,
+    { iv: CryptoJS.enc.Hex.parse(data.slice(0, 32)), mode: CryptoJS.mode.CBC, padding: CryptoJS.pad.Pkcs7 });
+  return { aesKey: aesKey, uploadKey: keys.upload };
+}
+
 // Generate a random AES key
 export function generateRandomKey() {
   const keyArray = new Uint8Array(32); // 256 bits
@@ -30,6 +30,7 @@ contract EncFederatedLearningContract {
     mapping(address => uint256) public projectsOwners;
     uint256 constant NON_EXISTENT = type(uint256).max;
     event LocalTrainingFinished(address indexed clientAddress, uint256 indexed projectId, uint256 indexed iteration);
+    event LocalModelUploaded(address indexed clientAddress, uint256 indexed projectId, uint256 indexed iteration, string modelAddress);
     event GlobalModelUpdated(address indexed managerAddress, uint256 indexed projectId, uint256 indexed iteration);
     event AchieveKey(address indexed clientAddress, uint256 indexed projectId, uint256 indexed iteration, string clientPK);
     event EncryptedKey(address indexed clientAddress, uint256 indexed projectId, uint256 indexed iteration, string encryptedKey);
@@ -168,6 +169,7 @@ contract EncFederatedLearningContract {
         require(project.active, "Project is not active");
         require(isTrainer(msg.sender, projectId), "Has not joined");
         project.localModelIPFSAddress[msg.sender] = modelAddress;
+        emit LocalModelUploaded(msg.sender, projectId, project.iteration, modelAddress);
         project.count--;
         if(project.count==0){
             project.active = false;
@@ -175,6 +177,16 @@ contract EncFederatedLearningContract {
         }
     }
 
+    // Close the iteration before every trainer has uploaded (quorum or deadline reached);
+    // later uploads revert and the missing entries of getLocalModels are empty
+    function closeRound(uint256 projectId) external {
+        require(projectIdCounter > projectId, "Project does not exist");
+        FLProject storage project = projects[projectId];
+        require(project.managerAddress==msg.sender, "Only FL manager can do");
+        require(project.active, "Project is not active");
+        project.active = false;
+    }
+
     function getLocalModels(uint256 projectId) external view returns (string[] memory){
         require(projectIdCounter > projectId, "Project does not exist");
         FLProject storage project = projects[projectId];
@@ -220,12 +232,15 @@ contract EncFederatedLearningContract {
 
         distributeIncentiveFee(projectId, incentiveFees);
 
-        //reset process
+        //reset process, dropping this iteration's uploads so a straggler of the
+        //next one does not hand back a stale model address from getLocalModels
         uint256 numTrainers = project.trainers.length;
         for (uint256 i = 0; i < numTrainers; i++) {
+            delete project.localModelIPFSAddress[project.trainers[i]];
             delete project.trainers[i];
         }
         project.trainers = new address[](0);
+        project.count = 0;
     }
 
     function updateEncryptedKey(uint256 projectId, address clientAddress, string calldata encryptedKey) external {
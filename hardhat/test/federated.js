@@ -74,6 +74,46 @@ describe("EncFederatedLearningContract", function () {
         expect(clientAddresses[0]).to.equal(participant.address);
     });
     
+    it("should let the manager close an iteration before every trainer has uploaded", async function () {
+        const modelArchAddress = "modelArchIPFSAddress";
+        const modelWeightAddress = "globalModelWeightIPFSAddress";
+        const oneTimeFee = 1;
+        const managerPK = "managerPublicKey";
+
+        await contract.connect(manager).create(modelArchAddress, modelWeightAddress, oneTimeFee, managerPK);
+        await contract.connect(participant).join(0, "participantPublicKey", { value: ethers.parseEther("0.1") });
+        await contract.connect(otherParticipant).join(0, "otherParticipantPublicKey", { value: ethers.parseEther("0.1") });
+
+        const modelAddress = "modelIPFSAddress";
+        await expect(contract.connect(participant).local_upload(0, modelAddress))
+            .to.emit(contract, 'LocalModelUploaded')
+            .withArgs(participant.address, 0, 1, modelAddress);
+
+        await contract.connect(manager).closeRound(0);
+        await expect(contract.connect(otherParticipant).local_upload(0, "lateModelIPFSAddress"))
+            .to.be.revertedWith("Project is not active");
+
+        const clientIPFSHashes = await contract.connect(manager).getLocalModels(0);
+        expect(clientIPFSHashes[0]).to.equal(modelAddress);
+        expect(clientIPFSHashes[1]).to.equal("");
+
+        await contract.connect(manager).updateGlobalModel(0, "newGlobalModelIPFSAddress", [1, 0]);
+        await contract.connect(manager).whetherContinue(0, true);
+        const project = await contract.projects(0);
+        expect(project.count).to.equal(0);  // the straggler does not block the next iteration
+
+        // Second iteration: the previous uploader is now the straggler and must not
+        // get its first-iteration model address back
+        await contract.connect(participant).join(0, "participantPublicKey");
+        await contract.connect(otherParticipant).join(0, "otherParticipantPublicKey");
+        await contract.connect(otherParticipant).local_upload(0, "secondModelIPFSAddress");
+        await contract.connect(manager).closeRound(0);
+
+        const secondIPFSHashes = await contract.connect(manager).getLocalModels(0);
+        expect(secondIPFSHashes[0]).to.equal("");
+        expect(secondIPFSHashes[1]).to.equal("secondModelIPFSAddress");
+    });
+
     it("should allow the manager to update the global model", async function () {
         const modelArchAddress = "modelArchIPFSAddress";
         const modelWeightAddress = "globalModelWeightIPFSAddress";